@@ -0,0 +1,259 @@
+"""
+Offline batch analysis of a corpus, without the beanstalkd queue.
+
+The corpus is a JSONL file (optionally gzipped) with one job per line,
+in the same format as the jobs of the queue. It is streamed through a
+pool of worker processes (forked once the language data and spaCy are
+loaded), and the jobs with their analysis are written to a JSONL file
+(gzipped when its name ends with .gz), in input order by default.
+
+When it finishes, it prints the throughput, the time spent in each
+stage of the analysis and the ratio of discarded jobs.
+
+Usage examples:
+    python3 -m analyzer.batch corpus.jsonl -o results.jsonl.gz
+    python3 -m analyzer.batch corpus.jsonl.gz -o results.jsonl \
+        --workers 8 --chunk-size 128 --unordered
+"""
+import argparse
+import functools
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+import time
+import analyzer.engine
+from analyzer import budget
+
+# Stages of the analysis of a job, timed separately
+STAGES = ['decode', 'profile', 'text', 'encode']
+
+# Jobs sent to a worker at once
+CHUNK_SIZE = 64
+
+# Jobs between two progress reports
+REPORT_INTERVAL = 10000
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def open_corpus(path):
+    """
+    Open the corpus for reading ('-' is the standard input).
+    """
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def open_results(path):
+    """
+    Open the results file for writing ('-' is the standard output).
+    """
+    if path == '-':
+        return sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+    return open(path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+
+
+def read_lines(corpus_file):
+    """
+    Yields every non empty line of the corpus.
+    """
+    for line in corpus_file:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def analyze_line(line, time_budget=None):
+    """
+    Analyze a line of the corpus, like the runner does with a job.
+    It returns a (status, output, timings) tuple, where status is
+    'analyzed', 'discarded', 'timeout' or 'error', output is the job with
+    its 'analysis' as a JSON line (None on errors), and timings are the
+    seconds spent in each stage (see STAGES). The analysis of a job is
+    aborted after time_budget seconds, and tagged '<timeout>'.
+    """
+    timings = [0.0] * len(STAGES)
+    started_at = time.perf_counter()
+    try:
+        job_json = json.loads(line)
+    except ValueError:
+        return ('error', None, timings)
+    finished_at = time.perf_counter()
+    timings[0] = finished_at - started_at
+    try:
+        with budget.TimeBudget(time_budget):
+            started_at = finished_at
+            analysis = analyzer.engine.user_profile_analysis(job_json)
+            finished_at = time.perf_counter()
+            timings[1] = finished_at - started_at
+            if analysis is not None:
+                started_at = finished_at
+                analysis = analyzer.engine.text_analysis(job_json, analysis)
+                finished_at = time.perf_counter()
+                timings[2] = finished_at - started_at
+        status = 'discarded' if analysis is None else 'analyzed'
+    except budget.JobTimeout:
+        finished_at = time.perf_counter()
+        timings[2 if timings[1] > 0 else 1] = finished_at - started_at
+        status = 'timeout'
+        analysis = analyzer.engine.timeout_analysis(time_budget)
+    except Exception as error:
+        # A single bad job shouldn't stop the whole corpus
+        print('Error analyzing a job: ' + str(error), file=sys.stderr)
+        return ('error', None, timings)
+    job_json['analysis'] = analysis
+    output = json.dumps(job_json)
+    timings[3] = time.perf_counter() - finished_at
+    return (status, output, timings)
+
+
+class BatchStats(object):
+    """
+    Job counts and time spent in each stage of a batch analysis.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.counts = dict(analyzed=0, discarded=0, timeout=0, error=0)
+        self.timings = [0.0] * len(STAGES)
+
+    @property
+    def jobs(self):
+        return sum(self.counts.values())
+
+    def add(self, status, timings):
+        self.counts[status] += 1
+        for index, seconds in enumerate(timings):
+            self.timings[index] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def throughput(self):
+        elapsed = self.elapsed()
+        if elapsed == 0:
+            return float('inf')
+        return self.jobs / elapsed
+
+    def discard_ratio(self):
+        if self.jobs == 0:
+            return 0.0
+        return self.counts['discarded'] / self.jobs
+
+    def report(self, file=sys.stderr):
+        print('%d jobs in %.1f s: %.1f jobs/sec, %d analyzed, %d discarded '
+              '(%.1f%%), %d timeouts, %d errors' % (
+                  self.jobs, self.elapsed(), self.throughput(),
+                  self.counts['analyzed'], self.counts['discarded'],
+                  100 * self.discard_ratio(), self.counts['timeout'],
+                  self.counts['error']),
+              file=file, flush=True)
+
+    def report_stages(self, file=sys.stderr):
+        # Stage times are added up across the workers
+        total = sum(self.timings)
+        for stage, seconds in zip(STAGES, self.timings):
+            print('  %-8s %10.1f s %8.3f ms/job %6.1f%%' % (
+                stage, seconds, 1000 * seconds / max(self.jobs, 1),
+                100 * seconds / total if total > 0 else 0.0),
+                  file=file, flush=True)
+
+
+def analyze_corpus(lines, results_file, workers=1, chunk_size=CHUNK_SIZE, ordered=True,
+                   keep_discarded=False, report_interval=REPORT_INTERVAL, time_budget=None):
+    """
+    Analyze every line of the corpus and write the results. With more
+    than one worker, the lines are analyzed by a pool of processes, in
+    chunks of chunk_size lines. Discarded jobs are only written with
+    keep_discarded (with a null analysis), and the ones that time out
+    are written tagged '<timeout>'. It returns the BatchStats.
+    """
+    stats = BatchStats()
+    pool = None
+    analyze = functools.partial(analyze_line, time_budget=time_budget)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(analyze, lines, chunk_size)
+        else:
+            results = pool.imap_unordered(analyze, lines, chunk_size)
+    else:
+        results = map(analyze, lines)
+    try:
+        for status, output, timings in results:
+            stats.add(status, timings)
+            if status in ('analyzed', 'timeout') or (status == 'discarded' and keep_discarded):
+                results_file.write(output + '\n')
+            if report_interval and stats.jobs % report_interval == 0:
+                stats.report()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return stats
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Analyze a JSONL corpus of jobs offline.')
+    parser.add_argument('corpus', help='JSONL corpus, gzipped if it ends with .gz '
+                        '(- for the standard input)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL results file, gzipped if it ends with .gz '
+                        '(default: the standard output)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Jobs sent to a worker at once')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Write the results as soon as they are ready, '
+                        'instead of in input order')
+    parser.add_argument('--keep-discarded', action='store_true',
+                        help='Write the discarded jobs too, with a null analysis')
+    parser.add_argument('--report-interval', type=int, default=REPORT_INTERVAL,
+                        help='Jobs between two progress reports (0 to disable)')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='Seconds the analysis of a job may take (default: no limit)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    # Load everything before forking the workers, so they share it
+    analyzer.engine.warm_up()
+    corpus_file = open_corpus(args.corpus)
+    results_file = open_results(args.output)
+    try:
+        stats = analyze_corpus(read_lines(corpus_file), results_file,
+                               workers=args.workers,
+                               chunk_size=args.chunk_size,
+                               ordered=not args.unordered,
+                               keep_discarded=args.keep_discarded,
+                               report_interval=args.report_interval,
+                               time_budget=args.time_budget)
+    finally:
+        if corpus_file is not sys.stdin:
+            corpus_file.close()
+        if results_file is not sys.stdout:
+            results_file.close()
+        else:
+            results_file.flush()
+    stats.report()
+    stats.report_stages()
+    return 0 if stats.counts['error'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Time budget for the analysis of a job.
+
+A single pathological message can make a grammar rule backtrack for
+seconds. Within a TimeBudget, the analysis is aborted with JobTimeout
+once the budget has run out:
+
+    with budget.TimeBudget(2.0):
+        analysis = analyzer.engine.nlp_analysis(job_json)
+
+In the main thread of a process (e.g. a runner worker), a SIGALRM timer
+interrupts the analysis wherever it is, even in the middle of a regex
+search. Elsewhere (or where there's no SIGALRM), the deadline is only
+checked between the stages of the analysis and the grammar rules (see
+check()).
+
+The parts of the analysis that must not be interrupted (e.g. writes to
+the caches) run within shield(): the timeout is raised when they finish.
+"""
+import signal
+import threading
+import time
+
+# Solution and problem of the analysis of a job that timed out
+TIMEOUT_TAG = '<timeout>'
+
+
+class JobTimeout(Exception):
+    """
+    The time budget of a job has run out.
+    """
+
+    def __init__(self, seconds):
+        Exception.__init__(self, 'The analysis took more than %.3f seconds' % seconds)
+        self.seconds = seconds
+
+
+def can_interrupt():
+    return (hasattr(signal, 'setitimer') and
+            threading.current_thread() is threading.main_thread())
+
+
+class TimeBudget(object):
+    """
+    Context manager that raises JobTimeout when its block takes longer
+    than seconds. With no seconds (None or 0), it does nothing.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = None
+        self.expired = False
+        self.restored = False
+        self.shields = 0
+        self.interrupting = False
+        self.previous = None
+        self.previous_handler = None
+        self.previous_timer = None
+
+    def __enter__(self):
+        if not self.seconds:
+            return self
+        self.previous = CURRENT['budget']
+        CURRENT['budget'] = self
+        self.deadline = time.perf_counter() + self.seconds
+        if can_interrupt():
+            self.interrupting = True
+            self.previous_timer = signal.getitimer(signal.ITIMER_REAL)
+            self.previous_handler = signal.signal(signal.SIGALRM, self.expire)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.seconds:
+            self.restore()
+        return False
+
+    def restore(self):
+        """
+        Disarm the timer, and put back the previous SIGALRM handler, timer
+        and budget. It only does it once: either when the block finishes
+        or when the timeout is raised, whichever comes first (an alarm
+        can go off as __exit__() starts).
+        """
+        if self.restored:
+            return
+        self.restored = True
+        # A late alarm must not raise anymore
+        self.shields += 1
+        try:
+            if self.interrupting:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, self.previous_handler)
+                if self.previous_timer[0] > 0:
+                    signal.setitimer(signal.ITIMER_REAL, *self.previous_timer)
+        finally:
+            CURRENT['budget'] = self.previous
+
+    def expire(self, signum=None, frame=None):
+        self.expired = True
+        if self.shields == 0:
+            self.restore()
+            raise JobTimeout(self.seconds)
+
+    def check(self):
+        if self.expired or time.perf_counter() > self.deadline:
+            self.expire()
+
+
+# Budget of the job being analyzed
+CURRENT = dict(budget=None)
+
+
+def check():
+    """
+    Raise JobTimeout if the budget of the current job has run out.
+    """
+    current_budget = CURRENT['budget']
+    if current_budget is not None:
+        current_budget.check()
+
+
+class shield(object):
+    """
+    Context manager that defers the timeout of the current job until its
+    block has finished.
+    """
+
+    def __enter__(self):
+        self.budget = CURRENT['budget']
+        if self.budget is not None:
+            self.budget.shields += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.budget is not None:
+            self.budget.shields -= 1
+            if exc_type is None and self.budget.shields == 0:
+                self.budget.check()
+        return False
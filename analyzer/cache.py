@@ -0,0 +1,236 @@
+"""
+Caches for the analysis results.
+
+AnalysisCache is a bounded LRU cache (with an optional TTL) that can be
+backed by a local sqlite file, so its entries survive restarts and can
+be shared by several worker processes. It is bounded by the number of
+entries and, optionally, by their approximate size in bytes. The sqlite
+file is bounded too, by its number of rows (see SqliteStore).
+
+Every cache has a fingerprint of the language data it was filled with
+(see files_fingerprint()). Stored entries with a different fingerprint
+are never returned, so the cache is invalidated whenever the language
+data files change.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Default maximum number of rows of each namespace of a sqlite store
+STORE_MAX_ROWS = 1000000
+
+# The rows over the limit are evicted every STORE_TRIM_INTERVAL puts
+# (counting them on every put would be too slow), and the expired ones
+# every STORE_PURGE_INTERVAL seconds
+STORE_TRIM_INTERVAL = 100
+STORE_PURGE_INTERVAL = 300
+
+
+def files_fingerprint(paths):
+    """
+    Returns a hash of the contents of the given files.
+    """
+    fingerprint = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as language_file:
+            fingerprint.update(hashlib.sha1(language_file.read()).digest())
+    return fingerprint.hexdigest()
+
+
+def text_key(*texts):
+    """
+    Returns a hash of the given texts, to be used as a cache key.
+    """
+    key = hashlib.sha1()
+    for text in texts:
+        key.update(str(text).encode('utf-8'))
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+def normalize_text(text):
+    """
+    Normalizes a message before it is used as a cache key, so that the
+    copies of a message (e.g. retweets) that only differ in their unicode
+    composition or surrounding whitespace share the same entry.
+    """
+    return unicodedata.normalize('NFC', text).strip()
+
+
+class SqliteStore(object):
+    """
+    On-disk store for an AnalysisCache. The connection is opened lazily
+    in each process, so the store can be shared by forked workers.
+    The oldest rows of the namespace are evicted while there are more
+    than max_rows, and the rows older than ttl seconds are purged
+    periodically (see put()).
+    """
+
+    def __init__(self, path, namespace, fingerprint, max_rows=STORE_MAX_ROWS, ttl=None):
+        self.path = path
+        self.namespace = namespace
+        self.fingerprint = fingerprint
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.connection = None
+        self.pid = None
+        self.puts = 0
+        self.purged_at = 0
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=10)
+            self.pid = os.getpid()
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, '
+                'fingerprint TEXT, value TEXT, stored_at REAL, '
+                'PRIMARY KEY (namespace, key))')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS cache_stored_at ON cache (namespace, stored_at)')
+            # Entries from other versions of the language data are useless
+            self.connection.execute(
+                'DELETE FROM cache WHERE namespace = ? AND fingerprint != ?',
+                (self.namespace, self.fingerprint))
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key):
+        """
+        Returns (value, stored_at), or None.
+        """
+        row = self.connect().execute(
+            'SELECT value, stored_at FROM cache WHERE namespace = ? AND key = ? '
+            'AND fingerprint = ?', (self.namespace, key, self.fingerprint)).fetchone()
+        if row is None:
+            return None
+        return (json.loads(row[0]), row[1])
+
+    def put(self, key, value, stored_at):
+        connection = self.connect()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+            (self.namespace, key, self.fingerprint, json.dumps(value), stored_at))
+        self.puts += 1
+        if self.puts % STORE_TRIM_INTERVAL == 0:
+            self.trim(connection)
+        if self.ttl is not None and stored_at - self.purged_at >= STORE_PURGE_INTERVAL:
+            self.purge(connection, stored_at)
+        connection.commit()
+
+    def trim(self, connection):
+        """
+        Evict the oldest rows of the namespace over max_rows.
+        """
+        if self.max_rows is None:
+            return
+        connection.execute(
+            'DELETE FROM cache WHERE namespace = ? AND stored_at <= ('
+            'SELECT stored_at FROM cache WHERE namespace = ? '
+            'ORDER BY stored_at DESC LIMIT 1 OFFSET ?)',
+            (self.namespace, self.namespace, self.max_rows))
+
+    def purge(self, connection, now):
+        """
+        Delete the expired rows of the namespace.
+        """
+        self.purged_at = now
+        connection.execute('DELETE FROM cache WHERE namespace = ? AND stored_at < ?',
+                           (self.namespace, now - self.ttl))
+
+    def delete(self, key):
+        connection = self.connect()
+        connection.execute('DELETE FROM cache WHERE namespace = ? AND key = ?',
+                           (self.namespace, key))
+        connection.commit()
+
+
+class AnalysisCache(object):
+    """
+    Bounded LRU cache with an optional TTL (in seconds) and an optional
+    sqlite store (path). Values must be JSON serializable.
+    When max_bytes is given, the least recently used entries are also
+    evicted while the entries in memory take more than max_bytes (their
+    size is estimated from their JSON encoding). The sqlite store keeps
+    at most max_rows entries.
+    """
+
+    def __init__(self, max_entries, ttl=None, path=None, namespace='', fingerprint='',
+                 max_bytes=None, max_rows=STORE_MAX_ROWS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+        self.entries = OrderedDict()
+        self.size = 0
+        self.store = None
+        if path:
+            self.store = SqliteStore(path, namespace, fingerprint, max_rows, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if self.expired(entry[1]):
+                self.forget(key)
+                entry = None
+            else:
+                self.entries.move_to_end(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                if self.expired(entry[1]):
+                    self.store.delete(key)
+                    entry = None
+                else:
+                    self.remember(key, entry[0], entry[1])
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        stored_at = time.time()
+        self.remember(key, value, stored_at)
+        if self.store is not None:
+            self.store.put(key, value, stored_at)
+
+    def remember(self, key, value, stored_at):
+        if key in self.entries:
+            self.forget(key)
+        size = len(key) + len(json.dumps(value))
+        self.entries[key] = (value, stored_at, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes and
+                len(self.entries) > 1):
+            self.size -= self.entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def forget(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counters, and the number and
+        approximate size of the entries in memory.
+        """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    entries=len(self.entries),
+                    bytes=self.size,
+                    hit_rate=self.hits / lookups if lookups > 0 else 0.0)
@@ -1,39 +1,236 @@
 """
 Example of a script performing an NLP analysis of a given message
 """
+import gc
 from datetime import datetime
+from analyzer import budget
+from analyzer import cache
+from analyzer import metrics
+from analyzer import snapshot
 from analyzer.engines import user_analyzer
 from analyzer.engines import text_analyzer
 ## Initialization ##
 
-# User analysis
-DICTIONARY = user_analyzer.dictionary_parser(
-    './language_data/user_dictionary.txt')
-LEXICON = user_analyzer.lexicon_generator(
-    './language_data/user_grammar.txt', DICTIONARY)
-STRING_TWITTER_QUERIES = user_analyzer.string_twitter_queriesParser(
-    './language_data/string_twitter_queries.txt')
-
-
-# Text analysis
-LANGUAGE_DATA = text_analyzer.language_data_loader(
-    './language_data/grammar.txt',
-    './language_data/counter_grammar.txt',
-    './language_data/start_words.txt',
-    './language_data/stop_words.txt'
+LANGUAGE_DATA_PATHS = snapshot.LANGUAGE_DATA_PATHS
+
+# Default size of the caches (see setup_caches())
+PROFILE_CACHE_SIZE = 100000
+TEXT_CACHE_SIZE = 100000
+TEXT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_CONFIG = dict(
+    profile_cache_size=PROFILE_CACHE_SIZE,
+    profile_cache_ttl=None,
+    profile_cache_path=None,
+    profile_cache_max_rows=cache.STORE_MAX_ROWS,
+    text_cache_size=TEXT_CACHE_SIZE,
+    text_cache_max_bytes=TEXT_CACHE_MAX_BYTES,
+    text_cache_ttl=None,
+    text_cache_path=None,
+    text_cache_max_rows=cache.STORE_MAX_ROWS,
+    rule_cache_size=text_analyzer.RULE_CACHE_SIZE
 )
 
+# Message analyzed by warm_up()
+WARM_UP_MESSAGE = 'Is there any treatment for cancer? Aspirin is the new treatment for fever'
 
-def nlp_analysis(job_json):
+
+class Engine(object):
     """
-    It takes a job as an input and returns an analysis.
+    The language resources (see analyzer.snapshot), the spaCy model and
+    the caches of the analysis. Nothing is loaded until it is first
+    needed, so importing the engine is cheap.
+
+    warm_up() loads everything at once. A supervisor calls it before
+    forking its workers, so they share the loaded objects (copy-on-write)
+    instead of loading their own copies.
+    """
+
+    def __init__(self, paths=LANGUAGE_DATA_PATHS, snapshot_path=snapshot.SNAPSHOT_PATH):
+        self.paths = paths
+        self.snapshot_path = snapshot_path
+        self.cache_config = DEFAULT_CACHE_CONFIG
+        self.resources = None
+        self.fingerprint = None
+        self.caches = None
+
+    def load(self):
+        """
+        Returns the language resources, loading them on first use.
+        """
+        if self.resources is None:
+            self.resources = snapshot.load_resources(self.paths, self.snapshot_path)
+            self.resize_rule_caches()
+        return self.resources
+
+    def resize_rule_caches(self):
+        """
+        Apply the configured size of the compiled rules caches of the
+        grammars (see text_analyzer.RuleSet).
+        """
+        rule_cache_size = self.cache_config.get('rule_cache_size',
+                                                text_analyzer.RULE_CACHE_SIZE)
+        language_data = self.resources['language_data']
+        for name in ['grammar', 'counter_grammar']:
+            language_data[name].resize_cache(rule_cache_size)
+
+    @property
+    def dictionary(self):
+        return self.load()['dictionary']
+
+    @property
+    def lexicon(self):
+        return self.load()['lexicon']
+
+    @property
+    def string_twitter_queries(self):
+        return self.load()['string_twitter_queries']
+
+    @property
+    def language_data(self):
+        return self.load()['language_data']
+
+    @property
+    def language_data_fingerprint(self):
+        # Cached results are only valid for the language data they come from
+        if self.fingerprint is None:
+            self.fingerprint = cache.files_fingerprint(sorted(self.paths.values()))
+        return self.fingerprint
+
+    def setup_caches(self, cache_config):
+        """
+        Set the cache options (see config_loader.CACHE_CONFIG). The caches
+        are created again on their next use.
+        """
+        self.cache_config = cache_config
+        self.caches = None
+        if self.resources is not None:
+            self.resize_rule_caches()
+
+    def get_caches(self):
+        if self.caches is None:
+            config = self.cache_config
+            self.caches = dict(
+                # User profile verdicts, by user name and description
+                profile=cache.AnalysisCache(config['profile_cache_size'],
+                                            config['profile_cache_ttl'],
+                                            config['profile_cache_path'],
+                                            'profile',
+                                            self.language_data_fingerprint,
+                                            max_rows=config.get('profile_cache_max_rows',
+                                                                cache.STORE_MAX_ROWS)),
+                # Text analysis results, by message (retweets and spam
+                # repeat them a lot)
+                text=cache.AnalysisCache(config['text_cache_size'],
+                                         config['text_cache_ttl'],
+                                         config['text_cache_path'],
+                                         'text',
+                                         self.language_data_fingerprint,
+                                         config['text_cache_max_bytes'],
+                                         config.get('text_cache_max_rows',
+                                                    cache.STORE_MAX_ROWS)))
+        return self.caches
+
+    @property
+    def profile_cache(self):
+        return self.get_caches()['profile']
+
+    @property
+    def text_cache(self):
+        return self.get_caches()['text']
+
+    def warm_up(self):
+        """
+        Load the language resources, the spaCy model and the caches, and
+        analyze a message so that every lazily built object is ready.
+        """
+        self.load()
+        self.get_caches()
+        text_analyzer.NLP.load()
+        analyze_message(WARM_UP_MESSAGE)
+        # Objects loaded so far are never collected, so the garbage
+        # collector doesn't write to their pages in forked workers
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+
+
+ENGINE = Engine()
+
+# Former module level names, now loaded on first use
+LAZY_ATTRIBUTES = dict(
+    DICTIONARY='dictionary',
+    LEXICON='lexicon',
+    STRING_TWITTER_QUERIES='string_twitter_queries',
+    LANGUAGE_DATA='language_data',
+    LANGUAGE_DATA_FINGERPRINT='language_data_fingerprint',
+    PROFILE_CACHE='profile_cache',
+    TEXT_CACHE='text_cache'
+)
+
+
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTES:
+        return getattr(ENGINE, LAZY_ATTRIBUTES[name])
+    raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
+
+
+def warm_up():
+    """
+    Load everything the analysis needs (see Engine.warm_up()).
+    """
+    ENGINE.warm_up()
+
+
+def setup_caches(cache_config):
+    """
+    Set up the caches from the [cache] section of config.ini (see
+    config_loader.CACHE_CONFIG).
+    """
+    ENGINE.setup_caches(cache_config)
+
+
+def cache_stats():
+    """
+    Returns the stats of every cache (see AnalysisCache.stats()), by name.
+    """
+    return dict((name, analysis_cache.stats())
+                for name, analysis_cache in ENGINE.get_caches().items())
+
+
+def user_analysis_cached(user_name, user_description):
+    """
+    user_analyzer() verdict for a user, cached by name and description,
+    since the same accounts post many times a day.
+    """
+    key = cache.text_key(user_name, user_description)
+    # A hit reorders the entries of the cache, so it's shielded too
+    with budget.shield():
+        user_analysis = ENGINE.profile_cache.get(key)
+    if user_analysis is None:
+        user_analysis = user_analyzer.user_analyzer(user_name,
+                                                    user_description,
+                                                    ENGINE.string_twitter_queries,
+                                                    ENGINE.lexicon)
+        with budget.shield():
+            ENGINE.profile_cache.put(key, user_analysis)
+    return list(user_analysis)
+
+
+# Batch analysis: number of messages sent to spaCy at once, and threads
+BATCH_SIZE = 1000
+BATCH_THREADS = 2
+
+
+def user_profile_analysis(job_json):
+    """
+    First step of the analysis: the user profile. It returns the analysis
+    with 'profile', 'profile_origin' and 'health_related', or None when
+    the user is not health related.
     """
     analysis = dict()
     # Get 'profile' and 'health_related'
-    user_analysis = user_analyzer.user_analyzer(job_json['user_name'],
-                                                job_json['user_description'],
-                                                STRING_TWITTER_QUERIES,
-                                                LEXICON)
+    user_analysis = user_analysis_cached(job_json['user_name'],
+                                         job_json['user_description'])
 
     analysis['profile'] = user_analysis[1]
     analysis['profile_origin'] = user_analysis[2]
@@ -43,16 +240,59 @@ def nlp_analysis(job_json):
 
     if not analysis['health_related']:
         return None
+    return analysis
+
 
+def analyze_message(message, parsed_message=None, start_word_span=False):
+    """
+    text_analyzer.analyzer() output for a message, with the loaded
+    language data.
+    """
     # The text analyzer inferes a health related problem and its solution,
     # when available
-    text_analysis = text_analyzer.analyzer(job_json['message'],
-                                           LANGUAGE_DATA['start_words'],
-                                           LANGUAGE_DATA['grammar'],
-                                           LANGUAGE_DATA['counter_grammar'],
-                                           LANGUAGE_DATA['stop_words'],
-                                           LANGUAGE_DATA['magic_bullet_grammar'])
+    return text_analyzer.analyzer(message,
+                                  ENGINE.language_data['start_words'],
+                                  ENGINE.language_data['grammar'],
+                                  ENGINE.language_data['counter_grammar'],
+                                  ENGINE.language_data['stop_words'],
+                                  ENGINE.language_data['magic_bullet_grammar'],
+                                  parsed_message,
+                                  start_word_span)
 
+
+def message_analysis_cached(message, parsed_message=None):
+    """
+    analyze_message() output, cached by the normalized message text. The
+    normalized text is the one analyzed, so that all the messages sharing
+    a cache entry get the same analysis.
+    """
+    normalized_message = cache.normalize_text(message)
+    key = cache.text_key(normalized_message)
+    with budget.shield():
+        text_analysis = ENGINE.text_cache.get(key)
+    if text_analysis is None:
+        if normalized_message != message:
+            # It was parsed from the original text
+            parsed_message = None
+        text_analysis = analyze_message(normalized_message, parsed_message)
+        with budget.shield():
+            ENGINE.text_cache.put(key, text_analysis)
+    return list(text_analysis)
+
+
+def text_analysis(job_json, analysis, parsed_message=None):
+    """
+    Second step of the analysis: the message. It adds the 'solution' and
+    'problem' to the analysis returned by user_profile_analysis().
+    """
+    return add_text_analysis(analysis,
+                             message_analysis_cached(job_json['message'], parsed_message))
+
+
+def add_text_analysis(analysis, text_analysis):
+    """
+    Adds the output of analyze_message() to the analysis.
+    """
     analysis['solution'] = text_analysis[0]
     analysis['problem'] = text_analysis[1]
 
@@ -61,6 +301,87 @@ def nlp_analysis(job_json):
     return analysis
 
 
+def nlp_analysis(job_json):
+    """
+    It takes a job as an input and returns an analysis.
+    """
+    started_at = metrics.start()
+    analysis = user_profile_analysis(job_json)
+    metrics.stop('stage_seconds', started_at, stage='profile')
+    budget.check()
+    if analysis is not None:
+        text_started_at = metrics.start()
+        analysis = text_analysis(job_json, analysis)
+        metrics.stop('stage_seconds', text_started_at, stage='text')
+    metrics.stop('analysis_seconds', started_at)
+    return analysis
+
+
+def nlp_analysis_batch(jobs, batch_size=BATCH_SIZE, n_threads=BATCH_THREADS):
+    """
+    It takes a list of jobs as an input and returns a list with their
+    analyses (None for the discarded ones), like nlp_analysis() would.
+
+    The user profiles are analyzed first. Then, the messages of the health
+    related users that are not cached and contain a start word are parsed
+    together with spaCy's pipe(), before the rule matching runs for each
+    distinct message. Like message_analysis_cached(), it analyzes the
+    normalized text of the messages. The start word of each message is
+    searched only once, and the result handed to the analyzer.
+    """
+    analyses = [user_profile_analysis(job_json) for job_json in jobs]
+
+    keys = dict()
+    messages = dict()
+    start_word_spans = dict()
+    text_analyses = dict()
+    to_parse = []
+    for index, job_json in enumerate(jobs):
+        if analyses[index] is None:
+            continue
+        messages[index] = cache.normalize_text(job_json['message'])
+        key = cache.text_key(messages[index])
+        keys[index] = key
+        if key in text_analyses:
+            continue
+        with budget.shield():
+            text_analyses[key] = ENGINE.text_cache.get(key)
+        if text_analyses[key] is None:
+            started_at = metrics.start()
+            start_word_spans[index] = text_analyzer.get_start_word_span(
+                messages[index], ENGINE.language_data['start_words'])
+            metrics.stop('stage_seconds', started_at, stage='start_word')
+            if start_word_spans[index] is not None:
+                to_parse.append(index)
+    parsed_messages = dict(zip(to_parse, text_analyzer.parse_messages(
+        [messages[index] for index in to_parse], batch_size, n_threads)))
+
+    results = []
+    for index, job_json in enumerate(jobs):
+        if analyses[index] is None:
+            results.append(None)
+            continue
+        key = keys[index]
+        if text_analyses[key] is None:
+            text_analyses[key] = analyze_message(messages[index],
+                                                 parsed_messages.get(index),
+                                                 start_word_spans[index])
+            with budget.shield():
+                ENGINE.text_cache.put(key, text_analyses[key])
+        results.append(add_text_analysis(analyses[index], list(text_analyses[key])))
+    return results
+
+
+def timeout_analysis(time_budget):
+    """
+    The analysis of a job whose time budget ran out, tagged '<timeout>'.
+    """
+    return dict(solution=budget.TIMEOUT_TAG,
+                problem=budget.TIMEOUT_TAG,
+                time_budget=time_budget,
+                created_at=datetime.now().isoformat())
+
+
 def dummy_nlp_analysis(input_job):
     """
     An nlp analysis function returns a JSON with the analysis results
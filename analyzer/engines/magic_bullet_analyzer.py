@@ -2,14 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import re
-from spacy.en import English
-NLP = English()
+from analyzer import metrics
+from analyzer import rule_profiler
 
 
+class LazyLanguage(object):
+    """
+    spaCy's English() model, loaded on first use (it takes seconds and
+    hundreds of MB), so that importing the analyzers is cheap.
+    """
+
+    def __init__(self):
+        self.language = None
+
+    def load(self):
+        if self.language is None:
+            from spacy.en import English
+            self.language = English()
+        return self.language
+
+    def __call__(self, text):
+        return self.load()(text)
+
+    def pipe(self, texts, **kwargs):
+        return self.load().pipe(texts, **kwargs)
+
+
+NLP = LazyLanguage()
+
+
+DUMMY_CONTEXT = 'Pretty tinny long short yellow dummy'
+
 
 def enlarge_message(message):
 
-    dummy_context = 'Pretty tinny long short yellow dummy'
+    dummy_context = DUMMY_CONTEXT
 
     if message.endswith('.'):
         message = dummy_context + '. ' + message + ' ' + dummy_context
@@ -19,6 +46,79 @@ def enlarge_message(message):
     return message
 
 
+class ParsedMessage(object):
+    """
+    A message parsed with spaCy at most once, and only when its noun
+    phrases are first needed. It is shared by text_analyzer and
+    magic_bullet_analyzer for a single analysis.
+
+    The parse is made on the enlarged message (see enlarge_message()),
+    and noun chunks can be requested for the enlarged message or for a
+    span of the original one (e.g. the sentence with the start word).
+    """
+
+    def __init__(self, message, nlp=None):
+        self.message = message
+        self.enlarged_message = enlarge_message(message)
+        # Position of the original message in the enlarged one:
+        self.offset = len(DUMMY_CONTEXT) + 2
+        self.nlp = nlp if nlp is not None else NLP
+        self.parses = 0
+        self._noun_chunks = None
+
+    def to_enlarged(self, position):
+        """
+        Maps an offset of the original message into the enlarged one.
+        """
+        return position + self.offset
+
+    def from_enlarged(self, position):
+        """
+        Maps an offset of the enlarged message into the original one.
+        """
+        return position - self.offset
+
+    def set_doc(self, doc):
+        """
+        Stores the noun chunks of an already parsed enlarged message
+        (e.g. when the messages have been parsed in batches).
+        """
+        self._noun_chunks = [(np.text, np.start_char, np.end_char)
+                             for np in doc.noun_chunks]
+
+    def enlarged_noun_chunks(self):
+        """
+        Returns a list of (text, start, end) tuples for every noun chunk
+        of the enlarged message, with offsets in the enlarged message.
+        """
+        if self._noun_chunks is None:
+            self.parses += 1
+            started_at = metrics.start()
+            self.set_doc(self.nlp(self.enlarged_message))
+            metrics.stop('stage_seconds', started_at, stage='spacy')
+        return self._noun_chunks
+
+    def enlarged_noun_phrases(self):
+        """
+        Returns the text of every noun chunk of the enlarged message.
+        """
+        return [np[0] for np in self.enlarged_noun_chunks()]
+
+    def noun_chunks(self, start=0, end=None):
+        """
+        Returns a list of (text, start, end) tuples for the noun chunks
+        that lie within message[start:end], with offsets relative to
+        start.
+        """
+        if end is None:
+            end = len(self.message)
+        enlarged_start = self.to_enlarged(start)
+        enlarged_end = self.to_enlarged(end)
+        return [(np[0], np[1] - enlarged_start, np[2] - enlarged_start)
+                for np in self.enlarged_noun_chunks()
+                if np[1] >= enlarged_start and np[2] <= enlarged_end]
+
+
 def get_magic_bullet_instance_and_type(pattern):
 
     result = []
@@ -43,7 +143,8 @@ def get_magic_bullet_instance_and_type(pattern):
     return result
 
 
-def get_string_match_plus_noun_phrases(magic_bullet_instance, start_word, noun_phrases, message):
+def get_string_match_plus_noun_phrases(magic_bullet_instance, start_word, noun_phrases, message,
+                                       parsed_message=None):
 
     result = [None, noun_phrases]
     
@@ -67,9 +168,12 @@ def get_string_match_plus_noun_phrases(magic_bullet_instance, start_word, noun_p
     
     if magic_bullet_instance in message.lower():
         if len(noun_phrases) == 0:
-            for np in NLP(message).noun_chunks:
-                np = np.text
-                noun_phrases.append(np)
+            if parsed_message is not None:
+                noun_phrases.extend(parsed_message.enlarged_noun_phrases())
+            else:
+                for np in NLP(message).noun_chunks:
+                    np = np.text
+                    noun_phrases.append(np)
         for np in noun_phrases:
             if magic_bullet_instance in np.lower():
                 if np.split()[-1].lower() == magic_bullet_instance:
@@ -103,27 +207,188 @@ def get_regex_match(magic_bullet_instance, message):
     return result
 
 
-def magic_bullet_analyzer(message, start_word, magic_bullet_grammar, stop_words):
+class MagicBulletGrammar(object):
+    """
+    Magic bullet rules preprocessed once: a table with the instance, type
+    and compiled regexes of every rule, plus a combined regex that finds
+    the first match of every case B/C rule in a single scan.
 
-    message = enlarge_message(message)
+    The combined regex is a sequence of optional lookaheads, one named
+    group per rule, guarded by a lookahead on their alternation. Since a
+    lookahead at position p matches exactly what re.match() would match
+    at p, the first position where a group participates gives the same
+    match as re.search() on that rule alone.
+
+    It can be used wherever the list of rules is expected (iteration,
+    'in' tests and len()).
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.rules = []
+        regex_rules = []
+        for index, pattern in enumerate(self.patterns):
+            instance_and_type = get_magic_bullet_instance_and_type(pattern)
+            rule = dict(pattern=pattern,
+                        instance=instance_and_type[0],
+                        type=instance_and_type[1],
+                        regex=None,
+                        context_regex=None)
+            if rule['type'] != 'case A':
+                # Any other type is matched as a regex (see get_regex_match())
+                rule['regex'] = re.compile(str(rule['instance']), flags=re.IGNORECASE)
+                regex_rules.append(index)
+            if rule['type'] == 'case B':
+                rule['context_regex'] = re.compile(pattern.replace('[npl]', ''),
+                                                   flags=re.IGNORECASE)
+            elif rule['type'] == 'case C':
+                rule['context_regex'] = re.compile(pattern.replace('[npr]', ''),
+                                                   flags=re.IGNORECASE)
+            self.rules.append(rule)
+        self.regex_rules = regex_rules
+        self.combined_regex = self.combine(regex_rules)
+
+    def combine(self, regex_rules):
+        """
+        Returns the combined regex for the given rule indexes, or None
+        if their instances cannot be combined (e.g. they use back
+        references or inline flags).
+        """
+        if len(regex_rules) == 0:
+            return None
+        instances = [str(self.rules[index]['instance']) for index in regex_rules]
+        for instance in instances:
+            if re.search(r'\\\d|\(\?P=', instance):
+                return None
+        guard = '(?=' + '|'.join('(?:' + instance + ')' for instance in instances) + ')'
+        groups = ''.join('(?:(?=(?P<r' + str(index) + '>' + instance + ')))?'
+                         for index, instance in zip(regex_rules, instances))
+        try:
+            return re.compile(guard + groups, flags=re.IGNORECASE)
+        except re.error:
+            return None
+
+    def regex_matches(self, message):
+        """
+        Returns a dict with the match of every case B/C rule (by rule
+        index) found in message, like get_regex_match() would.
+        """
+        matches = dict()
+        profiler = rule_profiler.active()
+        # The rules are searched one by one when they are profiled, so
+        # the time of each one is known
+        if self.combined_regex is None or profiler is not None:
+            for index in self.regex_rules:
+                rule = self.rules[index]
+                if profiler is None:
+                    search_regex = rule['regex'].search(message)
+                else:
+                    search_regex = profiler.search('magic_bullet', rule['pattern'],
+                                                   rule['regex'], message)
+                if search_regex is not None:
+                    matches[index] = search_regex.group(0)
+            return matches
+        pending = list(self.regex_rules)
+        for position_match in self.combined_regex.finditer(message):
+            still_pending = []
+            for index in pending:
+                group_name = 'r' + str(index)
+                if position_match.start(group_name) != -1:
+                    matches[index] = position_match.group(group_name)
+                else:
+                    still_pending.append(index)
+            pending = still_pending
+            if len(pending) == 0:
+                break
+        return matches
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class StopWords(object):
+    """
+    The stop words (regexes of noun phrases that cannot be extracted as
+    entities), compiled once into a single alternation, so a noun phrase
+    is checked against all of them in one search.
+
+    It can be used wherever the list of stop words is expected
+    (iteration, 'in' tests and len()).
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.regexes = None
+        self.combined_regex = None
+        try:
+            if len(self.patterns) > 0:
+                self.combined_regex = re.compile(
+                    '|'.join('(?:' + pattern + ')' for pattern in self.patterns))
+        except re.error:
+            # E.g. inline flags or group references: they are searched
+            # one by one
+            self.regexes = [re.compile(pattern) for pattern in self.patterns]
+
+    def search(self, noun_phrase):
+        """
+        Returns True if any stop word is found in noun_phrase.
+        """
+        if self.regexes is not None:
+            for regex in self.regexes:
+                if regex.search(noun_phrase):
+                    return True
+            return False
+        if self.combined_regex is None:
+            return False
+        return self.combined_regex.search(noun_phrase) is not None
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+def magic_bullet_analyzer(message, start_word, magic_bullet_grammar, stop_words,
+                          parsed_message=None):
+
+    if not isinstance(magic_bullet_grammar, MagicBulletGrammar):
+        magic_bullet_grammar = MagicBulletGrammar(magic_bullet_grammar)
+    if not isinstance(stop_words, StopWords):
+        stop_words = StopWords(stop_words)
+    # The message is parsed at most once, and only if noun phrases are needed:
+    if parsed_message is None:
+        parsed_message = ParsedMessage(message)
+    message = parsed_message.enlarged_message
     noun_phrases = []
     matching_pattern = None
     longest_match = ''
     type_of_longest_match = None
+    matching_rule = None
     output = []
 
-    for pattern in magic_bullet_grammar:
+    # All case B/C rules are searched at once:
+    regex_matches = magic_bullet_grammar.regex_matches(message)
 
-        instance_and_type = get_magic_bullet_instance_and_type(pattern)
+    for index, rule in enumerate(magic_bullet_grammar.rules):
 
-        if instance_and_type[1] == 'case A':
-            result = get_string_match_plus_noun_phrases(instance_and_type[0], start_word, noun_phrases, message)
+        if rule['type'] == 'case A':
+            result = get_string_match_plus_noun_phrases(rule['instance'], start_word, noun_phrases, message,
+                                                        parsed_message)
             match = result[0]
-            type_of_match = 'case A'
         else:
-            match = get_regex_match(instance_and_type[0], message)
-            type_of_match = instance_and_type[1]
-        
+            match = regex_matches.get(index)
+        type_of_match = rule['type']
+
         if match is not None:
             if type_of_match == 'case A':
                 if len(noun_phrases) == 0:
@@ -131,14 +396,11 @@ def magic_bullet_analyzer(message, start_word, magic_bullet_grammar, stop_words)
             if len(match) > len(longest_match):
                 longest_match = match
                 type_of_longest_match = type_of_match
-                matching_pattern = pattern
+                matching_pattern = rule['pattern']
+                matching_rule = rule
 
     if type_of_longest_match == 'case A':
-        stop_word_found = False
-        for stop_word in stop_words:
-            if re.search(stop_word, str(longest_match)):
-                stop_word_found = True
-        if stop_word_found is False:
+        if not stop_words.search(str(longest_match)):
             output.append(longest_match)
             output.append(start_word)
             output.append(matching_pattern)
@@ -149,19 +411,12 @@ def magic_bullet_analyzer(message, start_word, magic_bullet_grammar, stop_words)
     
     elif type_of_longest_match == 'case B':
         if len(noun_phrases) == 0:
-            for np in NLP(message).noun_chunks:
-                np = np.text
-                noun_phrases.append(np)
-        pattern_context = matching_pattern.replace('[npl]', '')
-        target_longest_match = re.sub(pattern_context, '' ,longest_match,flags=re.IGNORECASE)
+            noun_phrases = parsed_message.enlarged_noun_phrases()
+        target_longest_match = matching_rule['context_regex'].sub('', longest_match)
         np_fits = False
         for np in noun_phrases[::-1]:
-            stop_word_found = False
             if np in target_longest_match:
-                for stop_word in stop_words:
-                    if re.search(stop_word, str(np)):
-                        stop_word_found = True
-                if stop_word_found is False:
+                if not stop_words.search(str(np)):
                     output.append(np)
                     output.append(start_word)
                     output.append(matching_pattern)
@@ -174,19 +429,12 @@ def magic_bullet_analyzer(message, start_word, magic_bullet_grammar, stop_words)
 
     elif type_of_longest_match == 'case C':
         if len(noun_phrases) == 0:
-            for np in NLP(message).noun_chunks:
-                np = np.text
-                noun_phrases.append(np)
-        pattern_context = matching_pattern.replace('[npr]', '')
-        target_longest_match = re.sub(pattern_context, '' ,longest_match,flags=re.IGNORECASE)
+            noun_phrases = parsed_message.enlarged_noun_phrases()
+        target_longest_match = matching_rule['context_regex'].sub('', longest_match)
         np_fits = False
         for np in noun_phrases:
-            stop_word_found = False
             if np in target_longest_match:
-                for stop_word in stop_words:
-                    if re.search(stop_word, str(np)):
-                        stop_word_found = True
-                if stop_word_found is False:
+                if not stop_words.search(str(np)):
                     output.append(np)
                     output.append(start_word)
                     output.append(matching_pattern)
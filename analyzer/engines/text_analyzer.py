@@ -12,6 +12,10 @@ and its corresponding disease.
 
 """
 import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 # Text codification must be UTF-8 for SpaCy (NLP library)
 
 # There's no sys.sederaultencoding in Python3
@@ -19,15 +23,16 @@ import re
 # reload(sys)
 # sys.setdefaultencoding('utf8')
 
-# Load SpaCy and English module
-from spacy.en import English
-NLP = English()
-
 # Load magic_bullet_analyzer() function, a separate module
-# Before: from analyzer.engines import magic_bullet_analyzer
-import sys
-sys.path.append('./analyzer/engines')
-import magic_bullet_analyzer
+from analyzer.engines import magic_bullet_analyzer
+from analyzer import budget
+from analyzer import metrics
+from analyzer import rule_profiler
+
+# SpaCy's English module is loaded once (on first use), and shared with
+# magic_bullet_analyzer()
+NLP = magic_bullet_analyzer.NLP
+StopWords = magic_bullet_analyzer.StopWords
 
 def file_parser(path, to_lower):
     """
@@ -45,6 +50,36 @@ def file_parser(path, to_lower):
     return results
 
 
+# Single tokens that don't index any start word (too common):
+FORBIDDEN_SINGLE_TOKENS = [
+    '^of$',
+    '^type$',
+    '^with$',
+    '^and$',
+    '^the$',
+    '^\\d+$',
+    '^acute$',
+    '^system$',
+    '^primary$',
+    '^involving$',
+    '^dominant$',
+    '^recurrent$',
+    '^or$',
+    '^to$',
+    '^in$',
+    '^without$',
+    '^situ$',
+    '^types$',
+    '^due$',
+    '^(I|II|III|IV|V|VI|VII|VIII|XIX|X)$',
+    '^[A-Z]$',
+    '^by$'
+]
+
+# All of them at once:
+FORBIDDEN_SINGLE_TOKENS_REGEX = re.compile('|'.join(FORBIDDEN_SINGLE_TOKENS))
+
+
 def start_words_to_dict(start_words):
     """
     Create a dict of "start words" from a large file of disease
@@ -59,41 +94,376 @@ def start_words_to_dict(start_words):
             else:
                 single_tokens[token] = []
                 single_tokens[token].append(start_word)
-    forbidden_single_tokens = [
-        '^of$',
-        '^type$',
-        '^with$',
-        '^and$',
-        '^the$',
-        '^\d+$',
-        '^acute$',
-        '^system$',
-        '^primary$',
-        '^involving$',
-        '^dominant$',
-        '^recurrent$',
-        '^or$',
-        '^to$',
-        '^in$',
-        '^without$',
-        '^situ$',
-        '^types$',
-        '^due$',
-        '^(I|II|III|IV|V|VI|VII|VIII|XIX|X)$',
-        '^[A-Z]$',
-        '^by$'
-    ]
     single_tokens_to_delete = []
     for single_token in single_tokens.keys():
-        for forbidden_single_token in forbidden_single_tokens:
-            if re.search(forbidden_single_token, single_token):
-                single_tokens_to_delete.append(single_token)
-                break
+        if FORBIDDEN_SINGLE_TOKENS_REGEX.search(single_token):
+            single_tokens_to_delete.append(single_token)
     for single_token_to_delete in single_tokens_to_delete:
         del single_tokens[single_token_to_delete]
     return single_tokens
 
 
+class StartWordIndex(object):
+    """
+    Compact version of the dict returned by start_words_to_dict(). Every
+    term is stored once, and the terms of all the tokens are packed into
+    a single array of term ids (postings), instead of a list of strings
+    per token.
+
+    It can be used wherever the start words dict is expected: keys(),
+    items(), item lookups (which return a list of terms), 'in' tests,
+    iteration and len() behave the same.
+    """
+
+    def __init__(self, start_words):
+        term_ids = dict()
+        self.terms = []
+        token_postings = dict()
+        for start_word in start_words:
+            term_id = term_ids.get(start_word)
+            if term_id is None:
+                term_id = term_ids[start_word] = len(self.terms)
+                self.terms.append(start_word)
+            for token in start_word.split():
+                postings = token_postings.get(token)
+                if postings is None:
+                    postings = token_postings[token] = array('I')
+                postings.append(term_id)
+        # Position of each token's postings in self.postings
+        self.tokens = dict()
+        self.offsets = array('I', [0])
+        self.postings = array('I')
+        for token, postings in token_postings.items():
+            if FORBIDDEN_SINGLE_TOKENS_REGEX.search(token):
+                continue
+            self.tokens[sys.intern(token)] = len(self.offsets) - 1
+            self.postings.extend(postings)
+            self.offsets.append(len(self.postings))
+
+    def keys(self):
+        return self.tokens.keys()
+
+    def items(self):
+        return [(single_token, self[single_token]) for single_token in self.tokens]
+
+    def __getitem__(self, single_token):
+        index = self.tokens[single_token]
+        terms = self.terms
+        return [terms[term_id]
+                for term_id in self.postings[self.offsets[index]:self.offsets[index + 1]]]
+
+    def __contains__(self, single_token):
+        return single_token in self.tokens
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+# Transitions are keyed by (state << CHAR_BITS) | ord(char) while a
+# StartWordAutomaton is built
+CHAR_BITS = 21
+
+# Markers of StartWordAutomaton.single_chars, for the states without
+# transitions and for the ones with more than one. They are unicode
+# noncharacters, which are not expected in start words.
+NO_TRANSITION = '\ufffe'
+BRANCHING = '\uffff'
+
+
+class StartWordAutomaton(object):
+    """
+    Aho-Corasick automaton built over every term of a start words dict
+    (see start_words_to_dict() and StartWordIndex). It finds the longest
+    start word in a message with a single pass over its lowercased text.
+
+    The states are kept in a string and a few arrays (see
+    _pack_transitions()), rather than in a dict and a few objects per
+    state, since there are about as many states as characters in the
+    start words.
+
+    It can be used wherever the start words dict is expected, since
+    keys(), items() and item lookups are delegated to that dict.
+    """
+
+    def __init__(self, start_words):
+        self.start_words = start_words
+        # Terms are ranked in the order start_word_match() used to visit
+        # them, so that ties between terms of the same length are
+        # resolved the same way.
+        terms = []
+        ranks = dict()
+        for single_token in start_words.keys():
+            for term in start_words[single_token]:
+                if term not in ranks:
+                    ranks[term] = len(terms)
+                    terms.append(term)
+        self.terms = terms
+        # Every transition, while the automaton is built
+        transitions = dict()
+        self.best = array('i', [-1])
+        # Parent state and character of every state, for the failure links
+        parents = array('I', [0])
+        chars = array('I', [0])
+        depths = array('I', [0])
+        for term_id, term in enumerate(terms):
+            state = 0
+            for char in term:
+                key = (state << CHAR_BITS) | ord(char)
+                next_state = transitions.get(key)
+                if next_state is None:
+                    next_state = transitions[key] = len(self.best)
+                    self.best.append(-1)
+                    parents.append(state)
+                    chars.append(ord(char))
+                    depths.append(depths[state] + 1)
+                state = next_state
+            self.best[state] = self._better(self.best[state], term_id)
+        self.fail = array('I', bytes(4 * len(self.best)))
+        self._build_failure_links(transitions, parents, chars, depths)
+        self._pack_transitions(transitions, parents, chars)
+
+    def _better(self, term_id, other_term_id):
+        """
+        Returns the preferred term between two term ids (-1 for none): the
+        longest one, or the one with the lowest rank if both have the
+        same length.
+        """
+        if term_id < 0:
+            return other_term_id
+        if other_term_id < 0:
+            return term_id
+        if len(self.terms[other_term_id]) > len(self.terms[term_id]):
+            return other_term_id
+        if len(self.terms[other_term_id]) == len(self.terms[term_id]) \
+                and other_term_id < term_id:
+            return other_term_id
+        return term_id
+
+    def _build_failure_links(self, transitions, parents, chars, depths):
+        """
+        Construction of the failure links, in order of depth (the failure
+        link of a state always points to a shallower one). Each state also
+        inherits the best term reachable through its failure link.
+        """
+        fail = self.fail
+        for state in sorted(range(1, len(self.best)), key=depths.__getitem__):
+            parent = parents[state]
+            code = chars[state]
+            fail_state = 0
+            if parent != 0:
+                fail_state = fail[parent]
+                while fail_state and ((fail_state << CHAR_BITS) | code) not in transitions:
+                    fail_state = fail[fail_state]
+                fail_state = transitions.get((fail_state << CHAR_BITS) | code, 0)
+            fail[state] = fail_state
+            self.best[state] = self._better(self.best[state], self.best[fail_state])
+
+    def _pack_transitions(self, transitions, parents, chars):
+        """
+        Most states have a single transition: its character is kept in
+        the single_chars string and its next state in the single_next
+        array. The transitions of the branching states are kept in a dict
+        for each of them (in branches, at the single_next position).
+        """
+        single_chars = [NO_TRANSITION] * len(self.best)
+        self.single_next = array('I', bytes(4 * len(self.best)))
+        self.branches = []
+        for key, next_state in transitions.items():
+            state = key >> CHAR_BITS
+            char = chr(chars[next_state])
+            if single_chars[state] == NO_TRANSITION:
+                single_chars[state] = char
+                self.single_next[state] = next_state
+                continue
+            if single_chars[state] != BRANCHING:
+                self.branches.append({single_chars[state]: self.single_next[state]})
+                single_chars[state] = BRANCHING
+                self.single_next[state] = len(self.branches) - 1
+            self.branches[self.single_next[state]][char] = next_state
+        self.single_chars = ''.join(single_chars)
+        # Transitions from the root state
+        if single_chars[0] == BRANCHING:
+            self.root = self.branches[self.single_next[0]]
+        elif single_chars[0] == NO_TRANSITION:
+            self.root = dict()
+        else:
+            self.root = {single_chars[0]: self.single_next[0]}
+
+    def search(self, message_to_lower):
+        """
+        Returns [term, start, end] for the longest term found in
+        message_to_lower (its first occurrence), or None.
+        """
+        single_chars = self.single_chars
+        single_next = self.single_next
+        branches = self.branches
+        root = self.root
+        fail = self.fail
+        best = self.best
+        state = 0
+        found = -1
+        found_end = 0
+        for position, char in enumerate(message_to_lower):
+            while state:
+                state_char = single_chars[state]
+                if state_char == BRANCHING:
+                    next_state = branches[single_next[state]].get(char)
+                    if next_state is not None:
+                        state = next_state
+                        break
+                elif state_char == char:
+                    state = single_next[state]
+                    break
+                state = fail[state]
+            else:
+                state = root.get(char, 0)
+                if state == 0:
+                    continue
+            candidate = best[state]
+            if candidate >= 0 and candidate != found \
+                    and self._better(found, candidate) == candidate:
+                found = candidate
+                found_end = position + 1
+        if found < 0:
+            return None
+        term = self.terms[found]
+        return [term, found_end - len(term), found_end]
+
+    def keys(self):
+        return self.start_words.keys()
+
+    def items(self):
+        return self.start_words.items()
+
+    def __getitem__(self, single_token):
+        return self.start_words[single_token]
+
+    def __contains__(self, single_token):
+        return single_token in self.start_words
+
+    def __iter__(self):
+        return iter(self.start_words)
+
+    def __len__(self):
+        return len(self.start_words)
+
+
+# Maximum number of compiled rules kept by a RuleSet, across all the
+# start words (each one takes about 1 KB, and every start word needs a
+# compiled instance of every rule):
+RULE_CACHE_SIZE = 4096
+
+
+class RuleSet(object):
+    """
+    A list of grammar rules that are compiled once per start word.
+    Compiled instances are kept in a LRU cache keyed by start word, so
+    the grammar is not recompiled for every message. The cache holds at
+    most cache_size compiled rules (but always the latest start word),
+    and nothing with a cache_size of 0.
+
+    It can be used wherever the list of rules is expected (iteration,
+    'in' tests and len()). kind names the rules in the rule profiler
+    (see analyzer.rule_profiler).
+    """
+
+    def __init__(self, patterns, remove_solution=False, cache_size=RULE_CACHE_SIZE,
+                 kind='grammar'):
+        self.patterns = list(patterns)
+        self.remove_solution = remove_solution
+        self.cache_size = cache_size
+        self.kind = kind
+        self.cache = OrderedDict()
+        self.cached_rules = 0
+
+    def resize_cache(self, cache_size):
+        """
+        Set the maximum number of compiled rules kept, evicting the least
+        recently used start words if needed.
+        """
+        self.cache_size = cache_size
+        self.evict()
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cached_rules = 0
+
+    def evict(self):
+        while self.cache and (self.cached_rules > self.cache_size or self.cache_size == 0):
+            if len(self.cache) == 1 and self.cache_size > 0:
+                break
+            _, compiled_rules = self.cache.popitem(last=False)
+            self.cached_rules -= len(compiled_rules)
+
+    def instances(self, twitter_start_word):
+        """
+        Returns a list of (pattern, compiled instance) tuples, where every
+        '[p]' has been replaced by twitter_start_word (and '[s]' removed,
+        when remove_solution is set).
+        """
+        compiled_rules = self.cache.get(twitter_start_word)
+        if compiled_rules is not None:
+            self.cache.move_to_end(twitter_start_word)
+            return compiled_rules
+        compiled_rules = []
+        for pattern in self.patterns:
+            instance = pattern.replace('[p]', twitter_start_word)
+            if self.remove_solution:
+                instance = instance.replace('[s]', '')
+            compiled_rules.append((pattern, re.compile(instance, flags=re.IGNORECASE)))
+        if self.cache_size > 0:
+            # A timeout in between would leave cached_rules out of sync
+            with budget.shield():
+                self.cache[twitter_start_word] = compiled_rules
+                self.cached_rules += len(compiled_rules)
+                self.evict()
+        return compiled_rules
+
+    def longest_match(self, message, twitter_start_word, stop_at_first=False):
+        """
+        Searches every rule once in message and returns [match, pattern]
+        for the rule with the longest match (the first one on ties), or
+        None. With stop_at_first, it returns the first non-empty match.
+        The number of rules searched is recorded in the rules_evaluated
+        metric.
+        """
+        longest_match = ''
+        matching_pattern = None
+        searches = 0
+        profiler = rule_profiler.active()
+        for pattern, regex in self.instances(twitter_start_word):
+            budget.check()
+            searches += 1
+            if profiler is None:
+                search_regex = regex.search(message)
+            else:
+                search_regex = profiler.search(self.kind, pattern, regex, message)
+            if search_regex is None:
+                continue
+            match = search_regex.group(0)
+            if len(match) > len(longest_match):
+                longest_match = match
+                matching_pattern = pattern
+                if stop_at_first:
+                    break
+        metrics.observe('rules_evaluated', searches, kind=self.kind)
+        if matching_pattern is None:
+            return None
+        return [longest_match, matching_pattern]
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def __len__(self):
+        return len(self.patterns)
+
+
 def language_data_loader(grammar_path, counter_grammar_path, start_words_path, stop_words_path):
     """
     It receives three file paths as input:
@@ -116,148 +486,190 @@ def language_data_loader(grammar_path, counter_grammar_path, start_words_path, s
             language_data['magic_bullet_grammar'].append(pattern)
     for pattern in language_data['magic_bullet_grammar']:
         language_data['grammar'].remove(pattern)
+    language_data['magic_bullet_grammar'] = magic_bullet_analyzer.MagicBulletGrammar(
+        language_data['magic_bullet_grammar'])
+
+    language_data['grammar'] = RuleSet(language_data['grammar'], remove_solution=True)
 
     # Load counter_grammar
-    language_data['counter_grammar'] = file_parser(counter_grammar_path, False)
+    language_data['counter_grammar'] = RuleSet(file_parser(counter_grammar_path, False),
+                                               kind='counter_grammar')
+
+    # In profiling mode, flag the rules that are slow on adversarial input
+    if rule_profiler.active() is not None:
+        check_rules(language_data)
     
     # Load start words (a term list to recover messages on diseases)
     language_data['start_words'] = file_parser(start_words_path, True)
-    language_data['start_words'] = start_words_to_dict(language_data['start_words'])
+    language_data['start_words'] = StartWordIndex(language_data['start_words'])
+    # The automaton is built once here, so start_word_match() only needs
+    # a single pass over each message:
+    language_data['start_words'] = StartWordAutomaton(language_data['start_words'])
 
     # Load stop words (words tagged as noun phrases that cannot be extracted
     # as entities (e.g. You, @username11):
-    language_data['stop_words'] = file_parser(stop_words_path, False)
+    language_data['stop_words'] = StopWords(file_parser(stop_words_path, False))
     
     return language_data
 
 
+def check_rules(language_data, start_word=rule_profiler.CHECK_START_WORD):
+    """
+    Search the grammar, counter grammar and magic bullet rules (the
+    grammars with start_word in place of '[p]') in the adversarial
+    strings of the rule profiler. The slow rules are printed and
+    returned (see rule_profiler.check_rules()).
+    """
+    slow_rules = []
+    for kind in ['grammar', 'counter_grammar']:
+        slow_rules.extend(rule_profiler.check_rules(
+            kind, language_data[kind].instances(start_word)))
+    magic_bullet_grammar = language_data['magic_bullet_grammar']
+    slow_rules.extend(rule_profiler.check_rules(
+        'magic_bullet', [(magic_bullet_grammar.rules[index]['pattern'],
+                          magic_bullet_grammar.rules[index]['regex'])
+                         for index in magic_bullet_grammar.regex_rules]))
+    rule_profiler.warn_slow_rules(slow_rules)
+    return slow_rules
+
+
 def start_word_match(message, start_words):
     """
-    Find possible string matches of disease words into messages
+    Find possible string matches of disease words into messages.
+    start_words can be either a StartWordAutomaton or the dict returned
+    by start_words_to_dict(), in which case the automaton is built on
+    the fly.
     """
+    if not isinstance(start_words, StartWordAutomaton):
+        start_words = StartWordAutomaton(start_words)
     start_word = None
-    longest_term = ''
-    message_to_lower = message.lower()
-    for single_token in start_words.keys():
-        if single_token in message_to_lower:
-            for term in start_words[single_token]:
-                if term in message_to_lower:
-                    if len(term) > len(longest_term):
-                        longest_term = term
-    if len(longest_term) > 0:
-        start_word = longest_term
-    if start_word is not None:
-        start_position = re.search(re.escape(start_word), message_to_lower).start()
-        end_position = re.search(re.escape(start_word), message_to_lower).end()
-        start_word = message[start_position:end_position]
+    search_result = start_words.search(message.lower())
+    if search_result is not None:
+        start_word = message[search_result[1]:search_result[2]]
     return start_word
 
 
+# Sentence bounds, in order of priority. They used to be replaced one
+# after the other by a marker, and the message split on the markers:
+SENTENCE_BOUNDS = [
+    r'(?<=[^A-Z].[.?]) +(?=[A-Z])',
+    r'\.\.\.',
+    r'\? ',
+    r'\! ',
+    r' \- ',
+    r'\, ',
+    r'\: ',
+    r'; ',
+    r'http']
+
+# The same bounds in a single regex. Only a few of them can overlap, so
+# the lower priority ones don't match where a higher priority one would
+# have taken the same characters (e.g. the space in ', - '):
+SENTENCE_BOUNDS_REGEX = re.compile('|'.join([
+    SENTENCE_BOUNDS[0],
+    SENTENCE_BOUNDS[1],
+    r'\?(?!(?<=[^A-Z].\?) +[A-Z]) ',
+    SENTENCE_BOUNDS[3],
+    SENTENCE_BOUNDS[4],
+    r'\, (?!- )',
+    r'\: (?!- )',
+    r'; (?!- )',
+    SENTENCE_BOUNDS[8]]))
+
+
+def sentence_spans(message):
+    """
+    Divides the message into sentences in a single pass, and yields the
+    (start, end) offsets of each one in the message.
+    """
+    start = 0
+    for bound in SENTENCE_BOUNDS_REGEX.finditer(message):
+        yield (start, bound.start())
+        start = bound.end()
+    yield (start, len(message))
+
+
+def get_start_word_span(message, start_words):
+    """
+    Looks for the start word in the message, and returns it with the
+    offsets of the first sentence that contains it: [start_word, start,
+    end], or None.
+    """
+    start_word = start_word_match(message, start_words)
+    if start_word is None:
+        return None
+    for start, end in sentence_spans(message):
+        if message.find(start_word, start, end) >= 0:
+            return [start_word, start, end]
+    return None
+
+
 def get_start_word_from_sentence(message, start_words):
     """
     Divides the incoming message into sentences, and look for the
     start word in each sentence. When found, it returns the sentence and
     the start word found in it
     """
-
-    start_word = start_word_match(message, start_words)
-    result = []
-
-    if start_word is not None:
-        # A start_word has been found, now
-        # specify the sentence:
-        bounds = [
-            '(?<=[^A-Z].[.?]) +(?=[A-Z])',
-            '\.\.\.',
-            '\? ',
-            '\! ',
-            ' \- ',
-            '\, ',
-            '\: ',
-            '; ',
-            'http']
-        for bound in bounds:
-            message = re.sub(bound, '<bound>', message)
-        sentences = message.split('<bound>')
-        for sentence in sentences:
-            if re.search(re.escape(start_word), sentence):
-                result.append(start_word)
-                result.append(sentence)
-                break
-    
-    # Return output:
-    if len(result) == 0:
+    start_word_span = get_start_word_span(message, start_words)
+    if start_word_span is None:
         return None
-    else:
-        return result
+    return [start_word_span[0], message[start_word_span[1]:start_word_span[2]]]
 
 
-def get_noun_phrase(message, longest_match, position, stop_words):
+def get_noun_phrase(message, longest_match, position, stop_words,
+                    parsed_message=None, message_start=0):
     """
     Extracts the exact noun phrase corresponding to the solution of the
     disease problem. The arguments this function gets are defined in 
     analyzer()
-    """
+    When message is a sentence of an already parsed message
+    (parsed_message), message_start is its position in that message, and
+    its noun phrases are taken from the existing parse.
 
-    longest_match_start = re.search(re.escape(longest_match), message).start()
-    longest_match_end = re.search(re.escape(longest_match), message).end()
-    noun_phrases = []
+    Noun phrases are located by their offsets in the parse, which are in
+    text order, so the candidates next to longest_match are found with a
+    binary search.
+    """
+    if not isinstance(stop_words, StopWords):
+        stop_words = StopWords(stop_words)
 
-    # Get all noun phrases from the whole text:
-    for np in NLP(message).noun_chunks:
-        noun_phrases.append(np)
-    # If no NP is found:
-    if len(noun_phrases) == 0:
+    longest_match_start = message.find(longest_match)
+    if longest_match_start < 0:
         return None
+    longest_match_end = longest_match_start + len(longest_match)
+
+    # Get all noun phrases from the whole text, as (text, start, end):
+    if parsed_message is not None and message_start >= 0:
+        noun_phrases = parsed_message.noun_chunks(message_start,
+                                                  message_start + len(message))
     else:
+        noun_phrases = [(np.text, np.start_char, np.end_char)
+                        for np in NLP(message).noun_chunks]
+
+    # 1) Search for noun phrases in solution-problem position: 'sp'
+    # In this position, the solution is mentioned before the problem:
+    # the nearest noun phrase that ends before longest_match.
+    if position == "sp":
+        np_ends = [np[2] for np in noun_phrases]
+        candidate_nps = noun_phrases[:bisect_right(np_ends, longest_match_start)][::-1]
+
+    # 2) Search for noun phrase in problem-solution position: 'ps'
+    # In this position, the solution is mentioned after the problem:
+    # the nearest noun phrase that starts after longest_match.
+    elif position == "ps":
+        np_starts = [np[1] for np in noun_phrases]
+        candidate_nps = noun_phrases[bisect_left(np_starts, longest_match_end):]
 
-        # This variable stores the chosen noun phrase:
-        target_noun_phrase = None
-
-        # 1) Search for noun phrases in solution-problem position: 'sp'
-        # In this position, the solution is mentioned before the problem
-        if position == "sp":
-            candidate_nps = []
-            for np in noun_phrases:
-                np_end = re.search(re.escape(np.text), message).end()
-                if np_end <= longest_match_start:
-                    candidate_nps.append(np.text)
-            # Exclude noun phrase if it is stop word:
-            for candidate_np in candidate_nps[::-1]:
-                stop_word_found = False
-                for stop_word in stop_words:
-                    if re.search(stop_word, str(candidate_np)):
-                        stop_word_found = True
-                        break
-                if stop_word_found is False:
-                    target_noun_phrase = candidate_np
-                    break
-                else:
-                    continue
+    else:
+        candidate_nps = []
 
-        # 2) Search for noun phrase in problem-solution position: 'ps'
-        # In this position, the solution is mentioned after the problem
-        elif position == "ps":
-            candidate_nps = []
-            for np in noun_phrases:
-                np_start = re.search(re.escape(np.text), message).start()
-                if np_start >= longest_match_end:
-                    candidate_nps.append(np.text)
-            # Exclude noun phrase if it is stop word:
-            for candidate_np in candidate_nps:
-                stop_word_found = False
-                for stop_word in stop_words:
-                    if re.search(stop_word, str(candidate_np)):
-                        stop_word_found = True
-                        break
-                if stop_word_found is False:
-                    target_noun_phrase = candidate_np
-                    break
-                else:
-                    continue
+    # Exclude noun phrase if it is stop word:
+    for candidate_np in candidate_nps:
+        if not stop_words.search(candidate_np[0]):
+            return candidate_np[0]
 
-        # Return noun phrase ('None' if not found):
-        return target_noun_phrase
+    # Return noun phrase ('None' if not found):
+    return None
 
 
 def counter_analyzer(message, start_word, counter_grammar):
@@ -267,17 +679,10 @@ def counter_analyzer(message, start_word, counter_grammar):
     E.g. risk for + problem, is a "counter rule" that prevents a case of false
     positive in the rule: solution + for + problem
     """
-    longest_match = ''
-    for pattern in counter_grammar:
-        instance = pattern.replace('[p]', start_word)
-        if re.search(instance, message, flags=re.IGNORECASE):
-            found_instance = instance
-            match = message[re.search(found_instance, message, flags=re.IGNORECASE).start(
-                ):re.search(found_instance, message, flags=re.IGNORECASE).end()]
-            # Find the rule with the longest match in the string:
-            if len(match) > len(longest_match):
-                longest_match = match
-    if len(longest_match) > 0:
+    if not isinstance(counter_grammar, RuleSet):
+        counter_grammar = RuleSet(counter_grammar)
+    # Any match is enough to discard the message:
+    if counter_grammar.longest_match(message, start_word, stop_at_first=True) is not None:
         return True
     else:
         return False
@@ -297,7 +702,23 @@ def check_if_problem_in_solution(solution, problem):
         return True
 
 
-def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_bullet_grammar):
+def parse_messages(messages, batch_size=1000, n_threads=2):
+    """
+    Parses several messages at once with spaCy's pipe(), which is much
+    faster than parsing them one by one. It returns a ParsedMessage for
+    each message, to be passed to analyzer().
+    """
+    parsed_messages = [magic_bullet_analyzer.ParsedMessage(message, NLP)
+                       for message in messages]
+    docs = NLP.pipe([parsed_message.enlarged_message for parsed_message in parsed_messages],
+                    batch_size=batch_size, n_threads=n_threads)
+    for parsed_message, doc in zip(parsed_messages, docs):
+        parsed_message.set_doc(doc)
+    return parsed_messages
+
+
+def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_bullet_grammar,
+             parsed_message=None, start_word_span=False):
     """
     Analyzer, a treatment-entity finder.
     The input grammar follows two basic syntactic schemes,
@@ -324,6 +745,11 @@ def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_b
         magic_bullet_analyzer() looks for rich-context pattern rules that have
         priority over the conventional problem-solution rules
 
+    An already parsed message (see parse_messages()) can be given as
+    parsed_message, so that spaCy doesn't run again on it. In the same
+    way, start_word_span can be the get_start_word_span() result for the
+    message (None when it has no start word), so that it isn't searched
+    again.
     """
     # Necessary variables:
     magic_bullet_analyzer_result = None
@@ -333,11 +759,21 @@ def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_b
 
     # 1) Find the start word in the correct sentence in message,
     # then assign "message" a new value with only one sentence.
-    start_word_And_message = get_start_word_from_sentence(message, start_words)
+    if start_word_span is False:
+        started_at = metrics.start()
+        start_word_span = get_start_word_span(message, start_words)
+        metrics.stop('stage_seconds', started_at, stage='start_word')
+        budget.check()
+    start_word_And_message = start_word_span
     if start_word_And_message is not None:
         no_splitted_message = message
         start_word = start_word_And_message[0]
-        message = start_word_And_message[1]
+        message_start = start_word_And_message[1]
+        message = no_splitted_message[message_start:start_word_And_message[2]]
+        # The whole message is parsed with spaCy at most once, and shared
+        # with magic_bullet_analyzer() and get_noun_phrase():
+        if parsed_message is None:
+            parsed_message = magic_bullet_analyzer.ParsedMessage(no_splitted_message, NLP)
         # As we are're monitoring Twitter, we turn start_word into
         # twitter_start_word to get more mentions as follows:
         twitter_start_word = '(' + '#\w*' + start_word + '|' + start_word + ')'
@@ -351,11 +787,19 @@ def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_b
         # 2) Analysis process
 
         # 2.1) Counter analysis to avoid false positives:
+        started_at = metrics.start()
         counter_analyzer_result = counter_analyzer(message, twitter_start_word, counter_grammar)
+        metrics.stop('stage_seconds', started_at, stage='counter_grammar')
+        budget.check()
         if counter_analyzer_result is False:
             
-            # 2.2) Try first 'magic bullet' rules:
-            magic_bullet_analyzer_result = magic_bullet_analyzer.magic_bullet_analyzer(no_splitted_message, start_word, magic_bullet_grammar, stop_words)
+            # 2.2) Try first 'magic bullet' rules (it includes the spaCy
+            # parse, when it's needed):
+            started_at = metrics.start()
+            magic_bullet_analyzer_result = magic_bullet_analyzer.magic_bullet_analyzer(no_splitted_message, start_word, magic_bullet_grammar, stop_words,
+                                                                                      parsed_message)
+            metrics.stop('stage_seconds', started_at, stage='magic_bullet')
+            budget.check()
             if magic_bullet_analyzer_result[0] != '<nothing_found>':
                 output.append(magic_bullet_analyzer_result[0])
                 output.append(magic_bullet_analyzer_result[1])
@@ -368,21 +812,16 @@ def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_b
                 # 2.3) Look for problem-solution rule matching, as follows:
 
                 # For every stored grammar rule, generate its counterpart including the
-                # start word (e.g. '[s] for [p]' -> '[s] for anorexia')
-                for pattern in grammar:
-
-                    instance = pattern.replace('[p]', twitter_start_word)
-                    instance = instance.replace('[s]', '')
-
-                    # Test every rule against the message:
-                    if re.search(instance, message, flags=re.IGNORECASE):
-                        found_instance = instance
-                        match = message[re.search(found_instance, message, flags=re.IGNORECASE).start(
-                        ):re.search(found_instance, message, flags=re.IGNORECASE).end()]
-                        # Find the rule with the longest match in the string:
-                        if len(match) > len(longest_match):
-                            longest_match = match
-                            matching_pattern = pattern
+                # start word (e.g. '[s] for [p]' -> '[s] for anorexia'), and
+                # find the rule with the longest match in the message:
+                if not isinstance(grammar, RuleSet):
+                    grammar = RuleSet(grammar, remove_solution=True)
+                started_at = metrics.start()
+                grammar_match = grammar.longest_match(message, twitter_start_word)
+                metrics.stop('stage_seconds', started_at, stage='grammar')
+                if grammar_match is not None:
+                    longest_match = grammar_match[0]
+                    matching_pattern = grammar_match[1]
 
                 # Rule matchs if 'longest_match' contains a string,
                 # so the analysis can continue:
@@ -393,8 +832,11 @@ def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_b
                         target_match = message[:message.find(longest_match)]
                         # target_match = unicode(target_match, "utf-8" )
                         if len(target_match) >= 3:
+                            started_at = metrics.start()
                             target_noun_phrase = get_noun_phrase(
-                                message, longest_match, 'sp', stop_words)
+                                message, longest_match, 'sp', stop_words,
+                                parsed_message, message_start)
+                            metrics.stop('stage_seconds', started_at, stage='noun_phrase')
                             if target_noun_phrase is not None:
                                 output.append(target_noun_phrase)
                                 output.append(start_word)
@@ -408,8 +850,11 @@ def analyzer(message, start_words, grammar, counter_grammar, stop_words, magic_b
                         target_match = message[message.find(
                             longest_match) + len(longest_match):]
                         if len(target_match) >= 3:
+                            started_at = metrics.start()
                             target_noun_phrase = get_noun_phrase(
-                                message, longest_match, 'ps', stop_words)
+                                message, longest_match, 'ps', stop_words,
+                                parsed_message, message_start)
+                            metrics.stop('stage_seconds', started_at, stage='noun_phrase')
                             if target_noun_phrase is not None:
                                 output.append(target_noun_phrase)
                                 output.append(start_word)
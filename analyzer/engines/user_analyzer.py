@@ -96,17 +96,176 @@ def lexicon_generator(grammar_file_path, dictionary):
                 if node in dictionary.keys():
                     instanced_node = '(' + '|'.join(dictionary[node]) + ')'
                     instance = instance.replace(node, instanced_node)
-            generated_lexicon[(pattern, semantic_tag)] = instance
+            generated_lexicon[(pattern, semantic_tag)] = re.compile(instance)
         # (b) Pattern without node:
         else:
-            generated_lexicon[(pattern, semantic_tag)] = instance
+            generated_lexicon[(pattern, semantic_tag)] = re.compile(instance)
     return generated_lexicon
 
 
+def scoped_instance(instance):
+    """
+    Turns the leading inline flags of an instance into scoped flags
+    (e.g. '(?i)^physicist' -> '(?i:^physicist)'), so that it can be part
+    of a larger regex.
+    """
+    flags = re.match(r'\(\?([aiLmsux]+)\)', instance)
+    if flags:
+        return '(?' + flags.group(1) + ':' + instance[flags.end():] + ')'
+    return '(?:' + instance + ')'
+
+
+class LexiconMatcher(object):
+    """
+    Combined matcher for the lexicon returned by lexicon_generator().
+    It finds the first match of every lexicon instance in a single scan
+    of the user description.
+
+    The combined regex is a sequence of optional lookaheads, one named
+    group per instance, guarded by a lookahead on their alternation. Since
+    a lookahead at position p matches exactly what re.match() would match
+    at p, the first position where a group participates gives the same
+    match as re.search() on that instance alone.
+
+    It can be used wherever the lexicon dict is expected (items(), keys()
+    and item lookups).
+    """
+
+    def __init__(self, lexicon):
+        self.lexicon = dict()
+        for pattern_tuple, instance in lexicon.items():
+            if isinstance(instance, str):
+                instance = re.compile(instance)
+            self.lexicon[pattern_tuple] = instance
+        self.pattern_tuples = list(self.lexicon.keys())
+        self.combined_regex = self.combine()
+
+    def combine(self):
+        """
+        Returns the combined regex, or None if the instances cannot be
+        combined (e.g. they use back references).
+        """
+        if len(self.pattern_tuples) == 0:
+            return None
+        instances = [self.lexicon[pattern_tuple].pattern for pattern_tuple in self.pattern_tuples]
+        for instance in instances:
+            if re.search(r'\\\d|\(\?P[<=]', instance):
+                return None
+        scoped_instances = [scoped_instance(instance) for instance in instances]
+        guard = '(?=' + '|'.join(scoped_instances) + ')'
+        groups = ''.join('(?:(?=(?P<l' + str(index) + '>' + instance + ')))?'
+                         for index, instance in enumerate(scoped_instances))
+        try:
+            return re.compile(guard + groups)
+        except re.error:
+            return None
+
+    def matches(self, user_description):
+        """
+        Returns a list of (pattern_tuple, match) tuples, in lexicon order,
+        for every instance found in the user description.
+        """
+        found = dict()
+        if self.combined_regex is None:
+            for index, pattern_tuple in enumerate(self.pattern_tuples):
+                search_regex = self.lexicon[pattern_tuple].search(user_description)
+                if search_regex is not None:
+                    found[index] = search_regex.group(0)
+        else:
+            pending = list(range(len(self.pattern_tuples)))
+            for position_match in self.combined_regex.finditer(user_description):
+                still_pending = []
+                for index in pending:
+                    group_name = 'l' + str(index)
+                    if position_match.start(group_name) != -1:
+                        found[index] = position_match.group(group_name)
+                    else:
+                        still_pending.append(index)
+                pending = still_pending
+                if len(pending) == 0:
+                    break
+        return [(self.pattern_tuples[index], found[index]) for index in sorted(found)]
+
+    def items(self):
+        return self.lexicon.items()
+
+    def keys(self):
+        return self.lexicon.keys()
+
+    def __getitem__(self, pattern_tuple):
+        return self.lexicon[pattern_tuple]
+
+    def __len__(self):
+        return len(self.lexicon)
+
+
+def query_variants(query):
+    """
+    Case variants of a Twitter query that are looked for in the user
+    descriptions: as written, all lower, all caps and upper initial.
+    """
+    variants = [query, query.lower(), query.upper()]
+    if len(query) > 0:
+        variants.append(query[0].upper() + query[1:].lower())
+    unique_variants = []
+    for variant in variants:
+        if variant not in unique_variants:
+            unique_variants.append(variant)
+    return unique_variants
+
+
+def trie_regex(words):
+    """
+    Builds a regex matching any of the given words, where common prefixes
+    are factored out as in a trie (e.g. ['doctor', 'docs'] ->
+    'doc(?:s|tor)'), so it is matched in a single pass without trying
+    every word at each position.
+    """
+    trie = dict()
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[''] = True
+
+    def node_regex(node):
+        alternatives = [re.escape(char) + node_regex(child)
+                        for char, child in sorted(node.items()) if char != '']
+        if len(alternatives) == 0:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        regex = '(?:' + '|'.join(alternatives) + ')'
+        if '' in node:
+            regex += '?'
+        return regex
+
+    return re.compile(node_regex(trie))
+
+
+class QueryMatcher(object):
+    """
+    Matcher for the Twitter queries, built by string_twitter_queriesParser().
+    It finds any case variant of any query (see query_variants()) in a
+    single pass over the user description.
+    """
+
+    def __init__(self, queries):
+        self.queries = list(queries)
+        variants = []
+        for query in self.queries:
+            variants.extend(query_variants(query))
+        self.regex = trie_regex(variants)
+
+    def search(self, user_description):
+        return self.regex.search(user_description) is not None
+
+
 def string_twitter_queriesParser(string_twitter_queries_path):
     """
-    Read a file with all Twitter queries' possible variations (all lower, all caps,
-    upper initial). Store them into a list.
+    Read a file with the Twitter queries and build a QueryMatcher with them.
+    Case variations (all lower, all caps, upper initial) don't need to be
+    listed in the file, since the matcher looks for all of them.
     """
     string_twitter_queries = []
     string_twitter_queries_file = open(string_twitter_queries_path, 'r')
@@ -115,7 +274,7 @@ def string_twitter_queriesParser(string_twitter_queries_path):
         string_twitter_queries.append(line)
     string_twitter_queries_file.close()
 
-    return string_twitter_queries
+    return QueryMatcher(string_twitter_queries)
 
 
 
@@ -123,16 +282,13 @@ def user_description_HasQuery(user_description, string_twitter_queries):
     """
     Helper function of user_analyzer(). If a Twitter query is not present in a user
     description text, user_analyzer() doesn't go further to save time processing.
+    string_twitter_queries can be a QueryMatcher or a list of queries.
     """
-    
-    result = False
 
-    for string_twitter_query in string_twitter_queries:
-        if string_twitter_query in str(user_description):
-            result = True
-            break
-    
-    return result
+    if not isinstance(string_twitter_queries, QueryMatcher):
+        string_twitter_queries = QueryMatcher(string_twitter_queries)
+
+    return string_twitter_queries.search(str(user_description))
 
 
 
@@ -218,20 +374,17 @@ def user_analyzer(user_name, user_description, string_twitter_queries, lexicon):
         else:
 
             # 2) Analysis on the user description's text:
+            if not isinstance(lexicon, LexiconMatcher):
+                lexicon = LexiconMatcher(lexicon)
             longest_match = ''
             matching_pattern_tuple = None
-            matching_instance = None
             all_pattern_tuples = dict()
-            for pattern_tuple, instance in lexicon.items():
-                if re.search(instance, user_description):
-                    if pattern_tuple[1] not in all_pattern_tuples.keys():
-                        all_pattern_tuples[pattern_tuple[1]] = pattern_tuple[0]
-                    possible_match = user_description[re.search(instance, user_description).start(
-                    ):re.search(instance, user_description).end()]
-                    if len(possible_match) > len(longest_match):
-                        longest_match = possible_match
-                        matching_pattern_tuple = pattern_tuple
-                        matching_instance = instance
+            for pattern_tuple, possible_match in lexicon.matches(user_description):
+                if pattern_tuple[1] not in all_pattern_tuples.keys():
+                    all_pattern_tuples[pattern_tuple[1]] = pattern_tuple[0]
+                if len(possible_match) > len(longest_match):
+                    longest_match = possible_match
+                    matching_pattern_tuple = pattern_tuple
             if len(longest_match) > 0:
                 # We give preference to the following semantic tags,
                 # following this order:
@@ -0,0 +1,301 @@
+"""
+Lightweight metrics of the analysis.
+
+Hot paths time themselves with start() and stop(). Both are no-ops
+(a flag check) unless the metrics have been enabled, so the
+instrumentation costs nothing noticeable when it's switched off:
+
+    started_at = metrics.start()
+    ...
+    metrics.stop('stage_seconds', started_at, stage='grammar')
+
+Timings (and a few counts, see BUCKETS_BY_NAME) go into histograms with
+fixed buckets, and events into counters, both by name and labels. They are kept per process: with a pool of
+workers, each worker serves its own metrics (see setup()).
+
+The metrics are exposed in the Prometheus text format on a local HTTP
+endpoint (/metrics), and are periodically appended as a JSON line to a
+stats log.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Prefix of the exposed metric names
+PREFIX = 'health_nlp_'
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Buckets of the histograms that are not timings
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+BUCKETS_BY_NAME = dict(rules_evaluated=COUNT_BUCKETS)
+
+# Known metrics, with their help text
+HELP = dict(
+    stage_seconds='Time spent in each stage of the analysis of a job',
+    analysis_seconds='Time spent analyzing a job',
+    queue_wait_seconds='Time a job waited in the beanstalkd queue',
+    sink_seconds='Time spent uploading results, by sink',
+    jobs_total='Jobs taken from the queue, by result (analyzed, discarded, timeout or error)',
+    rules_evaluated='Rules searched in each message, by kind of grammar'
+)
+
+# Default values for setup()
+HOST = '127.0.0.1'
+PORT = 9108
+STATS_INTERVAL = 60
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values, with the sum and count.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last one is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=None):
+    items = list(key) + ([extra] if extra is not None else [])
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('"', '\\"') + '"'
+                          for name, value in items) + '}'
+
+
+class MetricsRegistry(object):
+    """
+    Histograms and counters, by name and labels.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+
+    def observe(self, name, value, labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, dict())
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(BUCKETS_BY_NAME.get(name, BUCKETS))
+            histogram.observe(value)
+
+    def increment(self, name, labels, value=1):
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict()
+            self.counters = dict()
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                metric = PREFIX + name
+                lines.append('# HELP ' + metric + ' ' + HELP.get(name, name))
+                lines.append('# TYPE ' + metric + ' counter')
+                for key, value in sorted(series.items()):
+                    lines.append(metric + format_labels(key) + ' ' + str(value))
+            for name, series in sorted(self.histograms.items()):
+                metric = PREFIX + name
+                lines.append('# HELP ' + metric + ' ' + HELP.get(name, name))
+                lines.append('# TYPE ' + metric + ' histogram')
+                for key, histogram in sorted(series.items()):
+                    bounds = [repr(bound) for bound in histogram.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append(metric + '_bucket' + format_labels(key, ('le', bound)) +
+                                     ' ' + str(count))
+                    lines.append(metric + '_sum' + format_labels(key) + ' ' +
+                                 repr(histogram.sum))
+                    lines.append(metric + '_count' + format_labels(key) + ' ' +
+                                 str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Returns the counters, and the count, sum and mean of every
+        histogram, as a JSON serializable dict.
+        """
+        with self.lock:
+            counters = dict((name + format_labels(key), value)
+                            for name, series in self.counters.items()
+                            for key, value in series.items())
+            histograms = dict((name + format_labels(key),
+                               dict(count=histogram.count,
+                                    sum=histogram.sum,
+                                    mean=histogram.sum / histogram.count
+                                    if histogram.count > 0 else 0.0))
+                              for name, series in self.histograms.items()
+                              for key, histogram in series.items())
+        return dict(counters=counters, histograms=histograms)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def enable():
+    REGISTRY.enabled = True
+
+
+def disable():
+    REGISTRY.enabled = False
+
+
+def enabled():
+    return REGISTRY.enabled
+
+
+def start():
+    """
+    Returns the current time of a monotonic clock, or None when the
+    metrics are disabled.
+    """
+    if REGISTRY.enabled:
+        return time.perf_counter()
+    return None
+
+
+def stop(name, started_at, **labels):
+    """
+    Record the time elapsed since start() in the histogram name.
+    """
+    if started_at is not None:
+        REGISTRY.observe(name, time.perf_counter() - started_at, labels)
+
+
+def observe(name, value, **labels):
+    """
+    Record a value (in seconds, for timings) in the histogram name.
+    """
+    if REGISTRY.enabled:
+        REGISTRY.observe(name, value, labels)
+
+
+def increment(name, **labels):
+    """
+    Add one to the counter name.
+    """
+    if REGISTRY.enabled:
+        REGISTRY.increment(name, labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a line in the worker output
+        pass
+
+
+def serve(host=HOST, port=PORT):
+    """
+    Serve the metrics on http://host:port/metrics from a background
+    thread, and return the server.
+    """
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class StatsLogger(object):
+    """
+    Background thread that appends a snapshot of the metrics to the
+    stats log every interval seconds, as a JSON line.
+    """
+
+    def __init__(self, path, interval=STATS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        line = dict(REGISTRY.snapshot(), pid=os.getpid(), time=time.time())
+        with open(self.path, 'a') as stats_file:
+            stats_file.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as error:
+                print('The stats log couldn\'t be written: ' + str(error))
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def setup(metrics_config, worker_index=0):
+    """
+    Enable the metrics if metrics_config['metrics_enabled'] is set (see
+    config_loader.METRICS_CONFIG), serve them on the configured port plus
+    worker_index, and start the stats log. It returns the (server,
+    stats logger) tuple, with None for the parts that are not enabled.
+    """
+    if metrics_config is None or not metrics_config.get('metrics_enabled'):
+        return (None, None)
+    enable()
+    server = None
+    stats_logger = None
+    port = metrics_config.get('metrics_port', PORT)
+    if port:
+        try:
+            server = serve(metrics_config.get('metrics_host', HOST), port + worker_index)
+        except OSError as error:
+            print('The metrics endpoint couldn\'t be started: ' + str(error))
+    if metrics_config.get('stats_log_path'):
+        stats_logger = StatsLogger(metrics_config['stats_log_path'],
+                                   metrics_config.get('stats_interval', STATS_INTERVAL))
+    return (server, stats_logger)
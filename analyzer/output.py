@@ -0,0 +1,215 @@
+"""
+Asynchronous output stage.
+
+The analyses are not uploaded by the runner itself: they are put into a
+bounded queue for each sink (firebase, elasticsearch), and a background
+thread per sink uploads them in batches, whenever the batch is full or
+the flush interval has passed. When a queue is full, submit() blocks the
+runner until there's room again (backpressure).
+
+Every submitted analysis carries a token (the beanstalkd job). Once all
+the sinks have flushed it, the token is returned by pop_completed() with
+the sinks that failed, so the runner only deletes a job when its results
+have been uploaded, and a retried job is only submitted to the sinks
+that failed.
+Meanwhile, stale_tokens() returns the ones that have been waiting for a
+while, so the runner can touch their jobs before their time to run is
+over.
+"""
+import queue
+import threading
+import time
+from analyzer import metrics
+
+# Default values for the output stage
+QUEUE_SIZE = 1000
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 1.0
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+
+class PendingOutput(object):
+    """
+    Keeps track of the sinks (by index) that still have to flush an
+    analysis, and of the ones that failed.
+    """
+
+    def __init__(self, token, sinks, completed):
+        self.token = token
+        self.pending = set(sinks)
+        self.failed = []
+        self.completed = completed
+        self.lock = threading.Lock()
+
+    def done(self, sink_index, succeeded):
+        with self.lock:
+            self.pending.discard(sink_index)
+            if not succeeded:
+                self.failed.append(sink_index)
+            finished = len(self.pending) == 0
+        if finished:
+            self.completed.put((self.token, sorted(self.failed)))
+
+
+class SinkFlusher(object):
+    """
+    Background thread that uploads the analyses queued for a single
+    uploader. If the uploader provides upload_analyses(), a whole batch is
+    sent at once, and the analyses it returns are considered as failed
+    (the uploader is in charge of retrying them). Otherwise,
+    upload_analysis() is called for each one.
+    """
+
+    def __init__(self, uploader, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_retries=MAX_RETRIES, index=0):
+        self.uploader = uploader
+        self.index = index
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, analysis_json, pending_output):
+        """
+        Queue an analysis. It blocks while the queue is full.
+        """
+        self.queue.put((analysis_json, pending_output))
+
+    def next_batch(self):
+        """
+        Wait for the first analysis, then collect more of them until the
+        batch is full or the flush interval has passed.
+        """
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def upload(self, analyses):
+        """
+        Returns the analyses that couldn't be uploaded.
+        """
+        if hasattr(self.uploader, 'upload_analyses'):
+            return self.uploader.upload_analyses(analyses) or []
+        for analysis_json in analyses:
+            self.uploader.upload_analysis(analysis_json)
+        return []
+
+    def flush(self, batch):
+        """
+        Upload a batch, retrying with exponential backoff on errors, and
+        report the result for each analysis.
+        """
+        analyses = [item[0] for item in batch]
+        failed = analyses
+        started_at = metrics.start()
+        for attempt in range(self.max_retries + 1):
+            try:
+                failed = self.upload(analyses)
+                break
+            except Exception as error:
+                print('Upload error (' + type(self.uploader).__name__ + '): ' + str(error))
+                if attempt < self.max_retries:
+                    time.sleep(RETRY_BACKOFF * (2 ** attempt))
+        metrics.stop('sink_seconds', started_at, sink=type(self.uploader).__name__)
+        failed_ids = set(id(analysis_json) for analysis_json in failed)
+        for item in batch:
+            item[1].done(self.index, id(item[0]) not in failed_ids)
+            self.queue.task_done()
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if len(batch) > 0:
+                self.flush(batch)
+            elif self.closed:
+                return
+
+    def close(self):
+        """
+        Flush everything that is still queued and stop the thread.
+        """
+        self.queue.join()
+        self.closed = True
+        self.thread.join()
+
+
+class OutputStage(object):
+    """
+    Fans out the analyses to a SinkFlusher per uploader.
+    """
+
+    def __init__(self, uploaders, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.sinks = [SinkFlusher(uploader, queue_size, batch_size, flush_interval,
+                                  index=index)
+                      for index, uploader in enumerate(uploaders)]
+        self.completed = queue.Queue()
+        # Tokens that haven't been flushed by all the sinks yet, with the
+        # last time they were returned by stale_tokens() (or submitted)
+        self.pending = dict()
+
+    def submit(self, analysis_json, token, sinks=None):
+        """
+        Queue an analysis for every sink, or only for the given sink
+        indexes. It blocks while any of the sink queues is full.
+        """
+        if sinks is None:
+            sinks = range(len(self.sinks))
+        sinks = sorted(set(sinks))
+        if len(sinks) == 0:
+            self.completed.put((token, []))
+            return
+        self.pending[id(token)] = [token, time.time()]
+        pending_output = PendingOutput(token, sinks, self.completed)
+        for sink_index in sinks:
+            self.sinks[sink_index].put(analysis_json, pending_output)
+
+    def pop_completed(self):
+        """
+        Returns a list of (token, failed sinks) tuples for the analyses
+        that have been flushed by all the sinks since the last call. The
+        failed sinks are a list of sink indexes, empty on success.
+        """
+        completed = []
+        while True:
+            try:
+                token, failed_sinks = self.completed.get_nowait()
+            except queue.Empty:
+                return completed
+            self.pending.pop(id(token), None)
+            completed.append((token, failed_sinks))
+
+    def stale_tokens(self, interval):
+        """
+        Returns the tokens still waiting to be flushed that haven't been
+        returned (or submitted) in the last interval seconds.
+        """
+        now = time.time()
+        stale = []
+        for pending in self.pending.values():
+            if now - pending[1] >= interval:
+                pending[1] = now
+                stale.append(pending[0])
+        return stale
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
@@ -5,22 +5,58 @@ results to firebase.
 """
 
 import analyzer.engine
+from analyzer import budget
+from analyzer import metrics
 
 
-def process_job(job_json, fb_uploader, es_uploader):
+def analyze_job(job_json, time_budget=None):
+    """
+    nlp_analysis() of the job. When it takes more than time_budget
+    seconds, it's aborted with budget.JobTimeout.
+    """
+    with budget.TimeBudget(time_budget):
+        return analyzer.engine.nlp_analysis(job_json)
+
+
+def process_job(job_json, fb_uploader, es_uploader, time_budget=None):
     """
     Given a JSON belonging to a job, process_job sends it to the
     analyzer and then it posts the output to firebase and
     elasticsearch.
     """
-    analysis_result = analyzer.engine.nlp_analysis(job_json)
+    analysis_result = analyze_job(job_json, time_budget)
     # When the user is not health related, the message is discarded.
     if analysis_result is None:
         print('d')
+        metrics.increment('jobs_total', result='discarded')
         return False
+    metrics.increment('jobs_total', result='analyzed')
     print('Send results to firebase: ' + job_json['message'])
     job_json['analysis'] = analysis_result
+    started_at = metrics.start()
     fb_uploader.upload_analysis(job_json)
+    metrics.stop('sink_seconds', started_at, sink=type(fb_uploader).__name__)
     print('Send results to elasticsearch')
+    started_at = metrics.start()
     es_uploader.upload_analysis(job_json)
+    metrics.stop('sink_seconds', started_at, sink=type(es_uploader).__name__)
+    return True
+
+
+def process_job_async(job_json, output_stage, token, time_budget=None, sinks=None):
+    """
+    Like process_job(), but the output is handed over to the output stage
+    (see analyzer.output), which uploads it in the background. token
+    identifies the job once its results have been uploaded. When sinks is
+    given, the output only goes to those sinks (by index).
+    """
+    analysis_result = analyze_job(job_json, time_budget)
+    # When the user is not health related, the message is discarded.
+    if analysis_result is None:
+        print('d')
+        metrics.increment('jobs_total', result='discarded')
+        return False
+    metrics.increment('jobs_total', result='analyzed')
+    job_json['analysis'] = analysis_result
+    output_stage.submit(job_json, token, sinks)
     return True
@@ -0,0 +1,264 @@
+"""
+Rule-level profiling of the grammar, counter grammar and magic bullet
+rules.
+
+Some hand written rules (e.g. 'risk\\w*( \\S+){0,3} for( \\S+){0,5} [p]')
+can backtrack badly on long messages. When profiling is enabled, every
+rule search made by text_analyzer and magic_bullet_analyzer is timed, and
+the cumulative time, number of searches, hits and worst case input of
+each rule are recorded, to be dumped as a ranked report. It's opt-in:
+when it's disabled, the analyzers only check whether it is.
+
+check_rules() runs a set of rules against built-in adversarial strings
+(see adversarial_strings()) and returns the slow ones. The text analyzer
+runs it on its rules when they are loaded with profiling enabled.
+
+Usage (profile the rules on a JSONL corpus of jobs):
+    python3 -m analyzer.rule_profiler corpus.jsonl [--limit 20] [--output report.json]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+# A rule search slower than this on an adversarial string is flagged
+SLOW_RULE_SECONDS = 0.01
+
+# Lengths (in characters) of the adversarial strings. They are searched
+# from the shortest to the longest, growing by ADVERSARIAL_GROWTH, and the
+# search stops as soon as it gets slow: an exponential rule would never
+# finish on the longest ones.
+ADVERSARIAL_MIN_LENGTH = 8
+ADVERSARIAL_LENGTH = 2000
+ADVERSARIAL_GROWTH = 1.25
+
+# Start word used to instantiate the grammar rules when they are checked
+CHECK_START_WORD = '(#\\w*cancer|cancer)'
+
+# Characters of the worst case inputs kept in the reports
+WORST_INPUT_LENGTH = 280
+
+
+class RuleStats(object):
+    """
+    Searches, hits, cumulative time and worst case input of a rule.
+    """
+
+    def __init__(self, kind, pattern):
+        self.kind = kind
+        self.pattern = pattern
+        self.searches = 0
+        self.hits = 0
+        self.seconds = 0.0
+        self.worst_seconds = 0.0
+        self.worst_input = None
+
+    def record(self, seconds, message, hit):
+        self.searches += 1
+        self.seconds += seconds
+        if hit:
+            self.hits += 1
+        if seconds > self.worst_seconds:
+            self.worst_seconds = seconds
+            self.worst_input = message
+
+    def to_dict(self):
+        return dict(kind=self.kind,
+                    pattern=self.pattern,
+                    searches=self.searches,
+                    hits=self.hits,
+                    seconds=self.seconds,
+                    mean_seconds=self.seconds / self.searches if self.searches else 0.0,
+                    worst_seconds=self.worst_seconds,
+                    worst_input=self.worst_input)
+
+
+class RuleProfiler(object):
+    """
+    The stats of every rule searched while profiling is enabled, by kind
+    ('grammar', 'counter_grammar' or 'magic_bullet') and pattern.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.rules = dict()
+
+    def search(self, kind, pattern, regex, message):
+        """
+        regex.search(message), timed and recorded for the rule.
+        """
+        started_at = time.perf_counter()
+        search_regex = regex.search(message)
+        seconds = time.perf_counter() - started_at
+        stats = self.rules.get((kind, pattern))
+        if stats is None:
+            stats = self.rules[(kind, pattern)] = RuleStats(kind, pattern)
+        stats.record(seconds, message, search_regex is not None)
+        return search_regex
+
+    def ranking(self, limit=None):
+        """
+        Returns the stats of the rules, the most expensive first.
+        """
+        ranking = sorted(self.rules.values(),
+                         key=lambda stats: (-stats.seconds, -stats.worst_seconds))
+        return ranking[:limit] if limit else ranking
+
+    def report(self, limit=20, file=None):
+        """
+        Print the ranking of the most expensive rules.
+        """
+        file = file if file is not None else sys.stdout
+        total = sum(stats.seconds for stats in self.rules.values())
+        print('%d rules, %.3f s searching' % (len(self.rules), total), file=file)
+        print('%4s %-15s %9s %6s %8s %9s %9s  %s' % (
+            'rank', 'kind', 'total ms', 'share', 'searches', 'mean us', 'worst ms', 'pattern'),
+              file=file)
+        for rank, stats in enumerate(self.ranking(limit), 1):
+            print('%4d %-15s %9.2f %5.1f%% %8d %9.1f %9.3f  %s' % (
+                rank, stats.kind, 1000 * stats.seconds,
+                100 * stats.seconds / total if total > 0 else 0.0, stats.searches,
+                1e6 * stats.seconds / max(stats.searches, 1), 1000 * stats.worst_seconds,
+                stats.pattern), file=file)
+            if stats.worst_input is not None:
+                print('%4s worst input: %r' % ('', stats.worst_input[:WORST_INPUT_LENGTH]),
+                      file=file)
+
+    def dump(self, path, limit=None):
+        """
+        Write the ranking as JSON.
+        """
+        with open(path, 'w') as report_file:
+            json.dump([stats.to_dict() for stats in self.ranking(limit)], report_file,
+                      indent=2)
+
+    def reset(self):
+        self.rules = dict()
+
+
+PROFILER = RuleProfiler()
+
+
+def enable():
+    PROFILER.enabled = True
+
+
+def disable():
+    PROFILER.enabled = False
+
+
+def active():
+    """
+    Returns the profiler when profiling is enabled, or None.
+    """
+    return PROFILER if PROFILER.enabled else None
+
+
+def adversarial_strings(pattern):
+    """
+    Strings that make badly written rules backtrack: long runs of words,
+    spaces or word characters where the rule's final token never shows
+    up, and the literal words of the rule repeated over and over.
+    """
+    words = re.findall(r'[A-Za-z]{2,}', re.sub(r'\\[A-Za-z]|\[\w+\]', ' ', pattern))
+    strings = [
+        ' '.join(['word'] * (ADVERSARIAL_LENGTH // 5)),
+        'a' * ADVERSARIAL_LENGTH,
+        ' ' * ADVERSARIAL_LENGTH,
+        ' '.join(['#hashtag'] * (ADVERSARIAL_LENGTH // 9)),
+        '. '.join(['Some sentence with a few words'] * (ADVERSARIAL_LENGTH // 32))]
+    if words:
+        literal = ' '.join(words) + ' '
+        strings.append((literal * (ADVERSARIAL_LENGTH // len(literal) + 1))[:ADVERSARIAL_LENGTH])
+        strings.append((' '.join(words[:1] + ['x'] * 10) + ' ') *
+                       (ADVERSARIAL_LENGTH // (len(words[0]) + 21) + 1))
+    return strings
+
+
+def check_rules(kind, rules, threshold=SLOW_RULE_SECONDS):
+    """
+    Search every (pattern, compiled regex) rule in its adversarial
+    strings, and return a list of (kind, pattern, seconds, input) tuples
+    for the rules whose slowest search took more than threshold.
+    """
+    lengths = []
+    length = ADVERSARIAL_MIN_LENGTH
+    while length < ADVERSARIAL_LENGTH:
+        lengths.append(int(length))
+        length *= ADVERSARIAL_GROWTH
+    lengths.append(ADVERSARIAL_LENGTH)
+    slow_rules = []
+    for pattern, regex in rules:
+        worst_seconds = 0.0
+        worst_input = None
+        for adversarial_string in adversarial_strings(pattern):
+            for length in lengths:
+                started_at = time.perf_counter()
+                regex.search(adversarial_string[:length])
+                seconds = time.perf_counter() - started_at
+                if seconds > worst_seconds:
+                    worst_seconds = seconds
+                    worst_input = adversarial_string[:length]
+                if seconds > threshold:
+                    break
+            if worst_seconds > threshold:
+                break
+        if worst_seconds > threshold:
+            slow_rules.append((kind, pattern, worst_seconds, worst_input))
+    return slow_rules
+
+
+def warn_slow_rules(slow_rules, file=None):
+    file = file if file is not None else sys.stdout
+    for kind, pattern, seconds, adversarial_string in slow_rules:
+        print('Slow %s rule (%.1f ms on %r...): %s' % (
+            kind, 1000 * seconds, adversarial_string[:40], pattern), file=file)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Profile the grammar rules on a JSONL corpus of jobs.')
+    parser.add_argument('corpus', help='JSONL corpus of jobs')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='Rules in the report (0 for all of them)')
+    parser.add_argument('--output', help='Write the whole ranking to this JSON file')
+    parser.add_argument('--language-data',
+                        help='Directory with the language data files (default: language_data/)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from analyzer import snapshot
+    from analyzer.engines import text_analyzer
+    args = parse_arguments(argv)
+    enable()
+    # The rules are checked while they are loaded, so the snapshot is
+    # not used
+    paths = snapshot.LANGUAGE_DATA_PATHS
+    if args.language_data:
+        paths = dict((name, os.path.join(args.language_data, os.path.basename(path)))
+                     for name, path in paths.items())
+    language_data = snapshot.build_resources(paths)['language_data']
+    messages = 0
+    with open(args.corpus, 'r', encoding='utf-8') as corpus_file:
+        for line in corpus_file:
+            if not line.strip():
+                continue
+            text_analyzer.analyzer(json.loads(line)['message'],
+                                   language_data['start_words'],
+                                   language_data['grammar'],
+                                   language_data['counter_grammar'],
+                                   language_data['stop_words'],
+                                   language_data['magic_bullet_grammar'])
+            messages += 1
+    print('Messages: %d' % messages)
+    PROFILER.report(args.limit or None)
+    if args.output:
+        PROFILER.dump(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,21 +7,201 @@ processor.
 
 The process will remain active until the user manually stops it.
 
+With more than one worker, a supervisor process forks a pool of workers,
+each one with its own connection to beanstalkd, and restarts them when
+they crash.
+
 """
 import json
+import multiprocessing
+import signal
+import time
+from collections import OrderedDict
 import pystalkd.Beanstalkd
 import sys
+import analyzer.engine
+from analyzer import cache
+from analyzer import metrics
+from analyzer.budget import JobTimeout
 from analyzer.processor import process_job
+from analyzer.processor import process_job_async
+from analyzer.output import OutputStage
 from analyzer.uploader import FirebaseAnalysisUploader
 from analyzer.uploader import ElasticsearchAnalysisUploader
+from analyzer.uploader import BULK_MAX_DOCS, BULK_MAX_BYTES
+
+
+# Seconds a worker waits for a job before checking if it has to stop
+RESERVE_TIMEOUT = 1
+
+# Seconds before a job whose results couldn't be uploaded is retried
+RELEASE_DELAY = 60
+
+# Releases of a job whose results couldn't be uploaded before it's buried
+MAX_RELEASES = 5
+
+# Released jobs whose sinks that failed are remembered (see retry_sinks())
+RETRY_SINKS_SIZE = 10000
+
+# Seconds between two touches of a job whose results are waiting to be
+# uploaded. It must be well under the time to run of the jobs (120 s by
+# default), or beanstalkd would hand them out again.
+TOUCH_INTERVAL = 30
+
+# Seconds between the supervisor's checks on its workers
+SUPERVISOR_INTERVAL = 1
+
+# Seconds the supervisor waits for its workers to finish on shutdown
+SHUTDOWN_TIMEOUT = 30
+
+# A worker that crashes again right after being restarted (e.g. while
+# beanstalkd is down) is restarted after RESTART_BACKOFF seconds, doubled
+# on every crash up to RESTART_MAX_BACKOFF. A worker that stays up for
+# RESTART_RESET_AFTER seconds is considered healthy again. After
+# MAX_RESTARTS crashes in a row of the same worker, the pool is stopped.
+RESTART_BACKOFF = 1
+RESTART_MAX_BACKOFF = 60
+RESTART_RESET_AFTER = 60
+MAX_RESTARTS = 10
+
+# Jobs between two stats reports of a worker
+STATS_INTERVAL = 1000
+
+# Tube the jobs are taken from, and tube for the jobs whose analysis ran
+# out of time (see move_to_timeout_tube())
+JOBS_TUBE = 'default'
+TIMEOUT_TUBE = 'timeout'
+
+
+def print_stats(jobs, timeouts=0):
+    """
+    Print the number of jobs processed, the hit rate of the caches and
+    the number of jobs that timed out.
+    """
+    caches = analyzer.engine.cache_stats()
+    print('Processed ' + str(jobs) + ' jobs. ' + ', '.join(
+        name + ' cache: %.1f%% hits (%d entries, %d evictions)' % (
+            100 * stats['hit_rate'], stats['entries'], stats['evictions'])
+        for name, stats in sorted(caches.items())) +
+          ('. ' + str(timeouts) + ' timeouts' if timeouts > 0 else ''), flush=True)
+
+
+def job_key(current_job):
+    # Released jobs keep their body
+    return cache.text_key(current_job.body)
+
+
+def acknowledge_jobs(completed_jobs, failed_sinks_by_job=None):
+    """
+    Delete the jobs whose results have been uploaded by the output stage.
+    The ones that couldn't be uploaded are released back into the queue,
+    and the sinks that failed are remembered in failed_sinks_by_job (see
+    retry_sinks()). After MAX_RELEASES, they are buried instead.
+    """
+    for current_job, failed_sinks in completed_jobs:
+        # If the job's time to run ran out anyway, beanstalkd doesn't
+        # know about it anymore, and that mustn't stop the worker
+        try:
+            if len(failed_sinks) == 0:
+                current_job.delete()
+            elif current_job.stats()['releases'] >= MAX_RELEASES:
+                print('The results of a job couldn\'t be uploaded after ' +
+                      str(MAX_RELEASES) + ' retries, burying it')
+                current_job.bury()
+            else:
+                if failed_sinks_by_job is not None:
+                    failed_sinks_by_job[job_key(current_job)] = failed_sinks
+                    while len(failed_sinks_by_job) > RETRY_SINKS_SIZE:
+                        failed_sinks_by_job.popitem(last=False)
+                current_job.release(delay=RELEASE_DELAY)
+        except Exception as error:
+            print('The job couldn\'t be acknowledged: ' + str(error))
+
+
+def retry_sinks(current_job, failed_sinks_by_job):
+    """
+    Returns the sinks (by index) a job has to be uploaded to: the ones
+    that failed, when it was released by this worker, or None (all of
+    them).
+    """
+    if len(failed_sinks_by_job) == 0:
+        return None
+    return failed_sinks_by_job.pop(job_key(current_job), None)
+
+
+def touch_jobs(pending_jobs):
+    """
+    Reset the time to run of the jobs whose results are still waiting to
+    be uploaded by the output stage.
+    """
+    for current_job in pending_jobs:
+        try:
+            current_job.touch()
+        except Exception as error:
+            print('The job couldn\'t be touched: ' + str(error))
+
+
+def observe_queue_wait(current_job):
+    """
+    Record how long the job waited in the queue (beanstalkd gives its age
+    in whole seconds). It costs a round trip, so it's only asked for when
+    the metrics are enabled.
+    """
+    if not metrics.enabled():
+        return
+    try:
+        metrics.observe('queue_wait_seconds', float(current_job.stats()['age']))
+    except Exception as error:
+        print('Couldn\'t get the job stats: ' + str(error))
 
 
-def setup_and_run(beanstalkd_config, firebase_config, es_config, loop_forever):
+def move_to_timeout_tube(beanstalk, current_job, job_json, time_budget,
+                         timeout_tube=TIMEOUT_TUBE):
+    """
+    Put a job whose analysis ran out of time, tagged '<timeout>', into
+    the timeout tube for offline inspection, and delete it from the jobs
+    queue. If it can't be put there, the job is buried instead.
+    """
+    print('Analysis timed out after ' + str(time_budget) + ' seconds: ' +
+          str(job_json.get('message')))
+    metrics.increment('jobs_total', result='timeout')
+    job_json['analysis'] = analyzer.engine.timeout_analysis(time_budget)
+    try:
+        beanstalk.use(timeout_tube)
+        try:
+            beanstalk.put(json.dumps(job_json))
+        finally:
+            beanstalk.use(JOBS_TUBE)
+    except Exception as error:
+        print('The job couldn\'t be moved to the ' + timeout_tube + ' tube: ' + str(error))
+        current_job.bury()
+        return
+    current_job.delete()
+
+
+def setup_and_run(beanstalkd_config, firebase_config, es_config, loop_forever,
+                  should_stop=None, output_config=None, metrics_config=None,
+                  worker_index=0):
     """
     Setup the beanstalkd connection and the firebase uploader.
     Then start listening to the jobs queue and send the jobs
     to the analyzer.
+    When should_stop is given, it is called between jobs, and the loop
+    ends as soon as it returns True.
+    When output_config['async_output'] is set, the results are uploaded in
+    the background by an output stage (see analyzer.output), and each job
+    is deleted once its results have been uploaded.
+    The analysis of each job is aborted after output_config['time_budget']
+    seconds, and the job is moved to output_config['timeout_tube'].
+    When metrics_config['metrics_enabled'] is set, the timings of the
+    analysis are served on the metrics port plus worker_index, and
+    written to the stats log (see analyzer.metrics).
     """
+    metrics_server, stats_logger = metrics.setup(metrics_config, worker_index)
+    runner_config = output_config if output_config is not None else dict()
+    time_budget = runner_config.get('time_budget')
+    timeout_tube = runner_config.get('timeout_tube', TIMEOUT_TUBE)
+
     # Setup connection to the jobs queue
     beanstalk = pystalkd.Beanstalkd.Connection(
         host=beanstalkd_config['beanstalk_ip'], port=beanstalkd_config['beanstalk_port'])
@@ -40,19 +220,236 @@ def setup_and_run(beanstalkd_config, firebase_config, es_config, loop_forever):
     # Setup the elasticsearch uploader
     es_uploader = ElasticsearchAnalysisUploader(es_config['url'],
                                                 es_config['user'],
-                                                es_config['password'])
+                                                es_config['password'],
+                                                es_config.get('bulk_max_docs', BULK_MAX_DOCS),
+                                                es_config.get('bulk_max_bytes', BULK_MAX_BYTES))
+
+    # Setup the output stage
+    output_stage = None
+    if output_config is not None and output_config.get('async_output'):
+        output_stage = OutputStage([fb_uploader, es_uploader],
+                                   output_config['output_queue_size'],
+                                   output_config['output_batch_size'],
+                                   output_config['output_flush_interval'])
 
     # Start waiting for jobs from the queue.
+    jobs = 0
+    timeouts = 0
+    failed_sinks_by_job = OrderedDict()
     while True:
-        # reserve blocks the execution until there's a new job
-        current_job = beanstalk.reserve()
+        if output_stage is not None:
+            acknowledge_jobs(output_stage.pop_completed(), failed_sinks_by_job)
+            touch_jobs(output_stage.stale_tokens(TOUCH_INTERVAL))
+        if should_stop is not None and should_stop():
+            break
+        if should_stop is not None or output_stage is not None:
+            # Wake up regularly to check if the worker has to stop,
+            # and to delete the jobs whose results have been uploaded
+            try:
+                current_job = beanstalk.reserve(RESERVE_TIMEOUT)
+            except pystalkd.Beanstalkd.DeadlineSoon:
+                # A job waiting for its results to be uploaded is about to
+                # run out of time
+                if output_stage is not None:
+                    touch_jobs(output_stage.stale_tokens(0))
+                continue
+            if current_job is None:
+                continue
+        else:
+            # reserve blocks the execution until there's a new job
+            current_job = beanstalk.reserve()
 
-        try:
-            process_job(json.loads(current_job.body), fb_uploader, es_uploader)
-        except:
-            print("Unexpected error:", sys.exc_info()[0])
+        observe_queue_wait(current_job)
+        # Jobs that time out are moved to the timeout tube
+        timed_out = False
+        if output_stage is None:
+            try:
+                job_json = json.loads(current_job.body)
+                process_job(job_json, fb_uploader, es_uploader, time_budget)
+            except JobTimeout:
+                move_to_timeout_tube(beanstalk, current_job, job_json, time_budget,
+                                     timeout_tube)
+                timed_out = True
+            except:
+                print("Unexpected error:", sys.exc_info()[0])
+                metrics.increment('jobs_total', result='error')
+
+            if not timed_out:
+                current_job.delete()
+        else:
+            queued = False
+            try:
+                job_json = json.loads(current_job.body)
+                queued = process_job_async(job_json, output_stage, current_job, time_budget,
+                                           retry_sinks(current_job, failed_sinks_by_job))
+            except JobTimeout:
+                move_to_timeout_tube(beanstalk, current_job, job_json, time_budget,
+                                     timeout_tube)
+                timed_out = True
+            except:
+                print("Unexpected error:", sys.exc_info()[0])
+                metrics.increment('jobs_total', result='error')
 
-        current_job.delete()
+            # Discarded jobs have nothing to upload
+            if not queued and not timed_out:
+                current_job.delete()
+
+        jobs += 1
+        if timed_out:
+            timeouts += 1
+        if jobs % STATS_INTERVAL == 0:
+            print_stats(jobs, timeouts)
 
         if not loop_forever:
-            return
+            break
+
+    if output_stage is not None:
+        output_stage.close()
+        acknowledge_jobs(output_stage.pop_completed(), failed_sinks_by_job)
+    if stats_logger is not None:
+        stats_logger.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+
+
+def run_worker(beanstalkd_config, firebase_config, es_config, output_config=None,
+               metrics_config=None, worker_index=0):
+    """
+    Entry point of a pool worker. The language data and the spaCy model
+    have already been loaded by the supervisor before forking, so they
+    are shared with it. The worker finishes its current job and exits
+    on SIGTERM. worker_index is its slot in the pool.
+    """
+    stop = dict(requested=False)
+
+    def request_stop(signum, frame):
+        stop['requested'] = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_and_run(beanstalkd_config, firebase_config, es_config, True,
+                  should_stop=lambda: stop['requested'], output_config=output_config,
+                  metrics_config=metrics_config, worker_index=worker_index)
+
+
+class WorkerPool(object):
+    """
+    Supervisor of a pool of forked worker processes. Crashed workers are
+    restarted (with an exponential backoff when they keep crashing), and
+    all of them are stopped cleanly on SIGTERM or SIGINT. If a worker
+    crashes more than max_restarts times in a row, the whole pool is
+    stopped and failed is set.
+    With pass_index, the slot of the worker in the pool is appended to
+    the arguments of target (a restarted worker keeps the slot).
+    """
+
+    def __init__(self, workers, target, args, pass_index=False, max_restarts=MAX_RESTARTS):
+        self.workers = workers
+        self.target = target
+        self.args = args
+        self.pass_index = pass_index
+        self.max_restarts = max_restarts
+        self.processes = []
+        self.started_at = [0] * workers
+        # Crashes in a row of each slot, and when its worker is restarted
+        self.crashes = [0] * workers
+        self.restart_at = [None] * workers
+        self.restarts = 0
+        self.stopping = False
+        self.failed = False
+
+    def start_worker(self, index):
+        args = self.args + (index,) if self.pass_index else self.args
+        process = multiprocessing.Process(target=self.target, args=args)
+        process.daemon = False
+        process.start()
+        self.started_at[index] = time.time()
+        return process
+
+    def start(self):
+        self.processes = [self.start_worker(index) for index in range(self.workers)]
+
+    def check(self):
+        """
+        Restart every worker that is no longer running, once its backoff
+        delay has passed.
+        """
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or self.stopping:
+                continue
+            if self.restart_at[index] is None:
+                if now - self.started_at[index] >= RESTART_RESET_AFTER:
+                    self.crashes[index] = 0
+                self.crashes[index] += 1
+                if self.crashes[index] > self.max_restarts:
+                    print('Worker ' + str(process.pid) + ' exited with code ' +
+                          str(process.exitcode) + ' after ' + str(self.max_restarts) +
+                          ' restarts in a row, stopping the pool')
+                    self.stopping = True
+                    self.failed = True
+                    return
+                # The first crash is restarted right away
+                delay = 0
+                if self.crashes[index] > 1:
+                    delay = min(RESTART_BACKOFF * 2 ** (self.crashes[index] - 2),
+                                RESTART_MAX_BACKOFF)
+                print('Worker ' + str(process.pid) + ' exited with code ' +
+                      str(process.exitcode) + ', restarting it' +
+                      (' in ' + str(delay) + ' seconds' if delay > 0 else ''))
+                self.restart_at[index] = now + delay
+            if now >= self.restart_at[index]:
+                self.processes[index] = self.start_worker(index)
+                self.restart_at[index] = None
+                self.restarts += 1
+
+    def stop(self):
+        """
+        Ask the workers to finish their current job and wait for them.
+        The ones that don't finish in time are killed.
+        """
+        self.stopping = True
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for process in self.processes:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                print('Worker ' + str(process.pid) + ' did not stop, killing it')
+                process.kill()
+                process.join()
+
+    def run(self):
+        """
+        Start the workers and supervise them until a SIGTERM or SIGINT
+        is received.
+        """
+        def request_stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        self.start()
+        print('Started ' + str(self.workers) + ' workers')
+        while not self.stopping:
+            time.sleep(SUPERVISOR_INTERVAL)
+            self.check()
+        print('Stopping workers')
+        self.stop()
+
+
+def setup_and_run_pool(beanstalkd_config, firebase_config, es_config, workers,
+                       output_config=None, metrics_config=None):
+    """
+    Start a pool of workers, each one listening to the jobs queue on its
+    own connection, and supervise them until the process is stopped.
+    """
+    pool = WorkerPool(workers, run_worker,
+                      (beanstalkd_config, firebase_config, es_config, output_config,
+                       metrics_config),
+                      pass_index=True)
+    pool.run()
+    if pool.failed:
+        sys.exit(1)
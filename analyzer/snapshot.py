@@ -0,0 +1,135 @@
+"""
+Compiled snapshot of the language resources.
+
+Parsing the files in language_data/ (expanding the user dictionary,
+building the lexicon, the start words index and the grammars) is done
+once by build_resources(), and its result is pickled into a single
+snapshot file. Workers load the snapshot instead of parsing the files
+again.
+
+The snapshot records a fingerprint of the language data files and of
+the engine modules that build the resources. load_resources() rebuilds
+it automatically whenever any of them changes.
+
+Usage (build the snapshot ahead of time, e.g. in the Docker image):
+    python3 -m analyzer.snapshot
+"""
+import os
+import pickle
+import time
+from analyzer import cache
+from analyzer.engines import magic_bullet_analyzer
+from analyzer.engines import text_analyzer
+from analyzer.engines import user_analyzer
+
+# Bump it when the format of the snapshot changes
+SNAPSHOT_VERSION = 2
+
+SNAPSHOT_PATH = './language_data/language_data.snapshot'
+
+LANGUAGE_DATA_PATHS = dict(
+    user_dictionary='./language_data/user_dictionary.txt',
+    user_grammar='./language_data/user_grammar.txt',
+    string_twitter_queries='./language_data/string_twitter_queries.txt',
+    grammar='./language_data/grammar.txt',
+    counter_grammar='./language_data/counter_grammar.txt',
+    start_words='./language_data/start_words.txt',
+    stop_words='./language_data/stop_words.txt'
+)
+
+# The resources are objects of these modules, so they are part of the
+# fingerprint too
+ENGINE_MODULES = [magic_bullet_analyzer, text_analyzer, user_analyzer]
+
+
+def build_resources(paths):
+    """
+    Parse the language data files into the objects used by the engine:
+    the user dictionary, the lexicon, the Twitter queries and the text
+    analyzer's language data.
+    """
+    dictionary = user_analyzer.dictionary_parser(paths['user_dictionary'])
+    return dict(
+        dictionary=dictionary,
+        lexicon=user_analyzer.LexiconMatcher(user_analyzer.lexicon_generator(
+            paths['user_grammar'], dictionary)),
+        string_twitter_queries=user_analyzer.string_twitter_queriesParser(
+            paths['string_twitter_queries']),
+        language_data=text_analyzer.language_data_loader(
+            paths['grammar'],
+            paths['counter_grammar'],
+            paths['start_words'],
+            paths['stop_words']))
+
+
+def snapshot_fingerprint(paths):
+    """
+    Returns a hash of the language data files, the engine modules and
+    the snapshot format.
+    """
+    sources = sorted(paths.values()) + [module.__file__ for module in ENGINE_MODULES]
+    return str(SNAPSHOT_VERSION) + '-' + cache.files_fingerprint(sources)
+
+
+def read_snapshot(snapshot_path, fingerprint):
+    """
+    Returns the resources stored in the snapshot, or None when it doesn't
+    exist or it was built from other sources.
+    """
+    try:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            # The header is a separate pickle, so a stale snapshot is
+            # discarded without loading its resources
+            header = pickle.load(snapshot_file)
+            if header.get('fingerprint') != fingerprint:
+                return None
+            return pickle.load(snapshot_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def write_snapshot(snapshot_path, fingerprint, resources):
+    """
+    Write the snapshot atomically, so that concurrent workers never read
+    a partial file.
+    """
+    temporary_path = snapshot_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        pickle.dump(dict(fingerprint=fingerprint, created_at=time.time()),
+                    snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(resources, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, snapshot_path)
+
+
+def load_resources(paths=None, snapshot_path=SNAPSHOT_PATH):
+    """
+    Returns the resources built by build_resources(), from the snapshot
+    when it is up to date. Otherwise, they are built from the language
+    data files and the snapshot is (re)written. With no snapshot_path,
+    the snapshot is not used at all.
+    """
+    if paths is None:
+        paths = LANGUAGE_DATA_PATHS
+    if snapshot_path is None:
+        return build_resources(paths)
+    fingerprint = snapshot_fingerprint(paths)
+    resources = read_snapshot(snapshot_path, fingerprint)
+    if resources is None:
+        resources = build_resources(paths)
+        try:
+            write_snapshot(snapshot_path, fingerprint, resources)
+        except OSError as error:
+            # E.g. a read only file system: the resources are still usable
+            print('The language data snapshot couldn\'t be written: ' + str(error))
+    return resources
+
+
+if __name__ == "__main__":
+    STARTED_AT = time.time()
+    write_snapshot(SNAPSHOT_PATH, snapshot_fingerprint(LANGUAGE_DATA_PATHS),
+                   build_resources(LANGUAGE_DATA_PATHS))
+    print('Snapshot written to ' + SNAPSHOT_PATH + ' in %.2f seconds' %
+          (time.time() - STARTED_AT))
+    STARTED_AT = time.time()
+    load_resources()
+    print('Snapshot loaded in %.3f seconds' % (time.time() - STARTED_AT))
@@ -1,8 +1,53 @@
 """
 Upload an analysis to firebase
 """
+import json
+import threading
+import time
 import pyrebase
 import requests
+from analyzer.cache import text_key
+
+# Firebase idTokens are valid for an hour. They are refreshed in the
+# background when they are about to expire (seconds).
+TOKEN_LIFETIME = 3600
+TOKEN_REFRESH_MARGIN = 300
+
+# Default limits for each elasticsearch _bulk request
+BULK_MAX_DOCS = 500
+BULK_MAX_BYTES = 5 * 1024 * 1024
+BULK_MAX_RETRIES = 3
+BULK_RETRY_BACKOFF = 0.5
+
+# Connect and read timeouts (seconds) of every HTTP request, so a flush
+# of the output stage can't hang for longer than the time to run of the
+# jobs waiting for it
+UPLOAD_TIMEOUT = (5, 15)
+
+
+def set_default_timeout(session, timeout=UPLOAD_TIMEOUT):
+    """
+    Make every request of a requests session time out after timeout,
+    unless the request gives its own.
+    """
+    request = session.request
+
+    def request_with_timeout(method, url, **kwargs):
+        kwargs.setdefault('timeout', timeout)
+        return request(method, url, **kwargs)
+
+    session.request = request_with_timeout
+    return session
+
+
+def analysis_key(analysis_json):
+    """
+    Returns a key derived from the job an analysis comes from (all its
+    fields but the analysis itself), so the upload of a retried job
+    overwrites the previous one instead of adding a copy.
+    """
+    job = dict((name, value) for name, value in analysis_json.items() if name != 'analysis')
+    return text_key(json.dumps(job, sort_keys=True))
 
 
 def irrelevant_analysis(analysis_json):
@@ -25,13 +70,56 @@ class FirebaseAnalysisUploader(object):
                                "storageBucket": storage_bucket}
         # Try to set up the connection to firebase
         self.firebase = pyrebase.initialize_app(self.firebaseConfig)
+        # pyrebase doesn't set any timeout on its session
+        if hasattr(self.firebase, 'requests'):
+            set_default_timeout(self.firebase.requests)
         # Get a reference to the auth service
         self.auth = self.firebase.auth()
         print('Logging in into firebase')
         # Log the user in
         self.user = self.auth.sign_in_with_email_and_password(email, password)
+        self.token_lock = threading.Lock()
+        self.refreshing = False
+        self.id_token = None
+        self.expires_at = 0
+        if 'idToken' in self.user:
+            self.set_token(self.user)
         print('Firebase connection ready')
 
+    def set_token(self, fb_user):
+        """
+        Cache the idToken of a sign in or refresh response, until shortly
+        before it expires.
+        """
+        lifetime = int(fb_user.get('expiresIn', TOKEN_LIFETIME))
+        with self.token_lock:
+            self.id_token = fb_user['idToken']
+            if 'refreshToken' in fb_user:
+                self.user['refreshToken'] = fb_user['refreshToken']
+            self.expires_at = time.time() + lifetime
+
+    def refresh_token(self):
+        try:
+            self.set_token(self.auth.refresh(self.user['refreshToken']))
+        finally:
+            self.refreshing = False
+
+    def get_token(self):
+        """
+        Returns the cached idToken. It is refreshed in the background when
+        it is about to expire, or right away if it has already expired.
+        """
+        now = time.time()
+        if self.id_token is None or now >= self.expires_at:
+            self.refreshing = True
+            self.refresh_token()
+        elif now >= self.expires_at - TOKEN_REFRESH_MARGIN and not self.refreshing:
+            self.refreshing = True
+            refresh_thread = threading.Thread(target=self.refresh_token)
+            refresh_thread.daemon = True
+            refresh_thread.start()
+        return self.id_token
+
     def upload_analysis(self, analysis_json):
         """
         Upload the results of an analysis to firebase.
@@ -41,38 +129,157 @@ class FirebaseAnalysisUploader(object):
         if irrelevant_analysis(analysis_json):
             return False
 
-        # Refresh Token
-        fb_user = self.auth.refresh(self.user['refreshToken'])
-
         # Get a reference to the analysis database
         analysis_db = self.firebase.database().child('analysis')
         # Pass the user's idToken to the push method
-        analysis_db.push(analysis_json, fb_user['idToken'])
+        analysis_db.push(analysis_json, self.get_token())
         return True
 
+    def upload_analyses(self, analyses):
+        """
+        Upload the results of several analyses to firebase with a single
+        multi-location update. The keys are derived from the jobs (see
+        analysis_key()), so a retried job overwrites its previous upload.
+        It returns the analyses that couldn't be uploaded (none, since
+        the update is atomic and errors are raised).
+        """
+        database = self.firebase.database()
+        data = dict()
+        for analysis_json in analyses:
+            if not irrelevant_analysis(analysis_json):
+                data['analysis/' + analysis_key(analysis_json)] = analysis_json
+        if len(data) > 0:
+            database.update(data, self.get_token())
+        return []
+
 
 class ElasticsearchAnalysisUploader(object):
     """
-    Class for wrapping up the uploading function to firebase.
+    Class for wrapping up the uploading function to elasticsearch.
+    It keeps a pooled HTTP session, and several analyses can be uploaded
+    at once through the _bulk API with upload_analyses().
     """
 
-    def __init__(self, url, user, password):
+    def __init__(self, url, user, password, bulk_max_docs=BULK_MAX_DOCS,
+                 bulk_max_bytes=BULK_MAX_BYTES, max_retries=BULK_MAX_RETRIES):
         self.url = url + '/analysis/health'
+        self.bulk_url = url + '/_bulk'
         self.user = user
         self.password = password
+        self.bulk_max_docs = bulk_max_docs
+        self.bulk_max_bytes = bulk_max_bytes
+        self.max_retries = max_retries
+        self.session = set_default_timeout(requests.Session())
+        self.session.auth = (user, password)
 
     def upload_analysis(self, analysis_json):
         """
-        Upload the results of an analysis to firebase.
+        Upload the results of an analysis to elasticsearch.
         """
 
         # If the analysis is not relevant, it won't be uploaded
         if irrelevant_analysis(analysis_json):
             return False
 
-        post = requests.post(self.url, json=analysis_json,
-                             auth=(self.user, self.password))
+        post = self.session.post(self.url, json=analysis_json)
 
         print(post)
 
         return True
+
+    def bulk_chunks(self, analyses):
+        """
+        Split the analyses into chunks of NDJSON lines (an action line and
+        a document line for each one), within the docs and bytes limits.
+        Each chunk is a list of (analysis, lines) tuples. The document ids
+        are derived from the jobs (see analysis_key()), so a retried job
+        replaces its previous document.
+        """
+        chunks = []
+        chunk = []
+        chunk_bytes = 0
+        for analysis_json in analyses:
+            action = json.dumps({'index': {'_index': 'analysis', '_type': 'health',
+                                           '_id': analysis_key(analysis_json)}})
+            lines = action + '\n' + json.dumps(analysis_json) + '\n'
+            lines_bytes = len(lines.encode('utf-8'))
+            if len(chunk) > 0 and (len(chunk) >= self.bulk_max_docs or
+                                   chunk_bytes + lines_bytes > self.bulk_max_bytes):
+                chunks.append(chunk)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append((analysis_json, lines))
+            chunk_bytes += lines_bytes
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
+    def send_bulk(self, chunk):
+        """
+        Send a chunk with a single _bulk request. It returns a (retry,
+        rejected) tuple with the chunk items that couldn't be indexed:
+        the ones worth retrying (too many requests or server errors) and
+        the ones that will never be indexed (e.g. mapping errors).
+        """
+        body = ''.join(item[1] for item in chunk).encode('utf-8')
+        response = self.session.post(self.bulk_url, data=body,
+                                     headers={'Content-Type': 'application/x-ndjson'})
+        response.raise_for_status()
+        result = response.json()
+        if not result.get('errors'):
+            return ([], [])
+        retry = []
+        rejected = []
+        for item, response_item in zip(chunk, result['items']):
+            status = list(response_item.values())[0]
+            status_code = status.get('status', 200)
+            if 'error' not in status and status_code < 300:
+                continue
+            if status_code == 429 or status_code >= 500:
+                print('Bulk item error: ' + json.dumps(status.get('error')))
+                retry.append(item)
+            else:
+                print('Bulk item rejected (' + str(status_code) + '): ' +
+                      json.dumps(status.get('error')))
+                rejected.append(item)
+        return (retry, rejected)
+
+    def upload_chunk(self, chunk):
+        """
+        Upload a chunk, retrying only its failed items that are worth
+        retrying, with exponential backoff. It returns a (failed, rejected)
+        tuple with the analyses that couldn't be indexed: the ones that
+        could still be retried later, and the ones that never will be.
+        """
+        rejected = []
+        for attempt in range(self.max_retries + 1):
+            try:
+                chunk, chunk_rejected = self.send_bulk(chunk)
+            except (requests.RequestException, ValueError) as error:
+                # The whole request failed, so every item is retried
+                print('Bulk request error: ' + str(error))
+            else:
+                rejected.extend(chunk_rejected)
+                if len(chunk) == 0:
+                    break
+            if attempt < self.max_retries:
+                time.sleep(BULK_RETRY_BACKOFF * (2 ** attempt))
+        return ([item[0] for item in chunk], [item[0] for item in rejected])
+
+    def upload_analyses(self, analyses, rejected=None):
+        """
+        Upload the results of several analyses to elasticsearch with
+        _bulk requests. The irrelevant ones are skipped. It returns the
+        analyses that couldn't be uploaded but are worth retrying. The
+        ones elasticsearch rejected for good (e.g. mapping errors) are
+        dropped, or appended to rejected if it's given.
+        """
+        relevant = [analysis_json for analysis_json in analyses
+                    if not irrelevant_analysis(analysis_json)]
+        failed = []
+        for chunk in self.bulk_chunks(relevant):
+            chunk_failed, chunk_rejected = self.upload_chunk(chunk)
+            failed.extend(chunk_failed)
+            if rejected is not None:
+                rejected.extend(chunk_rejected)
+        return failed
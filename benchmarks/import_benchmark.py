@@ -0,0 +1,49 @@
+"""
+Startup benchmark: time to import a module (analyzer.runner by default)
+in a fresh interpreter, and time to warm up the engine afterwards, with
+the peak RSS of the process.
+
+Usage:
+    export PYTHONPATH=.; python3 benchmarks/import_benchmark.py [module] [runs]
+"""
+import statistics
+import subprocess
+import sys
+
+MEASURE = '''
+import resource
+import time
+started_at = time.perf_counter()
+import {module}
+imported_at = time.perf_counter()
+import analyzer.engine
+analyzer.engine.warm_up()
+warmed_up_at = time.perf_counter()
+print(imported_at - started_at, warmed_up_at - imported_at,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def measure(module):
+    """
+    Returns (import seconds, warm up seconds, peak RSS in KB) for a fresh
+    interpreter.
+    """
+    output = subprocess.check_output([sys.executable, '-c', MEASURE.format(module=module)])
+    values = output.decode('utf-8').split()
+    return float(values[0]), float(values[1]), int(values[2])
+
+
+def main(module, runs):
+    results = [measure(module) for _ in range(runs)]
+    print('Import of %s: %.1f ms (median of %d runs)' %
+          (module, statistics.median(result[0] for result in results) * 1000, runs))
+    print('Engine warm up: %.1f ms' %
+          (statistics.median(result[1] for result in results) * 1000))
+    print('Peak RSS: %.1f MB' % (max(result[2] for result in results) / 1024))
+
+
+if __name__ == "__main__":
+    MODULE = sys.argv[1] if len(sys.argv) > 1 else 'analyzer.runner'
+    RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    main(MODULE, RUNS)
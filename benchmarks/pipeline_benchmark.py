@@ -0,0 +1,421 @@
+"""
+Benchmark of the analysis pipeline: per call latency percentiles and
+messages/sec of engine.nlp_analysis(), text_analyzer.analyzer(),
+magic_bullet_analyzer.magic_bullet_analyzer() and
+user_analyzer.user_analyzer(), with the peak RSS of the process.
+
+The language data is generated (thousands of start words and grammar
+rules, see generate_language_data()) unless --language-data points to a
+directory with the language data files. The corpora are synthetic
+tweets of several sizes, plus samples of a JSONL corpus of jobs with
+--corpus. Everything is generated from --seed, so two runs with the
+same arguments analyze the same messages. The caches of the engine are
+disabled, so every message is actually analyzed.
+
+The results are written as JSON with --output. With --baseline, they are
+compared against a stored result file, and the exit status is 1 when
+any latency, throughput or peak RSS got worse than --tolerance.
+
+Usage:
+    export PYTHONPATH=.; python3 benchmarks/pipeline_benchmark.py \
+        [--sizes 100,1000] [--corpus corpus.jsonl] [--output results.json] \
+        [--baseline baseline.json] [--tolerance 0.2]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import analyzer.engine
+from analyzer import snapshot
+from analyzer.engines import magic_bullet_analyzer
+from analyzer.engines import text_analyzer
+from analyzer.engines import user_analyzer
+
+# Bump it when the format of the results changes
+RESULTS_VERSION = 1
+
+PERCENTILES = [50, 90, 95, 99]
+
+# Messages analyzed before measuring, so that everything is loaded
+WARM_UP_MESSAGES = 50
+
+SOLUTIONS = ['aspirin', 'metformin', 'insulin', 'surgery', 'yoga', 'a new drug',
+             'the vaccine', 'gene therapy', 'a low carb diet', 'exercise',
+             'this app', 'acupuncture', 'chemotherapy', 'a new device']
+FILLER_WORDS = ['the', 'new', 'study', 'shows', 'people', 'today', 'my', 'doctor',
+                'said', 'that', 'really', 'works', 'we', 'need', 'more', 'research',
+                'about', 'via', 'great', 'news', 'read', 'this', 'amazing', 'life',
+                'why', 'is', 'not', 'so', 'easy', 'lol', 'time', 'to', 'talk']
+JOBS = ['nurse', 'doctor', 'physician', 'oncologist', 'cardiologist', 'researcher',
+        'pharmacist', 'surgeon', 'dermatologist', 'epidemiologist']
+PLACES = ['hospital', 'clinic', 'university', 'medical center', 'institute']
+TAGS = ['Doctor', 'Academia', 'Professional', 'Institution', 'Publishing source']
+GRAMMAR_TEMPLATES = [
+    '[s] {verb} ( \\S+){{0,{n}}} [p]',
+    '[s] {verb} for( \\S+){{0,{n}}} [p]',
+    '[s] (may|could|can) {verb}( \\S+){{1,{n}}} [p]',
+    '[p]( \\S+){{0,{n}}} {verb} with [s]',
+    '[p] (is|was) {verb} by( \\S+){{0,{n}}} [s]']
+VERBS = ['treat\\w*', 'cure\\w*', 'prevent\\w*', 'help\\w*', 'fight\\w*', 'reduce\\w*',
+         'manage\\w*', 'beat\\w*', 'improve\\w*', 'protect\\w*', 'reverse\\w*']
+MAGIC_BULLET_NOUNS = ['treatment', 'therapy', 'cure', 'drug', 'vaccine', 'medication',
+                      'remedy', 'procedure']
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(length))
+
+
+def generate_diseases(rng, count):
+    """
+    Disease terms of 1 to 3 words, e.g. 'chronic renosis', from a
+    vocabulary of count / 3 words.
+    """
+    suffixes = ['itis', 'osis', 'emia', 'oma', 'pathy', 'algia']
+    vocabulary = [random_word(rng, rng.randint(3, 8)) + rng.choice(suffixes)
+                  for _ in range(max(count // 3, 10))]
+    modifiers = ['acute', 'chronic', 'severe', 'juvenile', 'type 2', 'primary']
+    diseases = set()
+    while len(diseases) < count:
+        words = [rng.choice(vocabulary)]
+        if rng.random() < 0.4:
+            words.insert(0, rng.choice(modifiers))
+        if rng.random() < 0.2:
+            words.append(rng.choice(vocabulary))
+        diseases.add(' '.join(words))
+    return sorted(diseases)
+
+
+def generate_grammar(rng, count):
+    """
+    Problem-solution rules from GRAMMAR_TEMPLATES, plus a magic bullet
+    rule of each type for every noun in MAGIC_BULLET_NOUNS.
+    """
+    rules = set()
+    while len(rules) < count:
+        template = rng.choice(GRAMMAR_TEMPLATES)
+        verb = rng.choice(VERBS)
+        if rng.random() < 0.5:
+            verb = random_word(rng, rng.randint(4, 9)) + '\\w*'
+        rules.add(template.format(verb=verb, n=rng.randint(1, 8)))
+    rules = sorted(rules)
+    for noun in MAGIC_BULLET_NOUNS:
+        rules.append('[np = ' + noun + ']')
+        rules.append('[npl]is the ' + noun)
+        rules.append('the ' + noun + ' is[npr]')
+    return rules
+
+
+def generate_language_data(directory, start_word_count, grammar_rule_count, seed):
+    """
+    Write a realistically large set of language data files into
+    directory, and return their paths (like snapshot.LANGUAGE_DATA_PATHS).
+    """
+    rng = random.Random(seed)
+    paths = dict((name, os.path.join(directory, os.path.basename(path)))
+                 for name, path in snapshot.LANGUAGE_DATA_PATHS.items())
+    files = dict(
+        start_words=generate_diseases(rng, start_word_count),
+        grammar=generate_grammar(rng, grammar_rule_count),
+        counter_grammar=['risk\\w*( \\S+){0,3} for( \\S+){0,5} [p]',
+                         'chances for ( \\S+){0,5} [p]'] + [
+                             random_word(rng, 6) + '\\w* (of|for)( \\S+){0,4} [p]'
+                             for _ in range(max(grammar_rule_count // 10, 1))],
+        stop_words=['^i$', '^you$', '^they$', '^@\\w+$', 'key', 'potential', 'way\\w*',
+                    'idea\\w*', 'option\\w*', 'hope', 'year\\w*', 'tablet\\w*'],
+        user_dictionary=['<MEDICAL_JOB>\t' + job for job in JOBS] +
+        ['<MEDICAL_PLACE>\t' + place for place in PLACES],
+        user_grammar=['(?i)<MEDICAL_JOB> at <MEDICAL_PLACE>\tProfessional'] + [
+            '(?i)' + random_word(rng, rng.randint(5, 10)) + ' ' + rng.choice(JOBS) +
+            '\t' + rng.choice(TAGS) for _ in range(max(grammar_rule_count // 4, 1))],
+        string_twitter_queries=JOBS + PLACES + [
+            random_word(rng, rng.randint(5, 10)) for _ in range(500)])
+    for name, lines in files.items():
+        with open(paths[name], 'w', encoding='utf-8') as language_file:
+            language_file.write('\n'.join(lines))
+    return paths
+
+
+def synthetic_message(rng, diseases):
+    """
+    A tweet-like message. Most of them mention a disease, and some of
+    them with a problem-solution structure or a magic bullet.
+    """
+    words = [rng.choice(FILLER_WORDS) for _ in range(rng.randint(3, 18))]
+    kind = rng.random()
+    if kind < 0.3:
+        words.insert(rng.randint(0, len(words)), rng.choice(SOLUTIONS) + ' ' +
+                     rng.choice(VERBS).replace('\\w*', 's') + ' ' + rng.choice(diseases))
+    elif kind < 0.45:
+        words.insert(rng.randint(0, len(words)), rng.choice(diseases) + ' ' +
+                     rng.choice(MAGIC_BULLET_NOUNS))
+    elif kind < 0.85:
+        words.insert(rng.randint(0, len(words)), rng.choice(diseases))
+    message = ' '.join(words)
+    if rng.random() < 0.3:
+        message += '. ' + ' '.join(rng.choice(FILLER_WORDS) for _ in range(6)) + '!'
+    if rng.random() < 0.2:
+        message += ' http://t.co/' + random_word(rng, 10)
+    return message[0].upper() + message[1:]
+
+
+def synthetic_corpus(rng, count, diseases):
+    """
+    Jobs with synthetic messages. About half of the users are health
+    related (their description mentions a job or a place).
+    """
+    jobs = []
+    for _ in range(count):
+        description = ' '.join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(2, 12)))
+        if rng.random() < 0.5:
+            description += ', ' + rng.choice(JOBS) + ' at ' + rng.choice(PLACES)
+        jobs.append(dict(user_name=random_word(rng, rng.randint(5, 12)),
+                         user_description=description,
+                         created_at='2017-04-02T22:35:04.868Z',
+                         message=synthetic_message(rng, diseases),
+                         source='twitter',
+                         query=rng.choice(diseases)))
+    return jobs
+
+
+def sampled_corpus(rng, count, corpus_path):
+    """
+    A reservoir sample of count jobs of a JSONL corpus.
+    """
+    sample = []
+    with open(corpus_path, 'r', encoding='utf-8') as corpus_file:
+        for index, line in enumerate(line for line in corpus_file if line.strip()):
+            if len(sample) < count:
+                sample.append(line)
+            else:
+                position = rng.randint(0, index)
+                if position < count:
+                    sample[position] = line
+    return [json.loads(line) for line in sample]
+
+
+def peak_rss():
+    """
+    Peak RSS of the process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It is given in KB on Linux, and in bytes on MacOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(sorted_values, rank):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    index = max(int(round(rank / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def measure(function, calls):
+    """
+    Call function(*arguments) for each tuple of arguments in calls, and
+    return the latency stats (in ms) and the calls per second.
+    """
+    latencies = []
+    for arguments in calls:
+        started_at = time.perf_counter()
+        function(*arguments)
+        latencies.append(time.perf_counter() - started_at)
+    latencies.sort()
+    total = sum(latencies)
+    stats = dict(calls=len(latencies),
+                 mean_ms=1000 * total / max(len(latencies), 1),
+                 max_ms=1000 * latencies[-1] if latencies else 0.0,
+                 per_second=len(latencies) / total if total > 0 else 0.0)
+    for rank in PERCENTILES:
+        stats['p' + str(rank) + '_ms'] = 1000 * percentile(latencies, rank)
+    return stats
+
+
+def clear_rule_caches(language_data):
+    """
+    Empty the compiled rules of the grammars (see text_analyzer.RuleSet),
+    so that every function is measured from the same state.
+    """
+    language_data['grammar'].clear_cache()
+    language_data['counter_grammar'].clear_cache()
+
+
+def benchmark_corpus(jobs):
+    """
+    Measure every function of the pipeline on a corpus.
+    """
+    resources = analyzer.engine.ENGINE.load()
+    language_data = resources['language_data']
+    text_arguments = (language_data['start_words'], language_data['grammar'],
+                      language_data['counter_grammar'], language_data['stop_words'],
+                      language_data['magic_bullet_grammar'])
+    magic_bullet_calls = []
+    for job in jobs:
+        start_word = text_analyzer.start_word_match(job['message'],
+                                                    language_data['start_words'])
+        if start_word is not None:
+            magic_bullet_calls.append((job['message'], start_word,
+                                       language_data['magic_bullet_grammar'],
+                                       language_data['stop_words']))
+    calls = [
+        ('user_analyzer', user_analyzer.user_analyzer, [
+            (job['user_name'], job['user_description'],
+             resources['string_twitter_queries'], resources['lexicon']) for job in jobs]),
+        ('text_analyzer', text_analyzer.analyzer, [
+            (job['message'],) + text_arguments for job in jobs]),
+        ('magic_bullet_analyzer', magic_bullet_analyzer.magic_bullet_analyzer,
+         magic_bullet_calls),
+        ('nlp_analysis', analyzer.engine.nlp_analysis, [(job,) for job in jobs])]
+    results = dict()
+    for name, function, function_calls in calls:
+        clear_rule_caches(language_data)
+        results[name] = measure(function, function_calls)
+    results['peak_rss'] = peak_rss()
+    return results
+
+
+def setup_engine(paths):
+    """
+    Load the language data in paths into a new engine, without caches,
+    and return the seconds it took.
+    """
+    analyzer.engine.ENGINE = analyzer.engine.Engine(paths, snapshot_path=None)
+    analyzer.engine.setup_caches(dict(analyzer.engine.DEFAULT_CACHE_CONFIG,
+                                      profile_cache_size=0, text_cache_size=0))
+    started_at = time.perf_counter()
+    analyzer.engine.ENGINE.load()
+    return time.perf_counter() - started_at
+
+
+def run(args, paths):
+    rng = random.Random(args.seed)
+    load_seconds = setup_engine(paths)
+    text_analyzer.NLP.load()
+    language_data = analyzer.engine.ENGINE.language_data
+    diseases = list(language_data['start_words'].terms)
+    corpora = []
+    for size in args.sizes:
+        corpora.append(('synthetic-' + str(size), synthetic_corpus(rng, size, diseases)))
+        if args.corpus:
+            corpora.append(('sampled-' + str(size), sampled_corpus(rng, size, args.corpus)))
+    for job in synthetic_corpus(rng, WARM_UP_MESSAGES, diseases):
+        analyzer.engine.nlp_analysis(job)
+
+    results = dict(
+        version=RESULTS_VERSION,
+        created_at=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        seed=args.seed,
+        language_data=dict(start_words=len(language_data['start_words'].terms),
+                           grammar=len(language_data['grammar']),
+                           counter_grammar=len(language_data['counter_grammar']),
+                           magic_bullet_grammar=len(language_data['magic_bullet_grammar']),
+                           load_seconds=load_seconds),
+        corpora=dict())
+    for name, jobs in corpora:
+        results['corpora'][name] = benchmark_corpus(jobs)
+        print_corpus(name, results['corpora'][name])
+    results['peak_rss'] = peak_rss()
+    print('Peak RSS: %.1f MB' % (results['peak_rss'] / 1024 / 1024))
+    return results
+
+
+def print_corpus(name, corpus_results):
+    print(name)
+    print('  %-22s %8s %8s %8s %8s %8s %10s' % ('function', 'calls', 'p50 ms', 'p95 ms',
+                                                'p99 ms', 'max ms', 'msgs/sec'))
+    for function in sorted(corpus_results):
+        if function == 'peak_rss':
+            continue
+        stats = corpus_results[function]
+        print('  %-22s %8d %8.3f %8.3f %8.3f %8.3f %10.1f' % (
+            function, stats['calls'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['max_ms'], stats['per_second']), flush=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list with the regressions of results against baseline: a
+    p50/p95 latency more than tolerance higher, a throughput more than
+    tolerance lower, or a peak RSS more than tolerance higher. Corpora
+    and functions missing from either side are not compared.
+    """
+    regressions = []
+    for name, corpus_results in sorted(results['corpora'].items()):
+        baseline_corpus = baseline.get('corpora', dict()).get(name)
+        if baseline_corpus is None:
+            continue
+        for function, stats in sorted(corpus_results.items()):
+            baseline_stats = baseline_corpus.get(function)
+            if function == 'peak_rss' or baseline_stats is None or stats['calls'] == 0:
+                continue
+            for key in ['p50_ms', 'p95_ms']:
+                if stats[key] > baseline_stats[key] * (1 + tolerance):
+                    regressions.append('%s %s %s: %.3f -> %.3f' % (
+                        name, function, key, baseline_stats[key], stats[key]))
+            if stats['per_second'] < baseline_stats['per_second'] * (1 - tolerance):
+                regressions.append('%s %s per_second: %.1f -> %.1f' % (
+                    name, function, baseline_stats['per_second'], stats['per_second']))
+    if 'peak_rss' in baseline and results['peak_rss'] > baseline['peak_rss'] * (1 + tolerance):
+        regressions.append('peak_rss: %.1f MB -> %.1f MB' % (
+            baseline['peak_rss'] / 1024 / 1024, results['peak_rss'] / 1024 / 1024))
+    return regressions
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline.')
+    parser.add_argument('--sizes', default='100,1000',
+                        type=lambda sizes: [int(size) for size in sizes.split(',')],
+                        help='Corpus sizes, comma separated')
+    parser.add_argument('--corpus', help='JSONL corpus of jobs to sample from')
+    parser.add_argument('--language-data',
+                        help='Directory with the language data files (default: generated)')
+    parser.add_argument('--start-words', type=int, default=5000,
+                        help='Generated start words')
+    parser.add_argument('--grammar-rules', type=int, default=2000,
+                        help='Generated grammar rules')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed regression against the baseline (0.2 = 20%%)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        if args.language_data:
+            paths = dict((name, os.path.join(args.language_data, os.path.basename(path)))
+                         for name, path in snapshot.LANGUAGE_DATA_PATHS.items())
+        else:
+            paths = generate_language_data(directory, args.start_words,
+                                           args.grammar_rules, args.seed)
+        results = run(args, paths)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions against ' + args.baseline + ':')
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('No regressions against ' + args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
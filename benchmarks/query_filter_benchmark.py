@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the Twitter query pre-filter of the user analyzer:
+the former linear scan over every query (and every case variant of it)
+against the QueryMatcher built by string_twitter_queriesParser().
+
+Usage:
+    export PYTHONPATH=.; python3 benchmarks/query_filter_benchmark.py [queries] [descriptions]
+"""
+import random
+import sys
+import timeit
+from analyzer.engines import user_analyzer
+
+WORDS = ['health', 'doctor', 'nurse', 'medicine', 'cancer', 'research', 'mom',
+         'runner', 'coffee', 'tech', 'news', 'hospital', 'father', 'patient',
+         'opinions', 'own', 'clinic', 'care', 'science', 'life', 'love']
+
+
+def linear_has_query(user_description, string_twitter_queries):
+    """
+    The former user_description_HasQuery(), for comparison.
+    """
+    for string_twitter_query in string_twitter_queries:
+        if string_twitter_query in str(user_description):
+            return True
+    return False
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(length))
+
+
+def generate_queries(rng, count):
+    queries = []
+    for _ in range(count):
+        words = [random_word(rng, rng.randint(4, 10)) for _ in range(rng.randint(1, 2))]
+        queries.append(' '.join(words))
+    return queries
+
+
+def generate_descriptions(rng, count, queries):
+    """
+    Twitter bios of up to 160 characters. One in ten mentions a query.
+    """
+    descriptions = []
+    for index in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(5, 25))]
+        if index % 10 == 0:
+            words.insert(rng.randint(0, len(words)), rng.choice(queries).upper())
+        descriptions.append(' '.join(words)[:160])
+    return descriptions
+
+
+def main(query_count, description_count):
+    rng = random.Random(42)
+    queries = generate_queries(rng, query_count)
+    # The former query file listed every case variant of each query
+    all_variants = []
+    for query in queries:
+        all_variants.extend([query, query.upper(), query.capitalize()])
+    matcher = user_analyzer.QueryMatcher(queries)
+    descriptions = generate_descriptions(rng, description_count, queries)
+
+    linear_results = [linear_has_query(description, all_variants) for description in descriptions]
+    matcher_results = [matcher.search(description) for description in descriptions]
+    assert linear_results == matcher_results
+
+    linear_time = min(timeit.repeat(
+        lambda: [linear_has_query(description, all_variants) for description in descriptions],
+        number=1, repeat=3))
+    matcher_time = min(timeit.repeat(
+        lambda: [matcher.search(description) for description in descriptions],
+        number=1, repeat=3))
+
+    print('Queries: %d (%d lines in the former file), descriptions: %d' %
+          (query_count, len(all_variants), description_count))
+    print('Linear scan:   %.1f us/description' % (linear_time / description_count * 1e6))
+    print('Query matcher: %.1f us/description' % (matcher_time / description_count * 1e6))
+    print('Speedup: %.1fx' % (linear_time / matcher_time))
+
+
+if __name__ == "__main__":
+    QUERY_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    DESCRIPTION_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    main(QUERY_COUNT, DESCRIPTION_COUNT)
@@ -0,0 +1,145 @@
+"""
+Memory benchmark of the start words index: the former layout (the dict
+of start_words_to_dict() and an automaton with a dict per state)
+against StartWordIndex and the current StartWordAutomaton.
+
+Both layouts are built for a generated vocabulary, pickled, and loaded
+by a fresh process each (like a worker loading the language data
+snapshot), which reports how much its RSS grew.
+
+Usage:
+    export PYTHONPATH=.; python3 benchmarks/start_words_memory_benchmark.py [terms]
+"""
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+from analyzer.engines import text_analyzer
+
+MEASURE = '''
+import gc
+import os
+import pickle
+import sys
+sys.path.insert(0, {benchmarks!r})
+import __main__
+import start_words_memory_benchmark
+from analyzer.engines import text_analyzer
+# The former layout was pickled from the benchmark script
+__main__.FormerStartWordAutomaton = start_words_memory_benchmark.FormerStartWordAutomaton
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+gc.collect()
+before = rss()
+with open({path!r}, 'rb') as layout_file:
+    layout = pickle.load(layout_file)
+gc.collect()
+print(rss() - before)
+'''
+
+
+class FormerStartWordAutomaton(object):
+    """
+    The former layout of StartWordAutomaton (a dict of transitions per
+    state, and lists for the failure links and best terms), for
+    comparison. Only the data is built, the failure links are left out.
+    """
+
+    def __init__(self, start_words):
+        self.start_words = start_words
+        terms = []
+        ranks = dict()
+        for single_token in start_words.keys():
+            for term in start_words[single_token]:
+                if term not in ranks:
+                    ranks[term] = len(terms)
+                    terms.append(term)
+        self.terms = terms
+        self.goto = [dict()]
+        self.best = [None]
+        for term_id, term in enumerate(terms):
+            state = 0
+            for char in term:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append(dict())
+                    self.best.append(None)
+                state = next_state
+            self.best[state] = term_id
+        self.fail = [0] * len(self.goto)
+        for state in range(1, len(self.goto), 2):
+            self.fail[state] = state - 1
+
+
+def random_word(rng):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 12)))
+
+
+def generate_terms(rng, count):
+    """
+    Disease terms of 1 to 5 words, e.g. 'chronic kidney disease stage 3',
+    from a vocabulary of count / 5 words (plus common modifiers).
+    """
+    vocabulary = [random_word(rng) for _ in range(max(count // 5, 10))]
+    modifiers = ['acute', 'chronic', 'type', 'of', 'the', 'with', 'due', 'to', 'primary']
+    terms = set()
+    while len(terms) < count:
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.5:
+            words.insert(rng.randint(0, len(words)), rng.choice(modifiers))
+        if rng.random() < 0.2:
+            words.append(str(rng.randint(1, 4)))
+        terms.add(' '.join(words))
+    return sorted(terms)
+
+
+def measure(path):
+    """
+    Returns the RSS growth (in bytes) of a fresh process that loads the
+    pickled layout in path.
+    """
+    code = MEASURE.format(benchmarks=os.path.dirname(os.path.abspath(__file__)), path=path)
+    return int(subprocess.check_output([sys.executable, '-c', code]))
+
+
+def main(term_count):
+    rng = random.Random(42)
+    terms = generate_terms(rng, term_count)
+    start_words = text_analyzer.start_words_to_dict(terms)
+    index = text_analyzer.StartWordIndex(terms)
+    assert dict(index.items()) == start_words
+    layouts = [
+        ('Former dict', start_words),
+        ('StartWordIndex', index),
+        ('Former dict + automaton', FormerStartWordAutomaton(start_words)),
+        ('StartWordIndex + automaton', text_analyzer.StartWordAutomaton(index))
+    ]
+    print('Terms: %d, single tokens: %d' % (len(terms), len(index)))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, layout in layouts:
+            path = os.path.join(directory, 'layout.pickle')
+            with open(path, 'wb') as layout_file:
+                pickle.dump(layout, layout_file, protocol=pickle.HIGHEST_PROTOCOL)
+            print('%-28s %7.1f MB' % (name, measure(path) / 1024 / 1024))
+
+    automaton = layouts[3][1]
+    messages = [' '.join(rng.choice(terms).split()[:2] + [random_word(rng) for _ in range(15)])
+                for _ in range(2000)]
+    search_time = min(timeit.repeat(
+        lambda: [automaton.search(message) for message in messages], number=1, repeat=3))
+    print('Automaton search: %.1f us/message' % (search_time / len(messages) * 1e6))
+
+
+if __name__ == "__main__":
+    TERM_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    main(TERM_COUNT)
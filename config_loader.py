@@ -12,6 +12,10 @@ try:
     beanstalkd_section = config['beanstalkd']
     firebase_section = config['firebase']
     elasticsearch_section = config['elasticsearch']
+    # Optional section
+    runner_section = config['runner'] if config.has_section('runner') else dict()
+    cache_section = config['cache'] if config.has_section('cache') else dict()
+    metrics_section = config['metrics'] if config.has_section('metrics') else dict()
 except:
     print("ERROR: config.ini is not present or its format is wrong. \n\nPlease create a new config.ini file and set your configuration parameters. \n\nYou can find an example file in this directory, as config.example.ini. Just rename it as config.ini and set your local configuration parameters.")
     sys.exit()
@@ -36,4 +40,39 @@ ELASTICSEARCH_CONFIG = dict(
     url=elasticsearch_section.get('ElasticsearchUrl', 'http://localhost:9200'),
     user=elasticsearch_section.get('ElasticsearchUser', 'elastic'),
     password=elasticsearch_section.get('ElsaticsearchPassword', 'changeme'),
+    bulk_max_docs=int(elasticsearch_section.get('BulkMaxDocs', '500'), base=10),
+    bulk_max_bytes=int(elasticsearch_section.get('BulkMaxBytes', '5242880'), base=10)
+)
+
+RUNNER_CONFIG = dict(
+    workers=int(runner_section.get('Workers', '1'), base=10),
+    async_output=runner_section.get('AsyncOutput', 'false').lower() in ('true', 'yes', '1'),
+    output_queue_size=int(runner_section.get('OutputQueueSize', '1000'), base=10),
+    output_batch_size=int(runner_section.get('OutputBatchSize', '50'), base=10),
+    output_flush_interval=float(runner_section.get('OutputFlushInterval', '1.0')),
+    time_budget=float(runner_section.get('TimeBudget', '5.0')),
+    timeout_tube=runner_section.get('TimeoutTube', 'timeout')
+)
+
+CACHE_CONFIG = dict(
+    profile_cache_size=int(cache_section.get('ProfileCacheSize', '100000'), base=10),
+    profile_cache_ttl=float(cache_section['ProfileCacheTTL'])
+    if cache_section.get('ProfileCacheTTL') else None,
+    profile_cache_path=cache_section.get('ProfileCachePath') or None,
+    profile_cache_max_rows=int(cache_section.get('ProfileCacheMaxRows', '1000000'), base=10),
+    text_cache_size=int(cache_section.get('TextCacheSize', '100000'), base=10),
+    text_cache_max_bytes=int(cache_section.get('TextCacheMaxBytes', '67108864'), base=10),
+    text_cache_ttl=float(cache_section['TextCacheTTL'])
+    if cache_section.get('TextCacheTTL') else None,
+    text_cache_path=cache_section.get('TextCachePath') or None,
+    text_cache_max_rows=int(cache_section.get('TextCacheMaxRows', '1000000'), base=10),
+    rule_cache_size=int(cache_section.get('RuleCacheSize', '4096'), base=10)
+)
+
+METRICS_CONFIG = dict(
+    metrics_enabled=metrics_section.get('Enabled', 'false').lower() in ('true', 'yes', '1'),
+    metrics_host=metrics_section.get('Host', '127.0.0.1'),
+    metrics_port=int(metrics_section.get('Port', '9108'), base=10),
+    stats_log_path=metrics_section.get('StatsLogPath') or None,
+    stats_interval=float(metrics_section.get('StatsInterval', '60'))
 )
@@ -1,40 +1,233 @@
 """
 Utility to export analysis data from the elasticsearch into an
 export.txt file where each line is a json document.
+
+The index is read with parallel sliced scrolls (one thread per slice).
+Each slice is written to its own part file, and a checkpoint file keeps
+track of the finished slices, so an interrupted export can be resumed
+with the same arguments. Once all the slices are done, the parts are
+joined into the output file (gzip members can be concatenated too).
+
+Usage examples:
+    python3 elastic_raw_exporter.py
+    python3 elastic_raw_exporter.py -o export.jsonl.gz --slices 4
+    python3 elastic_raw_exporter.py --fields message,analysis \
+        --from 2017-06-01 --to 2017-07-01
 """
 from config_loader import ELASTICSEARCH_CONFIG as es_config
+import argparse
+import gzip
 import json
+import os
+import shutil
+import sys
+import threading
+import time
 import requests
 
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def build_query(args):
+    """
+    Build the query from the --query and --from/--to arguments.
+    """
+    filters = []
+    if args.query:
+        filters.append(json.loads(args.query))
+    time_range = dict()
+    if args.time_from:
+        time_range['gte'] = args.time_from
+    if args.time_to:
+        time_range['lt'] = args.time_to
+    if len(time_range) > 0:
+        filters.append({'range': {args.time_field: time_range}})
+    if len(filters) == 0:
+        return {'match_all': {}}
+    return {'bool': {'filter': filters}}
+
+
+def open_output(path, compress):
+    """
+    Open a part file for writing, with a large buffer.
+    """
+    if compress:
+        return gzip.GzipFile(fileobj=open(path, 'wb', buffering=WRITE_BUFFER_SIZE),
+                             mode='wb', compresslevel=6)
+    return open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+
+def read_json(response):
+    """
+    Decode a JSON response from its raw stream, without keeping a copy
+    of the whole text body in memory.
+    """
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return json.load(response.raw)
+
 
 def export_hits(hits, file):
-    # Export each element to the export.txt file
-    for analysis in hits:
-        file.write(json.dumps(analysis['_source']) + '\n')
-
-
-f = open('export.txt', 'w')
-
-r = requests.get(es_config['url'] + '/analysis/_search?scroll=1m&size=5000',
-                 auth=(es_config['user'],
-                       es_config['password']))
-
-data = r.json()
-scroll_id = data['_scroll_id']
-hits_count = len(data['hits']['hits'])
-export_hits(data['hits']['hits'], f)
-
-while hits_count > 0:
-    payload={'scroll': '1m', 'scroll_id': scroll_id}
-    # Get analysis data
-    r=requests.post(es_config['url'] + '/_search/scroll',
-                      auth=(es_config['user'],
-                            es_config['password']),
-                      json=payload)
-    data=r.json()
-    scroll_id=data['_scroll_id']
-    export_hits(data['hits']['hits'], f)
-    hits_count=len(data['hits']['hits'])
-    print('.', end='', flush=True)
-
-f.close()
+    # Export each element of a page with a single write
+    if len(hits) > 0:
+        file.write(('\n'.join(json.dumps(analysis['_source']) for analysis in hits) +
+                    '\n').encode('utf-8'))
+
+
+class Exporter(object):
+    """
+    Export every slice of the analysis index into its own part file.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        self.session.auth = (es_config['user'], es_config['password'])
+        self.query = build_query(args)
+        self.checkpoint_path = args.output + '.checkpoint'
+        self.completed_slices = self.load_checkpoint()
+        self.lock = threading.Lock()
+        self.exported = 0
+        self.errors = []
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('query') != self.query or checkpoint.get('slices') != self.args.slices:
+            print('The checkpoint belongs to a different export, starting over')
+            return set()
+        return set(checkpoint['completed_slices'])
+
+    def save_checkpoint(self):
+        with open(self.checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            json.dump({'query': self.query,
+                       'slices': self.args.slices,
+                       'completed_slices': sorted(self.completed_slices)}, checkpoint_file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def part_path(self, slice_id):
+        return self.args.output + '.part' + str(slice_id)
+
+    def search_body(self, slice_id):
+        body = {'query': self.query, 'sort': ['_doc']}
+        if self.args.slices > 1:
+            body['slice'] = {'id': slice_id, 'max': self.args.slices}
+        if self.args.fields:
+            body['_source'] = self.args.fields.split(',')
+        return body
+
+    def export_slice(self, slice_id):
+        """
+        Scroll through a slice and write its documents to its part file.
+        """
+        params = {'scroll': self.args.scroll,
+                  'size': self.args.size,
+                  'filter_path': '_scroll_id,hits.hits._source'}
+        scroll_id = None
+        output = open_output(self.part_path(slice_id), self.args.compress)
+        try:
+            data = read_json(self.session.post(es_config['url'] + '/analysis/_search',
+                                               params=params, json=self.search_body(slice_id),
+                                               stream=True))
+            while True:
+                scroll_id = data.get('_scroll_id', scroll_id)
+                hits = data.get('hits', {}).get('hits', [])
+                if len(hits) == 0:
+                    break
+                export_hits(hits, output)
+                with self.lock:
+                    self.exported += len(hits)
+                payload = {'scroll': self.args.scroll, 'scroll_id': scroll_id}
+                data = read_json(self.session.post(es_config['url'] + '/_search/scroll',
+                                                   params={'filter_path': params['filter_path']},
+                                                   json=payload, stream=True))
+        except Exception as error:
+            with self.lock:
+                self.errors.append('Slice ' + str(slice_id) + ': ' + str(error))
+            return
+        finally:
+            output.close()
+            if scroll_id is not None:
+                self.clear_scroll(scroll_id)
+        with self.lock:
+            self.completed_slices.add(slice_id)
+            self.save_checkpoint()
+
+    def clear_scroll(self, scroll_id):
+        try:
+            self.session.delete(es_config['url'] + '/_search/scroll',
+                                json={'scroll_id': [scroll_id]})
+        except requests.RequestException:
+            pass
+
+    def report_progress(self, started_at):
+        elapsed = time.time() - started_at
+        rate = self.exported / elapsed if elapsed > 0 else 0
+        print('Exported ' + str(self.exported) + ' documents (%.0f docs/sec)' % rate,
+              flush=True)
+
+    def join_parts(self):
+        with open(self.args.output, 'wb') as output:
+            for slice_id in range(self.args.slices):
+                with open(self.part_path(slice_id), 'rb') as part:
+                    shutil.copyfileobj(part, output, WRITE_BUFFER_SIZE)
+        for slice_id in range(self.args.slices):
+            os.remove(self.part_path(slice_id))
+        os.remove(self.checkpoint_path)
+
+    def run(self):
+        pending = [slice_id for slice_id in range(self.args.slices)
+                   if slice_id not in self.completed_slices]
+        if len(pending) < self.args.slices:
+            print('Resuming export, ' + str(len(pending)) + ' slices left')
+        threads = [threading.Thread(target=self.export_slice, args=(slice_id,))
+                   for slice_id in pending]
+        started_at = time.time()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            deadline = time.time() + self.args.progress_interval
+            for thread in threads:
+                thread.join(max(0, deadline - time.time()))
+            self.report_progress(started_at)
+        self.report_progress(started_at)
+        if len(self.errors) > 0:
+            for error in self.errors:
+                print(error)
+            print('The export is incomplete. Run it again to resume it.')
+            return False
+        self.join_parts()
+        print('Export ready: ' + self.args.output)
+        return True
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Export the analysis index to a JSONL file.')
+    parser.add_argument('-o', '--output', default='export.txt',
+                        help='output file (gzip compressed if it ends with .gz)')
+    parser.add_argument('--gzip', dest='compress', action='store_true',
+                        help='gzip compress the output')
+    parser.add_argument('--slices', type=int, default=1,
+                        help='number of parallel sliced scrolls')
+    parser.add_argument('--size', type=int, default=5000,
+                        help='documents per scroll page')
+    parser.add_argument('--scroll', default='1m', help='scroll context keep alive')
+    parser.add_argument('--fields', help='comma separated _source fields to export')
+    parser.add_argument('--query', help='elasticsearch query (JSON) to filter the documents')
+    parser.add_argument('--time-field', default='created_at',
+                        help='field used by --from and --to')
+    parser.add_argument('--from', dest='time_from', help='export documents from this date')
+    parser.add_argument('--to', dest='time_to', help='export documents before this date')
+    parser.add_argument('--progress-interval', type=float, default=5,
+                        help='seconds between progress reports')
+    args = parser.parse_args(argv)
+    if args.output.endswith('.gz'):
+        args.compress = True
+    return args
+
+
+if __name__ == "__main__":
+    if not Exporter(parse_arguments(sys.argv[1:])).run():
+        sys.exit(1)
@@ -1,34 +1,199 @@
 """
 Utility to import analyzed JSON data stored in plain text files
+
+The file (one JSON document per line, optionally gzip compressed) is
+streamed through a chunker into several concurrent _bulk senders. The
+index refresh is turned off during the load, and the chunks that can't
+be imported are written to a reject file.
+
+Usage examples:
+    python3 elastic_raw_importer.py export.txt
+    python3 elastic_raw_importer.py export.jsonl.gz --concurrency 8
 """
 from config_loader import ELASTICSEARCH_CONFIG as es_config
-from analyzer.uploader import ElasticsearchAnalysisUploader
-import sys
+from analyzer.uploader import ElasticsearchAnalysisUploader, irrelevant_analysis
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import gzip
 import json
+import sys
+import threading
+import time
+import requests
+
+
+def read_analyses(f, reject=None):
+    # Stream the analyses from the file, one per line. The malformed
+    # lines are handed over to reject(line, error), if given.
+    for line in f:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            analysis = json.loads(line)
+            analysis['source'] = analysis['source'].lower()
+            # Needed to tell if it's relevant
+            analysis['analysis']['problem']
+            analysis['analysis']['solution']
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            if reject is not None:
+                reject(line, error)
+            continue
+        yield analysis
+
+
+def chunker(analyses, chunk_size):
+    # Group the analyses into chunks of chunk_size
+    chunk = []
+    for analysis in analyses:
+        chunk.append(analysis)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+class Importer(object):
+    """
+    Send the chunks to elasticsearch from a pool of threads, each one
+    with its own uploader (and HTTP session).
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.imported = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.reject_file = None
+        self.started_at = time.time()
+        self.last_report = self.started_at
+
+    def uploader(self):
+        if not hasattr(self.local, 'uploader'):
+            self.local.uploader = ElasticsearchAnalysisUploader(es_config['url'],
+                                                                es_config['user'],
+                                                                es_config['password'],
+                                                                es_config['bulk_max_docs'],
+                                                                es_config['bulk_max_bytes'])
+        return self.local.uploader
+
+    def import_chunk(self, chunk):
+        # The irrelevant analyses are not sent
+        relevant = [analysis for analysis in chunk if not irrelevant_analysis(analysis)]
+        try:
+            rejected = []
+            failed = self.uploader().upload_analyses(relevant, rejected) + rejected
+        except Exception as error:
+            print('Chunk error: ' + str(error))
+            failed = relevant
+        with self.lock:
+            self.imported += len(relevant) - len(failed)
+            self.skipped += len(chunk) - len(relevant)
+            self.rejected += len(failed)
+            for analysis in failed:
+                self.reject_file.write(json.dumps(analysis) + '\n')
+            if time.time() - self.last_report >= self.args.progress_interval:
+                self.report_progress()
+
+    def reject_line(self, line, error):
+        # Malformed lines are written as they are
+        print('Malformed line: ' + str(error))
+        with self.lock:
+            self.rejected += 1
+            self.reject_file.write(line.rstrip('\n') + '\n')
+
+    def report_progress(self):
+        self.last_report = time.time()
+        elapsed = self.last_report - self.started_at
+        rate = self.imported / elapsed if elapsed > 0 else 0
+        print('Imported ' + str(self.imported) + ' documents, skipped ' +
+              str(self.skipped) + ' irrelevant, rejected ' + str(self.rejected) +
+              ' (%.0f docs/sec)' % rate, flush=True)
+
+    def run(self, f):
+        # Bound the chunks in flight, so the file is streamed
+        in_flight = threading.BoundedSemaphore(self.args.concurrency * 2)
+
+        def send(chunk):
+            try:
+                self.import_chunk(chunk)
+            finally:
+                in_flight.release()
+
+        with open(self.args.reject_file, 'w') as self.reject_file:
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+                for chunk in chunker(read_analyses(f, self.reject_line), self.args.chunk_size):
+                    in_flight.acquire()
+                    executor.submit(send, chunk)
+        self.report_progress()
+        if self.rejected > 0:
+            print('Rejected documents were written to ' + self.args.reject_file)
+
+
+def get_refresh_interval(session):
+    response = session.get(es_config['url'] + '/analysis/_settings/index.refresh_interval')
+    response.raise_for_status()
+    settings = response.json().get('analysis', {}).get('settings', {})
+    return settings.get('index', {}).get('refresh_interval')
+
+
+def set_refresh_interval(session, refresh_interval):
+    response = session.put(es_config['url'] + '/analysis/_settings',
+                           json={'index': {'refresh_interval': refresh_interval}})
+    response.raise_for_status()
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Import a JSONL file into the analysis index.')
+    parser.add_argument('file', help='file with the analysis data (gzip if it ends with .gz)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of concurrent _bulk senders')
+    parser.add_argument('--chunk-size', type=int, default=es_config['bulk_max_docs'],
+                        help='documents per chunk')
+    parser.add_argument('--reject-file', help='file for the documents that can\'t be imported')
+    parser.add_argument('--keep-refresh', action='store_true',
+                        help='don\'t turn off the index refresh during the load')
+    parser.add_argument('--progress-interval', type=float, default=5,
+                        help='seconds between progress reports')
+    args = parser.parse_args(argv)
+    if args.reject_file is None:
+        args.reject_file = args.file + '.rejected'
+    return args
+
+
+if __name__ == "__main__":
+    ARGS = parse_arguments(sys.argv[1:])
+
+    # Attempt to open the specified file
+    print('Specified file: ' + ARGS.file)
+
+    try:
+        if ARGS.file.endswith('.gz'):
+            f = gzip.open(ARGS.file, 'rt', encoding='utf-8')
+        else:
+            f = open(ARGS.file, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        print('The specified file couldn\'t be found')
+        sys.exit(1)
+
+    SESSION = requests.Session()
+    SESSION.auth = (es_config['user'], es_config['password'])
 
-# Setup the elasticsearch uploader
-es_uploader = ElasticsearchAnalysisUploader(es_config['url'],
-                                            es_config['user'],
-                                            es_config['password'])
-
-# Check that some filename has been specified as argument
-if len(sys.argv) != 2:
-    print('Wrong number of arguments. Please, specify the file\n' +
-          'with the analysis data to be imported.')
-    sys.exit(0)
-
-# Attempt to open the specified file
-print('Specified file: ' + sys.argv[1])
-
-try:
-    f = open(sys.argv[1])
-except FileNotFoundError:
-    print('The specified file couldn\'t be found')
-    sys.exit(1)
-
-# Read the contents of the file
-for line in f:
-    analysis = json.loads(line)
-    analysis['source'] = analysis['source'].lower()
-    es_uploader.upload_analysis(analysis)
-    print('Analysis imported: ' + line)
+    # Turn off the refresh during the load, and restore it afterwards
+    REFRESH_DISABLED = False
+    if not ARGS.keep_refresh:
+        try:
+            REFRESH_INTERVAL = get_refresh_interval(SESSION)
+            set_refresh_interval(SESSION, '-1')
+            REFRESH_DISABLED = True
+        except requests.HTTPError as error:
+            # E.g. the index doesn't exist yet
+            print('The index refresh couldn\'t be turned off: ' + str(error))
+    try:
+        Importer(ARGS).run(f)
+    finally:
+        f.close()
+        if REFRESH_DISABLED:
+            set_refresh_interval(SESSION, REFRESH_INTERVAL)
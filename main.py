@@ -1,7 +1,18 @@
-from config_loader import BEANSTALKD_CONFIG, FIREBASE_CONFIG, ELASTICSEARCH_CONFIG
-from analyzer.runner import setup_and_run
+from config_loader import BEANSTALKD_CONFIG, FIREBASE_CONFIG, ELASTICSEARCH_CONFIG, RUNNER_CONFIG
+from config_loader import CACHE_CONFIG, METRICS_CONFIG
+from analyzer.runner import setup_and_run, setup_and_run_pool
+import analyzer.engine
 
 # Start the magic!
 if __name__ == "__main__":
-    setup_and_run(BEANSTALKD_CONFIG, FIREBASE_CONFIG,
-                  ELASTICSEARCH_CONFIG, True)
+    analyzer.engine.setup_caches(CACHE_CONFIG)
+    # Load everything before forking the workers, so they share it
+    analyzer.engine.warm_up()
+    if RUNNER_CONFIG['workers'] > 1:
+        setup_and_run_pool(BEANSTALKD_CONFIG, FIREBASE_CONFIG,
+                           ELASTICSEARCH_CONFIG, RUNNER_CONFIG['workers'],
+                           output_config=RUNNER_CONFIG, metrics_config=METRICS_CONFIG)
+    else:
+        setup_and_run(BEANSTALKD_CONFIG, FIREBASE_CONFIG,
+                      ELASTICSEARCH_CONFIG, True, output_config=RUNNER_CONFIG,
+                      metrics_config=METRICS_CONFIG)
@@ -0,0 +1,95 @@
+"""
+Batch analysis tests.
+"""
+import gzip
+import io
+import json
+import time
+from unittest import mock
+import analyzer.batch
+
+
+def mock_user_profile_analysis(job_json):
+    if job_json['user_name'] == 'discarded':
+        return None
+    return dict(profile='doctor', health_related=True)
+
+
+def mock_text_analysis(job_json, analysis):
+    analysis['solution'] = job_json['message'].upper()
+    analysis['problem'] = 'diabetes'
+    return analysis
+
+
+def corpus_lines(count):
+    lines = []
+    for index in range(count):
+        user_name = 'discarded' if index % 4 == 0 else 'doctor'
+        lines.append(json.dumps(dict(user_name=user_name, user_description='',
+                                     message='message ' + str(index))))
+    return lines
+
+
+@mock.patch('analyzer.engine')
+def test_analyze_line(mock_engine):
+    mock_engine.user_profile_analysis.side_effect = mock_user_profile_analysis
+    mock_engine.text_analysis.side_effect = mock_text_analysis
+    status, output, timings = analyzer.batch.analyze_line(corpus_lines(2)[1])
+    assert status == 'analyzed'
+    assert json.loads(output)['analysis']['solution'] == 'MESSAGE 1'
+    assert len(timings) == len(analyzer.batch.STAGES)
+    status, output, _ = analyzer.batch.analyze_line(corpus_lines(1)[0])
+    assert status == 'discarded'
+    assert json.loads(output)['analysis'] is None
+    assert analyzer.batch.analyze_line('{not json')[0] == 'error'
+
+
+@mock.patch('analyzer.engine')
+def test_analyze_corpus(mock_engine):
+    mock_engine.user_profile_analysis.side_effect = mock_user_profile_analysis
+    mock_engine.text_analysis.side_effect = mock_text_analysis
+    lines = corpus_lines(20) + ['{not json']
+    results_file = io.StringIO()
+    stats = analyzer.batch.analyze_corpus(iter(lines), results_file, workers=1,
+                                          report_interval=0)
+    results = [json.loads(line) for line in results_file.getvalue().splitlines()]
+    assert [result['message'] for result in results] == [
+        'message ' + str(index) for index in range(20) if index % 4 != 0]
+    assert stats.counts == dict(analyzed=15, discarded=5, timeout=0, error=1)
+    assert stats.discard_ratio() == 5 / 21
+
+    results_file = io.StringIO()
+    stats = analyzer.batch.analyze_corpus(iter(lines), results_file, workers=2,
+                                          chunk_size=3, keep_discarded=True,
+                                          report_interval=0)
+    results = [json.loads(line) for line in results_file.getvalue().splitlines()]
+    assert [result['message'] for result in results] == [
+        'message ' + str(index) for index in range(20)]
+    assert stats.counts == dict(analyzed=15, discarded=5, timeout=0, error=1)
+
+
+def test_open_corpus_and_results(tmpdir):
+    path = str(tmpdir.join('results.jsonl.gz'))
+    results_file = analyzer.batch.open_results(path)
+    results_file.write('{"a": 1}\n\n{"a": 2}\n')
+    results_file.close()
+    with gzip.open(path, 'rt') as gzip_file:
+        assert gzip_file.read().startswith('{"a": 1}')
+    corpus_file = analyzer.batch.open_corpus(path)
+    assert list(analyzer.batch.read_lines(corpus_file)) == ['{"a": 1}', '{"a": 2}']
+    corpus_file.close()
+
+
+def slow_text_analysis(job_json, analysis):
+    time.sleep(1)
+    return analysis
+
+
+@mock.patch('analyzer.engine')
+def test_analyze_line_timeout(mock_engine):
+    mock_engine.user_profile_analysis.side_effect = mock_user_profile_analysis
+    mock_engine.text_analysis.side_effect = slow_text_analysis
+    mock_engine.timeout_analysis.return_value = dict(solution='<timeout>', problem='<timeout>')
+    status, output, _ = analyzer.batch.analyze_line(corpus_lines(2)[1], time_budget=0.05)
+    assert status == 'timeout'
+    assert json.loads(output)['analysis']['solution'] == '<timeout>'
@@ -0,0 +1,106 @@
+"""
+Time budget tests.
+"""
+import re
+import signal
+import threading
+import time
+from unittest import mock
+import pytest
+import analyzer.engine
+import analyzer.processor
+from analyzer import budget
+
+
+def test_interrupts_backtracking():
+    started_at = time.perf_counter()
+    with pytest.raises(budget.JobTimeout):
+        with budget.TimeBudget(0.2):
+            re.search(r'(a+)+b', 'a' * 40)
+    assert time.perf_counter() - started_at < 2
+    assert budget.CURRENT['budget'] is None
+
+
+def test_no_budget():
+    for seconds in [None, 0]:
+        with budget.TimeBudget(seconds):
+            budget.check()
+        assert budget.CURRENT['budget'] is None
+
+
+def test_within_budget():
+    with budget.TimeBudget(5) as time_budget:
+        budget.check()
+    assert not time_budget.expired
+    # The alarm is cancelled on exit
+    time.sleep(0.01)
+
+
+def test_late_alarm():
+    previous_handler = signal.getsignal(signal.SIGALRM)
+    time_budget = budget.TimeBudget(10)
+    time_budget.__enter__()
+    # As if the alarm went off when __exit__() starts
+    with pytest.raises(budget.JobTimeout):
+        time_budget.expire()
+    assert budget.CURRENT['budget'] is None
+    assert signal.getsignal(signal.SIGALRM) is previous_handler
+    assert signal.getitimer(signal.ITIMER_REAL)[0] == 0
+    time_budget.__exit__(None, None, None)
+    assert budget.CURRENT['budget'] is None
+
+
+def test_check():
+    time_budget = budget.TimeBudget(0.01)
+    time_budget.deadline = time.perf_counter() - 1
+    budget.CURRENT['budget'] = time_budget
+    try:
+        with pytest.raises(budget.JobTimeout):
+            budget.check()
+    finally:
+        budget.CURRENT['budget'] = None
+    budget.check()
+
+
+def test_check_in_thread():
+    errors = []
+
+    def analyze():
+        try:
+            with budget.TimeBudget(0.05):
+                time.sleep(0.1)
+                budget.check()
+        except budget.JobTimeout as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=analyze)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_shield():
+    finished = []
+    with pytest.raises(budget.JobTimeout):
+        with budget.TimeBudget(0.05):
+            with budget.shield():
+                time.sleep(0.1)
+                finished.append(True)
+    assert finished == [True]
+
+
+def test_timeout_analysis():
+    analysis = analyzer.engine.timeout_analysis(2.0)
+    assert analysis['solution'] == budget.TIMEOUT_TAG
+    assert analysis['problem'] == budget.TIMEOUT_TAG
+    assert analysis['time_budget'] == 2.0
+
+
+@mock.patch('analyzer.engine')
+def test_analyze_job(mock_engine):
+    mock_engine.nlp_analysis.side_effect = lambda job_json: time.sleep(1)
+    with pytest.raises(budget.JobTimeout):
+        analyzer.processor.analyze_job(dict(message='message'), 0.05)
+    mock_engine.nlp_analysis.side_effect = lambda job_json: dict(solution='solution')
+    assert analyzer.processor.analyze_job(dict(message='message'), 0.05) == \
+        dict(solution='solution')
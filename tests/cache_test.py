@@ -0,0 +1,92 @@
+"""
+cache_test.py
+"""
+import analyzer.cache
+
+
+def test_files_fingerprint(tmp_path):
+    language_file = tmp_path / 'grammar.txt'
+    language_file.write_text('[s] for [p]\n')
+    fingerprint = analyzer.cache.files_fingerprint([str(language_file)])
+    assert fingerprint == analyzer.cache.files_fingerprint([str(language_file)])
+    language_file.write_text('[s] against [p]\n')
+    assert fingerprint != analyzer.cache.files_fingerprint([str(language_file)])
+
+
+def test_text_key():
+    assert analyzer.cache.text_key('ab', 'c') != analyzer.cache.text_key('a', 'bc')
+    assert analyzer.cache.text_key('a', 'b') == analyzer.cache.text_key('a', 'b')
+
+
+def test_analysis_cache():
+    cache = analyzer.cache.AnalysisCache(2)
+    assert cache.get('a') is None
+    cache.put('a', ['pattern', 'Doctor', '<from Name>'])
+    cache.put('b', 'b value')
+    assert cache.get('a') == ['pattern', 'Doctor', '<from Name>']
+    # 'b' is the least recently used entry
+    cache.put('c', 'c value')
+    assert cache.get('b') is None
+    assert cache.get('c') == 'c value'
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 2
+
+
+def test_analysis_cache_max_bytes():
+    cache = analyzer.cache.AnalysisCache(10, max_bytes=30)
+    cache.put('a', 'a' * 10)
+    cache.put('b', 'b' * 10)
+    assert cache.stats()['bytes'] == 26
+    # 'a' is evicted to make room for 'c'
+    cache.put('c', 'c' * 10)
+    assert cache.get('a') is None
+    assert cache.get('b') == 'b' * 10
+    assert cache.stats()['bytes'] == 26
+    assert cache.stats()['evictions'] == 1
+
+
+def test_normalize_text():
+    composed = analyzer.cache.normalize_text('caf\u00e9 for fever ')
+    assert composed == analyzer.cache.normalize_text(' cafe\u0301 for fever')
+
+
+def test_analysis_cache_ttl():
+    cache = analyzer.cache.AnalysisCache(10, ttl=0)
+    cache.put('a', 'a value')
+    value, stored_at, size = cache.entries['a']
+    cache.entries['a'] = (value, stored_at - 1, size)
+    assert cache.get('a') is None
+
+
+def test_analysis_cache_store(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = analyzer.cache.AnalysisCache(10, path=path, namespace='profile',
+                                         fingerprint='v1')
+    cache.put('a', ['pattern', 'Doctor', '<from Name>'])
+    # A new process would find the stored entry
+    cache = analyzer.cache.AnalysisCache(10, path=path, namespace='profile',
+                                         fingerprint='v1')
+    assert cache.get('a') == ['pattern', 'Doctor', '<from Name>']
+    # But not after the language data has changed
+    cache = analyzer.cache.AnalysisCache(10, path=path, namespace='profile',
+                                         fingerprint='v2')
+    assert cache.get('a') is None
+
+
+def test_sqlite_store_limits(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    store = analyzer.cache.SqliteStore(path, 'text', 'v1', max_rows=50)
+    for index in range(2 * analyzer.cache.STORE_TRIM_INTERVAL):
+        store.put(str(index), index, 1000.0 + index)
+    rows = store.connect().execute('SELECT key FROM cache ORDER BY stored_at').fetchall()
+    # The oldest rows are evicted
+    assert len(rows) == 50
+    assert rows[0][0] == str(2 * analyzer.cache.STORE_TRIM_INTERVAL - 50)
+    store = analyzer.cache.SqliteStore(path, 'text', 'v1', ttl=60)
+    store.put('new', 1, 1000.0 + 2 * analyzer.cache.STORE_TRIM_INTERVAL + 30)
+    # The expired rows are purged
+    rows = store.connect().execute('SELECT key FROM cache').fetchall()
+    assert len(rows) == 31
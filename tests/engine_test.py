@@ -1,7 +1,8 @@
 """
 engine_test.py
 """
-from analyzer.engine import dummy_nlp_analysis
+import analyzer.engine
+from analyzer.engine import dummy_nlp_analysis, nlp_analysis, nlp_analysis_batch
 
 
 def test_dummy_nlp_analysis():
@@ -18,3 +19,63 @@ def test_dummy_nlp_analysis():
     assert example_analysis["profile"] == "radiologist"
     assert example_analysis["problem"] == "diabetes"
     assert example_analysis["solution"] == "aspirin"
+
+
+def test_nlp_analysis_batch():
+    jobs = [{
+        "user_name": "John Paul, MD",
+        "user_description": "G.P. and father",
+        "created_at": "2017-04-02T22:35:04.868Z",
+        "message": "The new treatment for angiosarcoma is here",
+        "source": "twitter",
+        "query": "angiosarcoma"
+    }, {
+        "user_name": "jdonado",
+        "user_description": "Some random radiologist.",
+        "created_at": "2017-04-02T22:35:04.868Z",
+        "message": "Some random message",
+        "source": "twitter",
+        "query": "diabetes"
+    }]
+    results = nlp_analysis_batch(jobs, batch_size=2, n_threads=1)
+    assert len(results) == 2
+    assert results[1] is None
+    expected = nlp_analysis(jobs[0])
+    assert results[0]['profile'] == expected['profile'] == 'Doctor'
+    assert results[0]['problem'] == expected['problem'] == 'angiosarcoma'
+    assert results[0]['solution'] == expected['solution']
+
+
+def test_user_analysis_cached():
+    misses = analyzer.engine.PROFILE_CACHE.misses
+    hits = analyzer.engine.PROFILE_CACHE.hits
+    first = analyzer.engine.user_analysis_cached('John Paul, MD', 'G.P., father of two')
+    second = analyzer.engine.user_analysis_cached('John Paul, MD', 'G.P., father of two')
+    assert first == second == [', MD', 'Doctor', '<from Name>']
+    assert analyzer.engine.PROFILE_CACHE.misses == misses + 1
+    assert analyzer.engine.PROFILE_CACHE.hits == hits + 1
+
+
+def test_message_analysis_cached():
+    misses = analyzer.engine.TEXT_CACHE.misses
+    hits = analyzer.engine.TEXT_CACHE.hits
+    message = 'Is there any cure for angiosarcoma? Asking for a friend'
+    first = analyzer.engine.message_analysis_cached(message)
+    # A retweet with some extra whitespace hits the cache
+    second = analyzer.engine.message_analysis_cached(message + ' ')
+    assert first == second == analyzer.engine.analyze_message(message)
+    assert analyzer.engine.TEXT_CACHE.misses == misses + 1
+    assert analyzer.engine.TEXT_CACHE.hits == hits + 1
+
+
+def test_engine():
+    engine = analyzer.engine.Engine(snapshot_path=None)
+    # Nothing is loaded until it is needed
+    assert engine.resources is None
+    assert engine.caches is None
+    assert len(engine.language_data['start_words']) > 0
+    assert engine.resources is not None
+    assert engine.caches is None
+    engine.warm_up()
+    assert engine.caches is not None
+    assert analyzer.engine.LANGUAGE_DATA is analyzer.engine.ENGINE.language_data
@@ -19,6 +19,17 @@ def test_enlarge_message():
     assert result == 'Pretty tinny long short yellow dummy. This is another message. Pretty tinny long short yellow dummy'
 
 
+def test_parsed_message():
+
+    parsed_message = magic_bullet_analyzer.ParsedMessage('Magic treatment is now available for obesity')
+    assert parsed_message.enlarged_message.endswith('. Pretty tinny long short yellow dummy')
+    assert parsed_message.from_enlarged(parsed_message.to_enlarged(6)) == 6
+    assert 'Magic treatment' in parsed_message.enlarged_noun_phrases()
+    assert ('Magic treatment', 0, 15) in parsed_message.noun_chunks()
+    assert ('obesity', 16, 23) in parsed_message.noun_chunks(21)
+    assert parsed_message.parses == 1
+
+
 def test_get_magic_bullet_instance_and_type():
 
     result = magic_bullet_analyzer.get_magic_bullet_instance_and_type('[np = treatment]')
@@ -54,6 +65,21 @@ def test_get_regex_match():
 
 
 
+def test_magic_bullet_grammar():
+
+    magic_bullet_grammar = magic_bullet_analyzer.MagicBulletGrammar([
+        '[np = surgery]',
+        '[npl]is the treatment',
+        'the treatment is[npr]'])
+    assert '[np = surgery]' in magic_bullet_grammar
+    assert [rule['type'] for rule in magic_bullet_grammar.rules] == ['case A', 'case B', 'case C']
+    assert magic_bullet_grammar.combined_regex is not None
+
+    message = 'A new wonderful medicine is the treatment available in obesity'
+    result = magic_bullet_grammar.regex_matches(message)
+    assert result == {1: 'A new wonderful medicine is the treatment'}
+
+
 def test_magic_bullet_analyzer():
 
     start_word = 'obesity'
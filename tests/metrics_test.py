@@ -0,0 +1,114 @@
+"""
+Metrics tests.
+"""
+import json
+import urllib.request
+from analyzer import metrics
+from analyzer.engines import text_analyzer
+
+
+def setup_function(function):
+    metrics.REGISTRY.reset()
+    metrics.enable()
+
+
+def teardown_function(function):
+    metrics.disable()
+    metrics.REGISTRY.reset()
+
+
+def test_disabled():
+    metrics.disable()
+    started_at = metrics.start()
+    assert started_at is None
+    metrics.stop('stage_seconds', started_at, stage='grammar')
+    metrics.observe('queue_wait_seconds', 1.0)
+    metrics.increment('jobs_total', result='analyzed')
+    assert metrics.REGISTRY.histograms == {}
+    assert metrics.REGISTRY.counters == {}
+
+
+def test_histogram():
+    histogram = metrics.Histogram(buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value)
+    assert histogram.cumulative_counts() == [2, 3, 4]
+    assert histogram.count == 4
+    assert abs(histogram.sum - 2.65) < 1e-9
+
+
+def test_render():
+    metrics.observe('queue_wait_seconds', 3.0)
+    metrics.stop('stage_seconds', metrics.start(), stage='grammar')
+    metrics.increment('jobs_total', result='analyzed')
+    metrics.increment('jobs_total', result='analyzed')
+    output = metrics.REGISTRY.render()
+    assert '# TYPE health_nlp_jobs_total counter' in output
+    assert 'health_nlp_jobs_total{result="analyzed"} 2' in output
+    assert '# TYPE health_nlp_stage_seconds histogram' in output
+    assert 'health_nlp_stage_seconds_count{stage="grammar"} 1' in output
+    assert 'health_nlp_queue_wait_seconds_bucket{le="2.5"} 0' in output
+    assert 'health_nlp_queue_wait_seconds_bucket{le="5.0"} 1' in output
+    assert 'health_nlp_queue_wait_seconds_bucket{le="+Inf"} 1' in output
+    assert 'health_nlp_queue_wait_seconds_sum 3.0' in output
+
+
+def test_analyzer_stages():
+    language_data = text_analyzer.language_data_loader(
+        './tests/engines/demo_grammar.txt',
+        './tests/engines/demo_counter_grammar.txt',
+        './tests/engines/demo_start_words.txt',
+        './tests/engines/demo_stop_words.txt')
+    text_analyzer.analyzer('Some random message',
+                           language_data['start_words'],
+                           language_data['grammar'],
+                           language_data['counter_grammar'],
+                           language_data['stop_words'],
+                           language_data['magic_bullet_grammar'])
+    stages = metrics.REGISTRY.histograms['stage_seconds']
+    assert stages[(('stage', 'start_word'),)].count == 1
+    assert (('stage', 'grammar'),) not in stages
+
+
+def test_serve():
+    metrics.increment('jobs_total', result='discarded')
+    server = metrics.serve('127.0.0.1', 0)
+    try:
+        url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/metrics'
+        body = urllib.request.urlopen(url).read().decode('utf-8')
+        assert 'health_nlp_jobs_total{result="discarded"} 1' in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stats_logger(tmpdir):
+    path = str(tmpdir.join('stats.log'))
+    metrics.observe('analysis_seconds', 0.5)
+    stats_logger = metrics.StatsLogger(path, interval=3600)
+    stats_logger.close()
+    with open(path) as stats_file:
+        line = json.loads(stats_file.readline())
+    assert line['histograms']['analysis_seconds'] == dict(count=1, sum=0.5, mean=0.5)
+
+
+def test_setup():
+    metrics.disable()
+    assert metrics.setup(dict(metrics_enabled=False)) == (None, None)
+    assert not metrics.enabled()
+    server, stats_logger = metrics.setup(dict(metrics_enabled=True, metrics_port=0))
+    assert metrics.enabled()
+    assert server is None and stats_logger is None
+
+
+def test_rules_evaluated():
+    rule_set = text_analyzer.RuleSet(['[s] for [p]', '[s] for( \\S+){0,3} [p]'],
+                                     remove_solution=True)
+    rule_set.longest_match('A new medicine for severe obesity', 'obesity')
+    rule_set.longest_match('A new medicine for diabetes', 'obesity')
+    histogram = metrics.REGISTRY.histograms['rules_evaluated'][(('kind', 'grammar'),)]
+    assert histogram.count == 2
+    assert histogram.sum == 4
+    assert histogram.buckets == metrics.COUNT_BUCKETS
+    assert 'health_nlp_rules_evaluated_bucket{kind="grammar",le="1"} 0' in \
+        metrics.REGISTRY.render()
@@ -0,0 +1,104 @@
+"""
+output_test.py
+"""
+import threading
+import analyzer.output
+
+
+class DummyUploader(object):
+
+    def __init__(self):
+        self.uploaded = []
+
+    def upload_analysis(self, analysis_json):
+        self.uploaded.append(analysis_json)
+        return True
+
+
+class DummyBatchUploader(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def upload_analyses(self, analyses):
+        self.batches.append(analyses)
+        # Analyses marked as 'fail' are returned as failed
+        return [analysis_json for analysis_json in analyses if analysis_json.get('fail')]
+
+
+class FailingUploader(object):
+
+    def upload_analysis(self, analysis_json):
+        raise IOError('Connection refused')
+
+
+def test_output_stage():
+    uploader = DummyUploader()
+    batch_uploader = DummyBatchUploader()
+    output_stage = analyzer.output.OutputStage([uploader, batch_uploader],
+                                               queue_size=10, batch_size=3,
+                                               flush_interval=0.01)
+    for index in range(5):
+        output_stage.submit({'message': str(index)}, 'job' + str(index))
+    output_stage.close()
+    assert [analysis['message'] for analysis in uploader.uploaded] == ['0', '1', '2', '3', '4']
+    assert sum(len(batch) for batch in batch_uploader.batches) == 5
+    assert all(len(batch) <= 3 for batch in batch_uploader.batches)
+    completed = output_stage.pop_completed()
+    assert sorted(completed) == [('job0', []), ('job1', []), ('job2', []),
+                                 ('job3', []), ('job4', [])]
+    assert output_stage.pop_completed() == []
+
+
+def test_output_stage_failure():
+    analyzer.output.RETRY_BACKOFF = 0
+    output_stage = analyzer.output.OutputStage([DummyUploader(), FailingUploader()],
+                                               flush_interval=0.01)
+    output_stage.submit({'message': 'some message'}, 'job')
+    output_stage.close()
+    assert output_stage.pop_completed() == [('job', [1])]
+
+
+def test_output_stage_retry_sinks():
+    analyzer.output.RETRY_BACKOFF = 0
+    uploader = DummyUploader()
+    output_stage = analyzer.output.OutputStage([uploader, FailingUploader()],
+                                               flush_interval=0.01)
+    # A retried job is only submitted to the sinks that failed
+    output_stage.submit({'message': 'some message'}, 'job', sinks=[1])
+    output_stage.submit({'message': 'other message'}, 'other job', sinks=[])
+    output_stage.close()
+    assert uploader.uploaded == []
+    assert sorted(output_stage.pop_completed()) == [('job', [1]), ('other job', [])]
+
+
+def test_output_stage_failed_items():
+    output_stage = analyzer.output.OutputStage([DummyBatchUploader()], flush_interval=0.01)
+    output_stage.submit({'message': 'some message'}, 'job1')
+    output_stage.submit({'message': 'other message', 'fail': True}, 'job2')
+    output_stage.close()
+    assert sorted(output_stage.pop_completed()) == [('job1', []), ('job2', [0])]
+
+
+class BlockingUploader(object):
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def upload_analysis(self, analysis_json):
+        self.release.wait()
+        return True
+
+
+def test_output_stage_stale_tokens():
+    uploader = BlockingUploader()
+    output_stage = analyzer.output.OutputStage([uploader], flush_interval=0.01)
+    output_stage.submit({'message': 'some message'}, 'job')
+    assert output_stage.stale_tokens(60) == []
+    assert output_stage.stale_tokens(0) == ['job']
+    # The token was just returned
+    assert output_stage.stale_tokens(60) == []
+    uploader.release.set()
+    output_stage.close()
+    assert output_stage.pop_completed() == [('job', [])]
+    assert output_stage.stale_tokens(0) == []
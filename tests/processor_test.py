@@ -42,3 +42,30 @@ def test_process_job(mock_engine):
     }
     analyzer.processor.process_job(example_job, mock_fb_uploader, mock_es_uploader)
     mock_engine.nlp_analysis.assert_called_once_with(example_job)
+
+
+class MockOutputStage(object):
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, analysis_json, token, sinks=None):
+        self.submitted.append((analysis_json, token))
+
+
+@mock.patch('analyzer.engine')
+def test_process_job_async(mock_engine):
+    example_job = {
+        "user_name": "jdonado",
+        "user_description": "Some random radiologist.",
+        "message": "Some random message",
+        "source": "twitter",
+        "query": "diabetes"
+    }
+    output_stage = MockOutputStage()
+    mock_engine.nlp_analysis.return_value = {"health_related": "true"}
+    assert analyzer.processor.process_job_async(example_job, output_stage, 'job')
+    assert output_stage.submitted == [(example_job, 'job')]
+    mock_engine.nlp_analysis.return_value = None
+    assert not analyzer.processor.process_job_async(example_job, output_stage, 'job')
+    assert len(output_stage.submitted) == 1
@@ -0,0 +1,96 @@
+"""
+Rule profiler tests.
+"""
+import io
+import json
+import re
+from analyzer import rule_profiler
+from analyzer.engines import text_analyzer
+
+
+def setup_function(function):
+    rule_profiler.PROFILER.reset()
+    rule_profiler.enable()
+
+
+def teardown_function(function):
+    rule_profiler.disable()
+    rule_profiler.PROFILER.reset()
+
+
+def test_disabled():
+    rule_profiler.disable()
+    assert rule_profiler.active() is None
+    rule_set = text_analyzer.RuleSet(['[s] for [p]'], remove_solution=True)
+    rule_set.longest_match('A new medicine for obesity', 'obesity')
+    assert rule_profiler.PROFILER.rules == {}
+
+
+def test_profile_rule_set(tmpdir):
+    rule_set = text_analyzer.RuleSet(['[s] for [p]', '[s] for( \\S+){0,3} [p]'],
+                                     remove_solution=True, kind='grammar')
+    counter_rule_set = text_analyzer.RuleSet(['risk for( \\S+){0,5} [p]'],
+                                             kind='counter_grammar')
+    for message in ['A new medicine for obesity', 'A new medicine for severe obesity',
+                    'Nothing to see here']:
+        assert rule_set.longest_match(message, 'obesity') is not None or \
+            message == 'Nothing to see here'
+        counter_rule_set.longest_match(message, 'obesity', stop_at_first=True)
+    stats = rule_profiler.PROFILER.rules[('grammar', '[s] for( \\S+){0,3} [p]')]
+    assert stats.searches == 3
+    assert stats.hits == 2
+    assert stats.worst_input is not None
+    assert stats.seconds >= stats.worst_seconds > 0
+    assert rule_profiler.PROFILER.rules[('counter_grammar', 'risk for( \\S+){0,5} [p]')].hits == 0
+    assert len(rule_profiler.PROFILER.ranking()) == 3
+    assert len(rule_profiler.PROFILER.ranking(1)) == 1
+
+    output = io.StringIO()
+    rule_profiler.PROFILER.report(file=output)
+    assert output.getvalue().startswith('3 rules, ')
+    assert '[s] for( \\S+){0,3} [p]' in output.getvalue()
+    path = str(tmpdir.join('report.json'))
+    rule_profiler.PROFILER.dump(path)
+    with open(path) as report_file:
+        report = json.load(report_file)
+    assert len(report) == 3
+    assert set(report[0].keys()) >= set(['kind', 'pattern', 'searches', 'hits', 'seconds',
+                                         'worst_seconds', 'worst_input'])
+
+
+def test_profile_magic_bullet_grammar():
+    grammar = text_analyzer.magic_bullet_analyzer.MagicBulletGrammar(
+        ['[npl]is the treatment', 'the treatment is[npr]'])
+    message = 'Dexamethasone is a good drug, it is the treatment for cancer'
+    rule_profiler.disable()
+    expected = grammar.regex_matches(message)
+    rule_profiler.enable()
+    assert grammar.regex_matches(message) == expected
+    assert rule_profiler.PROFILER.rules[('magic_bullet', '[npl]is the treatment')].hits == 1
+    assert rule_profiler.PROFILER.rules[('magic_bullet', 'the treatment is[npr]')].hits == 0
+
+
+def test_check_rules():
+    rules = [('[s] for [p]', re.compile(' for cancer')),
+             ('(a+)+b', re.compile('(a+)+b'))]
+    slow_rules = rule_profiler.check_rules('grammar', rules, threshold=0.005)
+    assert [slow_rule[1] for slow_rule in slow_rules] == ['(a+)+b']
+    assert slow_rules[0][2] > 0.005
+    assert set(slow_rules[0][3]) == set('a')
+
+
+def test_check_language_data(capsys):
+    """
+    Loading the language data in profiling mode flags the slow rules.
+    """
+    language_data = text_analyzer.language_data_loader(
+        './tests/engines/demo_grammar.txt',
+        './tests/engines/demo_counter_grammar.txt',
+        './tests/engines/demo_start_words.txt',
+        './tests/engines/demo_stop_words.txt')
+    output = capsys.readouterr().out
+    assert 'Slow grammar rule' in output
+    assert '[s] low\\w*( \\w+)* risks*( \\S+){1,7} [p]' in output
+    assert '[s] to let go of [p]' not in output
+    slow_rules = text_analyzer.check_rules(language_data)
+    assert '[s] to let go of [p]' not in [slow_rule[1] for slow_rule in slow_rules]
@@ -3,6 +3,9 @@
 runner_test.py
 """
 
+import json
+import time
+from collections import OrderedDict
 import analyzer.runner
 
 
@@ -44,3 +47,206 @@ def test_runner():
                            storage_bucket="storageBucket", email="email", password="password")
     analyzer.runner.setup_and_run(
         beanstalkd_config, firebase_config, es_config, False)
+
+
+def exiting_worker():
+    pass
+
+
+def test_worker_pool():
+    pool = analyzer.runner.WorkerPool(2, exiting_worker, ())
+    pool.start()
+    for process in pool.processes:
+        process.join()
+    pool.check()
+    assert pool.restarts == 2
+    pool.stop()
+    assert all(not process.is_alive() for process in pool.processes)
+    pool.check()
+    assert pool.restarts == 2
+
+
+def test_print_stats(capsys):
+    analyzer.runner.print_stats(1000)
+    output = capsys.readouterr().out
+    assert output.startswith('Processed 1000 jobs. ')
+    assert 'profile cache: ' in output
+    assert 'text cache: ' in output
+
+
+class DummyTubes(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.used = []
+        self.put_jobs = []
+
+    def use(self, tube):
+        self.used.append(tube)
+
+    def put(self, body):
+        if self.fail:
+            raise OSError('Connection lost')
+        self.put_jobs.append((self.used[-1], body))
+
+
+class DummyTimedOutJob(object):
+    def __init__(self, body='Job body', releases=0):
+        self.body = body
+        self.releases = releases
+        self.state = 'reserved'
+
+    def delete(self):
+        self.state = 'deleted'
+
+    def bury(self):
+        self.state = 'buried'
+
+    def release(self, delay=0):
+        self.state = 'released'
+
+    def stats(self):
+        return {'releases': self.releases}
+
+
+def test_move_to_timeout_tube():
+    beanstalk = DummyTubes()
+    job = DummyTimedOutJob()
+    analyzer.runner.move_to_timeout_tube(beanstalk, job, dict(message='message'), 2.0)
+    assert job.state == 'deleted'
+    tube, body = beanstalk.put_jobs[0]
+    assert tube == 'timeout'
+    assert json.loads(body)['analysis']['solution'] == '<timeout>'
+    assert beanstalk.used[-1] == 'default'
+    beanstalk = DummyTubes(fail=True)
+    job = DummyTimedOutJob()
+    analyzer.runner.move_to_timeout_tube(beanstalk, job, dict(message='message'), 2.0)
+    assert job.state == 'buried'
+    assert beanstalk.used[-1] == 'default'
+
+
+class DummyExpiredJob(object):
+    def __init__(self):
+        self.touched = 0
+
+    def delete(self):
+        raise OSError('NOT_FOUND')
+
+    def release(self, delay=0):
+        raise OSError('NOT_FOUND')
+
+    def touch(self):
+        self.touched += 1
+
+
+def test_acknowledge_jobs():
+    job = DummyTimedOutJob()
+    # Jobs that beanstalkd has forgotten don't stop the others
+    analyzer.runner.acknowledge_jobs([(DummyExpiredJob(), []), (DummyExpiredJob(), [1]),
+                                      (job, [])])
+    assert job.state == 'deleted'
+    expired_job = DummyExpiredJob()
+    analyzer.runner.touch_jobs([expired_job, DummyTimedOutJob()])
+    assert expired_job.touched == 1
+
+
+def test_worker_pool_backoff():
+    pool = analyzer.runner.WorkerPool(1, exiting_worker, (), max_restarts=2)
+    pool.start()
+    pool.processes[0].join()
+    # The first crash is restarted right away, the next one after a delay
+    pool.check()
+    assert pool.restarts == 1
+    pool.processes[0].join()
+    pool.check()
+    assert pool.restarts == 1
+    assert pool.restart_at[0] > time.time()
+    pool.restart_at[0] = 0
+    pool.check()
+    assert pool.restarts == 2
+    pool.processes[0].join()
+    # Too many crashes in a row stop the pool
+    pool.check()
+    assert pool.stopping and pool.failed
+    assert pool.restarts == 2
+
+
+def test_acknowledge_failed_jobs():
+    failed_sinks_by_job = OrderedDict()
+    released_job = DummyTimedOutJob('released job')
+    buried_job = DummyTimedOutJob('buried job', releases=analyzer.runner.MAX_RELEASES)
+    analyzer.runner.acknowledge_jobs([(released_job, [1]), (buried_job, [0, 1])],
+                                     failed_sinks_by_job)
+    assert released_job.state == 'released'
+    assert buried_job.state == 'buried'
+    # The released job is only retried on the sink that failed
+    assert analyzer.runner.retry_sinks(DummyTimedOutJob('released job'),
+                                       failed_sinks_by_job) == [1]
+    assert analyzer.runner.retry_sinks(DummyTimedOutJob('released job'),
+                                       failed_sinks_by_job) is None
+
+
+class DummyTouchedJob(object):
+    body = "Job body"
+
+    def __init__(self):
+        self.touched = 0
+
+    def touch(self):
+        self.touched += 1
+
+
+class DeadlineSoonBeanstalkd(object):
+    """
+    Reports the deadline of a job once, then has no jobs.
+    """
+
+    def __init__(self, host, port):
+        self.reserves = 0
+
+    def reserve(self, timeout=None):
+        self.reserves += 1
+        if self.reserves == 1:
+            raise analyzer.runner.pystalkd.Beanstalkd.DeadlineSoon('DEADLINE_SOON')
+        return None
+
+
+class DummyOutputStage(object):
+    def __init__(self, uploaders, queue_size, batch_size, flush_interval):
+        self.job = DummyTouchedJob()
+
+    def pop_completed(self):
+        return []
+
+    def stale_tokens(self, interval):
+        return [self.job] if interval == 0 else []
+
+    def close(self):
+        pass
+
+
+def test_runner_deadline_soon(monkeypatch):
+    monkeypatch.setattr(analyzer.runner.pystalkd.Beanstalkd, 'Connection', DeadlineSoonBeanstalkd)
+    monkeypatch.setattr(analyzer.runner, 'ElasticsearchAnalysisUploader',
+                        lambda *args: None)
+    output_stages = []
+
+    def output_stage(*args):
+        output_stages.append(DummyOutputStage(*args))
+        return output_stages[-1]
+
+    monkeypatch.setattr(analyzer.runner, 'OutputStage', output_stage)
+    checks = dict(count=0)
+
+    def should_stop():
+        checks['count'] += 1
+        return checks['count'] > 2
+
+    firebase_config = dict(api_key="someKey", auth_domain="authDomain", database_url="databaseUrl",
+                           storage_bucket="storageBucket", email="email", password="password")
+    output_config = dict(async_output=True, output_queue_size=10, output_batch_size=5,
+                         output_flush_interval=0.01)
+    analyzer.runner.setup_and_run(dict(beanstalk_ip='localhost', beanstalk_port=11300),
+                                  firebase_config, dict(url='', user='', password=''), True,
+                                  should_stop=should_stop, output_config=output_config)
+    # The pending jobs were touched instead of crashing the worker
+    assert output_stages[0].job.touched == 1
@@ -0,0 +1,40 @@
+"""
+snapshot_test.py
+"""
+import shutil
+import analyzer.snapshot
+
+
+def copy_language_data(tmp_path):
+    paths = dict()
+    for name, path in analyzer.snapshot.LANGUAGE_DATA_PATHS.items():
+        paths[name] = str(tmp_path / (name + '.txt'))
+        shutil.copy(path, paths[name])
+    return paths
+
+
+def test_load_resources(tmp_path, monkeypatch):
+    paths = copy_language_data(tmp_path)
+    snapshot_path = str(tmp_path / 'language_data.snapshot')
+    resources = analyzer.snapshot.load_resources(paths, snapshot_path)
+    assert len(resources['language_data']['start_words']) > 0
+
+    # The second time, the resources come from the snapshot
+    built = []
+    build_resources = analyzer.snapshot.build_resources
+    monkeypatch.setattr(analyzer.snapshot, 'build_resources',
+                        lambda paths: built.append(paths) or build_resources(paths))
+    loaded = analyzer.snapshot.load_resources(paths, snapshot_path)
+    assert len(built) == 0
+    assert loaded['dictionary'] == resources['dictionary']
+    assert list(loaded['language_data']['grammar']) == list(resources['language_data']['grammar'])
+    assert loaded['string_twitter_queries'].queries == resources['string_twitter_queries'].queries
+
+    # And it is rebuilt when a source file changes
+    with open(paths['stop_words'], 'a', encoding='utf-8') as stop_words_file:
+        stop_words_file.write('\nsomeone\n')
+    loaded = analyzer.snapshot.load_resources(paths, snapshot_path)
+    assert len(built) == 1
+    assert 'someone' in loaded['language_data']['stop_words']
+    analyzer.snapshot.load_resources(paths, snapshot_path)
+    assert len(built) == 1
@@ -63,6 +63,35 @@ def test_start_word_match():
                                             {'disease': ['acute disease', 'hard disease']})
     assert result == 'Hard disease'
 
+def test_start_word_index():
+    """
+    StartWordIndex tests
+    """
+    start_words = ['blue toothache', 'black toothache', 'blue backpain', 'black backpain',
+                   'pain of the back']
+    index = text_analyzer.StartWordIndex(start_words)
+    assert dict(index.items()) == text_analyzer.start_words_to_dict(start_words)
+    assert list(index.keys()) == ['blue', 'toothache', 'black', 'backpain', 'pain', 'back']
+    assert index['blue'] == ['blue toothache', 'blue backpain']
+    assert 'of' not in index
+    assert len(index) == 6
+    automaton = text_analyzer.StartWordAutomaton(index)
+    assert automaton.search('my black backpain') == ['black backpain', 3, 17]
+
+
+def test_start_word_automaton():
+    """
+    StartWordAutomaton tests
+    """
+    start_words = text_analyzer.start_words_to_dict(['acute disease', 'hard disease', 'disease'])
+    automaton = text_analyzer.StartWordAutomaton(start_words)
+    assert 'disease' in automaton.keys()
+    assert automaton.search('some input message') is None
+    assert automaton.search('a disease, a hard disease') == ['hard disease', 13, 25]
+    result = text_analyzer.start_word_match("Some Acute Disease", automaton)
+    assert result == 'Acute Disease'
+
+
 def test_get_start_word_from_sentence():
     """
     Start word from sentence tests
@@ -76,6 +105,29 @@ def test_get_start_word_from_sentence():
     assert result[1] == 'and in the second you can find acute disease'
 
 
+def test_sentence_spans():
+    """
+    Sentence segmentation tests
+    """
+    message = 'First one. Second one? yes, and - no: more... Last http://t.co'
+    sentences = [message[start:end] for start, end in text_analyzer.sentence_spans(message)]
+    assert sentences == ['First one.', 'Second one', 'yes', 'and', 'no', 'more', '', 'Last ', '://t.co']
+    # The bounds with a higher priority win, as when they were replaced in order
+    message = 'Really? Yes, - and so.'
+    sentences = [message[start:end] for start, end in text_analyzer.sentence_spans(message)]
+    assert sentences == ['Really?', 'Yes,', 'and so.']
+
+
+def test_get_start_word_span():
+    """
+    Start word span tests
+    """
+    message = "First, acute disease is hard. Acute disease again"
+    start_words = {'disease': ['acute disease', 'hard disease']}
+    assert text_analyzer.get_start_word_span(message, start_words) == ['acute disease', 7, 29]
+    assert text_analyzer.get_start_word_span("No start word", start_words) is None
+
+
 def test_counter_analyzer():
     """
     Counter analyzer tests
@@ -92,6 +144,39 @@ def test_counter_analyzer():
     assert analysis is False
 
 
+def test_rule_set():
+    """
+    RuleSet tests
+    """
+    rule_set = text_analyzer.RuleSet(['[s] for [p]', '[s] for( \\S+){0,3} [p]'],
+                                     remove_solution=True, cache_size=1)
+    assert '[s] for [p]' in rule_set
+    result = rule_set.longest_match('A new medicine for severe obesity', 'obesity')
+    assert result == [' for severe obesity', '[s] for( \\S+){0,3} [p]']
+    assert rule_set.longest_match('A new medicine for diabetes', 'obesity') is None
+    assert list(rule_set.cache.keys()) == ['obesity']
+    rule_set.longest_match('A new medicine for diabetes', 'diabetes')
+    assert list(rule_set.cache.keys()) == ['diabetes']
+
+
+def test_rule_set_cache_size():
+    """
+    The RuleSet cache is limited by compiled rules, not start words
+    """
+    rule_set = text_analyzer.RuleSet(['[s] for [p]', '[s] for( \\S+){0,3} [p]'],
+                                     remove_solution=True, cache_size=5)
+    for start_word in ['obesity', 'diabetes', 'cancer']:
+        rule_set.longest_match('A new medicine for ' + start_word, start_word)
+    assert list(rule_set.cache.keys()) == ['diabetes', 'cancer']
+    assert rule_set.cached_rules == 4
+    rule_set.resize_cache(2)
+    assert list(rule_set.cache.keys()) == ['cancer']
+    rule_set.resize_cache(0)
+    assert rule_set.cached_rules == 0
+    assert rule_set.longest_match('A new medicine for cancer', 'cancer') is not None
+    assert len(rule_set.cache) == 0
+
+
 def test_get_noun_phrase():
     """
     get_noun_phrase() test
@@ -116,6 +201,44 @@ def test_get_noun_phrase():
     assert result == None
 
 
+def test_stop_words():
+    """
+    StopWords tests
+    """
+    stop_words = text_analyzer.StopWords(['^i$', '^@\\w+$', 'way\\w*'])
+    assert '^i$' in stop_words
+    assert len(stop_words) == 3
+    assert stop_words.search('@someone')
+    assert stop_words.search('the ways')
+    assert not stop_words.search('a new device')
+    assert not text_analyzer.StopWords([]).search('a new device')
+
+
+def test_get_noun_phrase_offsets():
+    """
+    get_noun_phrase() takes the noun phrases by their offsets in an
+    already parsed message, even when their text is repeated.
+    """
+    message = 'It works. A device for diabetes is a device'
+    parsed_message = text_analyzer.magic_bullet_analyzer.ParsedMessage(message)
+    parsed_message._noun_chunks = [
+        (text, parsed_message.to_enlarged(start), parsed_message.to_enlarged(start + len(text)))
+        for text, start in [('It', 0), ('A device', 10), ('diabetes', 23),
+                            ('a device', 35)]]
+    sentence_start = 10
+    sentence = message[sentence_start:]
+    result = text_analyzer.get_noun_phrase(sentence, 'for diabetes', 'sp', ['^a device$'],
+                                           parsed_message, sentence_start)
+    assert result == 'A device'
+    result = text_analyzer.get_noun_phrase(sentence, 'for diabetes', 'sp', ['device'],
+                                           parsed_message, sentence_start)
+    assert result is None
+    result = text_analyzer.get_noun_phrase(sentence, 'diabetes is', 'ps', ['^A device$'],
+                                           parsed_message, sentence_start)
+    assert result == 'a device'
+    assert parsed_message.parses == 0
+
+
 def test_check_if_problem_in_solution():
     result = text_analyzer.check_if_problem_in_solution('stop eating', 'obesity')
     assert result is None
@@ -165,3 +288,13 @@ def test_analyzer():
                                       language_data['magic_bullet_grammar'])
     assert analysis[0] == '<nothing_found>'
     assert analysis[1] == 'hyperthyroidism'
+    # The start word isn't searched again when it is given
+    message = "This is a new medicine for hyperthyroidism"
+    analysis = text_analyzer.analyzer(message,
+                                      language_data['start_words'],
+                                      language_data['grammar'],
+                                      language_data['counter_grammar'],
+                                      language_data['stop_words'],
+                                      language_data['magic_bullet_grammar'],
+                                      start_word_span=None)
+    assert analysis[1] == '<no start_word>'
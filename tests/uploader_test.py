@@ -2,11 +2,14 @@
 """
 uploader_test.py
 """
+import json
 import analyzer.uploader
 
 
 class DummyAuth(object):
 
+    refresh_calls = 0
+
     def sign_in_with_email_and_password(self, email, password):
         assert email == "email5"
         assert password == "password6"
@@ -15,6 +18,7 @@ class DummyAuth(object):
 
     def refresh(self, userToken):
         assert userToken == "someToken"
+        DummyAuth.refresh_calls += 1
         return dict(idToken="someIdToken")
 
 
@@ -28,10 +32,21 @@ class DummyChild(object):
 
 class DummyDatabase(object):
 
+    updates = []
+    keys = 0
+
     def child(self, db_name):
         assert db_name == 'analysis'
         return DummyChild()
 
+    def generate_key(self):
+        DummyDatabase.keys += 1
+        return 'key' + str(DummyDatabase.keys)
+
+    def update(self, data, token):
+        assert token == "someIdToken"
+        DummyDatabase.updates.append(data)
+
 
 class DummyPyrebase(object):
 
@@ -88,3 +103,135 @@ def test_uploader():
     assert uploader.upload_analysis(example_analysis)
     assert not uploader.upload_analysis(example_analysis_2)
     return
+
+
+def test_uploader_batch():
+    uploader = analyzer.uploader.FirebaseAnalysisUploader(
+        "apiKey1",
+        "authDomain2",
+        "databaseUrl3",
+        "storageBucket4",
+        "email5",
+        "password6"
+    )
+    DummyAuth.refresh_calls = 0
+    example_analysis = {
+        "source": "twitter",
+        "analysis": {
+            "problem": "some problem",
+            "solution": "some solution"
+        }
+    }
+    irrelevant_analysis = {
+        "source": "twitter",
+        "analysis": {
+            "problem": "",
+            "solution": "<nothing_found>"
+        }
+    }
+    other_analysis = dict(example_analysis, message='other message')
+    assert uploader.upload_analyses([example_analysis, irrelevant_analysis, other_analysis]) == []
+    assert uploader.upload_analysis(example_analysis)
+    # The token is refreshed once and then cached
+    assert DummyAuth.refresh_calls == 1
+    assert len(DummyDatabase.updates) == 1
+    # The keys are derived from the jobs, whatever their analysis
+    assert sorted(DummyDatabase.updates[0].keys()) == sorted([
+        'analysis/' + analyzer.uploader.analysis_key(example_analysis),
+        'analysis/' + analyzer.uploader.analysis_key(other_analysis)])
+    assert analyzer.uploader.analysis_key(example_analysis) == \
+        analyzer.uploader.analysis_key(dict(example_analysis, analysis={}))
+
+
+class DummyResponse(object):
+
+    def __init__(self, result):
+        self.result = result
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.result
+
+
+class DummySession(object):
+    """
+    Fails to index the documents whose message is 'fail' on the first
+    attempt only, and the ones whose message is 'bad' always.
+    """
+
+    def __init__(self):
+        self.bulk_bodies = []
+        self.failed = False
+
+    def post(self, url, data=None, headers=None):
+        assert url == 'http://localhost:9200/_bulk'
+        assert headers['Content-Type'] == 'application/x-ndjson'
+        lines = data.decode('utf-8').splitlines()
+        self.bulk_bodies.append(lines)
+        items = []
+        for document in lines[1::2]:
+            if '"bad"' in document:
+                items.append({'index': {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}})
+            elif '"fail"' in document and not self.failed:
+                items.append({'index': {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}})
+            else:
+                items.append({'index': {'status': 201}})
+        self.failed = True
+        return DummyResponse({'errors': any('error' in item['index'] for item in items),
+                              'items': items})
+
+
+def test_elasticsearch_bulk_uploader():
+    analyzer.uploader.BULK_RETRY_BACKOFF = 0
+    uploader = analyzer.uploader.ElasticsearchAnalysisUploader(
+        'http://localhost:9200', 'elastic', 'changeme', bulk_max_docs=2)
+    uploader.session = DummySession()
+
+    def example(message):
+        return {"source": "twitter", "message": message,
+                "analysis": {"problem": "some problem", "solution": "some solution"}}
+
+    irrelevant = {"source": "twitter", "analysis": {"problem": "", "solution": "<nothing_found>"}}
+    failed = uploader.upload_analyses([example('one'), example('fail'), irrelevant, example('two')])
+    assert failed == []
+    bodies = uploader.session.bulk_bodies
+    # Two chunks (2 docs max), the first one followed by a retry of
+    # its failed item only
+    assert len(bodies) == 3
+    assert len(bodies[0]) == 4 and len(bodies[1]) == 2 and len(bodies[2]) == 2
+    assert '"fail"' in bodies[1][1]
+    assert '"two"' in bodies[2][1]
+    assert json.loads(bodies[0][0]) == {'index': {
+        '_index': 'analysis', '_type': 'health',
+        '_id': analyzer.uploader.analysis_key(example('one'))}}
+
+
+class DummyRequestSession(object):
+
+    def request(self, method, url, **kwargs):
+        return kwargs.get('timeout')
+
+
+def test_set_default_timeout():
+    session = analyzer.uploader.set_default_timeout(DummyRequestSession(), (1, 2))
+    assert session.request('POST', 'http://localhost:9200/_bulk') == (1, 2)
+    assert session.request('POST', 'http://localhost:9200/_bulk', timeout=5) == 5
+
+
+def test_elasticsearch_bulk_rejected():
+    analyzer.uploader.BULK_RETRY_BACKOFF = 0
+    uploader = analyzer.uploader.ElasticsearchAnalysisUploader(
+        'http://localhost:9200', 'elastic', 'changeme')
+    uploader.session = DummySession()
+    bad = {"source": "twitter", "message": "bad",
+           "analysis": {"problem": "some problem", "solution": "some solution"}}
+    fail = dict(bad, message="fail")
+    # The mapping error is not retried, the rejected execution is
+    rejected = []
+    assert uploader.upload_analyses([bad, fail], rejected) == []
+    assert rejected == [bad]
+    bodies = uploader.session.bulk_bodies
+    assert len(bodies) == 2
+    assert len(bodies[1]) == 2 and '"fail"' in bodies[1][1]
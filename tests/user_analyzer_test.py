@@ -41,10 +41,27 @@ def test_lexicon_generator():
     dictionary = user_analyzer.dictionary_parser(USER_DICTIONARY)
     lexicon = user_analyzer.lexicon_generator(USER_GRAMMAR,
                                               dictionary)
-    assert lexicon == {('(?i)(;|,|\\.) practitioner', 'Doctor'): '(?i)(;|,|\\.) practitioner',
-                       ('(?i)^practitioner', 'Doctor'): '(?i)^practitioner',
-                       ('(?i)nurse clinician', 'Professional'): '(?i)nurse clinician',
-                       ('(?i)^physicist', 'Doctor'): '(?i)^physicist'}
+    assert {pattern_tuple: instance.pattern for pattern_tuple, instance in lexicon.items()} == {
+        ('(?i)(;|,|\\.) practitioner', 'Doctor'): '(?i)(;|,|\\.) practitioner',
+        ('(?i)^practitioner', 'Doctor'): '(?i)^practitioner',
+        ('(?i)nurse clinician', 'Professional'): '(?i)nurse clinician',
+        ('(?i)^physicist', 'Doctor'): '(?i)^physicist'}
+
+
+def test_lexicon_matcher():
+    """
+    Find every lexicon instance in a description with the combined matcher
+    """
+    dictionary = user_analyzer.dictionary_parser(USER_DICTIONARY)
+    lexicon = user_analyzer.LexiconMatcher(user_analyzer.lexicon_generator(USER_GRAMMAR,
+                                                                           dictionary))
+    assert lexicon.combined_regex is not None
+    assert user_analyzer.scoped_instance('(?i)^physicist') == '(?i:^physicist)'
+    assert lexicon.matches('Physicist, Practitioner and nurse clinician') == [
+        (('(?i)nurse clinician', 'Professional'), 'nurse clinician'),
+        (('(?i)(;|,|\\.) practitioner', 'Doctor'), ', Practitioner'),
+        (('(?i)^physicist', 'Doctor'), 'Physicist')]
+    assert lexicon.matches('Some random person') == []
 
 
 def test_string_twitter_queriesParser():
@@ -54,7 +71,26 @@ def test_string_twitter_queriesParser():
     
     string_twitter_queries = user_analyzer.string_twitter_queriesParser(STRING_TWITTER_QUERIES)
 
-    assert string_twitter_queries == ['physicist', 'Physicist', 'PHYSICIST']
+    assert string_twitter_queries.queries == ['physicist', 'Physicist', 'PHYSICIST']
+
+
+def test_trie_regex():
+    """
+    Test the regex built from a trie of words
+    """
+    regex = user_analyzer.trie_regex(['doctor', 'docs', 'doc', 'G.P.'])
+    assert regex.pattern == r'(?:G\.P\.|doc(?:s|tor)?)'
+    assert regex.search('Family doctor')
+    assert regex.search('GP') is None
+
+
+def test_query_variants():
+    """
+    Test the case variants of the Twitter queries
+    """
+    assert user_analyzer.query_variants('heart disease') == [
+        'heart disease', 'HEART DISEASE', 'Heart disease']
+    assert user_analyzer.query_variants('G.P.') == ['G.P.', 'g.p.', 'G.p.']
 
 
 def test_user_description_HasQuery():
@@ -72,6 +108,12 @@ def test_user_description_HasQuery():
     result = user_analyzer.user_description_HasQuery(user_description, string_twitter_queries)
     assert result is True
 
+    # Case variants don't need to be listed
+    result = user_analyzer.user_description_HasQuery('PHYSICIST and runner', ['physicist'])
+    assert result is True
+    result = user_analyzer.user_description_HasQuery('pHysicist and runner', ['physicist'])
+    assert result is False
+
 
 def test_user_name_analysis():
     """
@@ -0,0 +1,63 @@
+"""
+Compare the throughput of the single job analysis (nlp_analysis) with
+the batch analysis (nlp_analysis_batch) on the corpus contents.
+
+Usage:
+    python3 try_batch.py [corpus_file] [batch_size] [n_threads]
+"""
+import json
+import sys
+import time
+import analyzer.engine
+
+
+def reset_caches():
+    """
+    Disable the analysis caches and empty the compiled rules of the
+    grammars, so that each path does all the work (spaCy and the rules)
+    instead of hitting the results of the previous one.
+    """
+    analyzer.engine.setup_caches(dict(analyzer.engine.DEFAULT_CACHE_CONFIG,
+                                      profile_cache_size=0, text_cache_size=0))
+    language_data = analyzer.engine.ENGINE.language_data
+    language_data['grammar'].clear_cache()
+    language_data['counter_grammar'].clear_cache()
+
+
+def docs_per_second(count, elapsed):
+    if elapsed == 0:
+        return float('inf')
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    CORPUS_PATH = './corpus/heart_disease_cholesterol_hypertension_diabetes_obesity.json'
+    if len(sys.argv) > 1:
+        CORPUS_PATH = sys.argv[1]
+    BATCH_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else analyzer.engine.BATCH_SIZE
+    N_THREADS = int(sys.argv[3]) if len(sys.argv) > 3 else analyzer.engine.BATCH_THREADS
+
+    with open(CORPUS_PATH, 'r') as corpus_file:
+        JOBS = [json.loads(line) for line in corpus_file if line.strip()]
+
+    print('Jobs: ' + str(len(JOBS)))
+
+    # Load the language data and spaCy before timing anything
+    analyzer.engine.warm_up()
+
+    reset_caches()
+    START = time.time()
+    SINGLE_RESULTS = [analyzer.engine.nlp_analysis(job) for job in JOBS]
+    SINGLE_ELAPSED = time.time() - START
+    print('Single job analysis: %.1f docs/sec' %
+          docs_per_second(len(JOBS), SINGLE_ELAPSED))
+
+    reset_caches()
+    START = time.time()
+    BATCH_RESULTS = analyzer.engine.nlp_analysis_batch(JOBS, BATCH_SIZE, N_THREADS)
+    BATCH_ELAPSED = time.time() - START
+    print('Batch analysis (batch size %d, %d threads): %.1f docs/sec' %
+          (BATCH_SIZE, N_THREADS, docs_per_second(len(JOBS), BATCH_ELAPSED)))
+
+    if BATCH_ELAPSED > 0:
+        print('Speedup: %.2fx' % (SINGLE_ELAPSED / BATCH_ELAPSED))